@@ -0,0 +1,365 @@
+"""Measures the latency of recent2 operations against a synthetic history.
+
+    python3 bench/bench.py run --output /tmp/before.json
+    # ... change recent2.py ...
+    python3 bench/bench.py run --output /tmp/after.json
+    python3 bench/bench.py compare /tmp/before.json /tmp/after.json
+
+Everything runs in this process, so the numbers do not include the python startup time of
+log-recent and recent. See load_test.py for that.
+"""
+import argparse
+import contextlib
+import datetime
+import json
+import os
+import platform
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+import uuid
+from pathlib import Path
+
+import tabulate
+
+from load_test import percentile
+
+# Benchmark the recent2.py next to this directory, not the installed one.
+sys.path.insert(0, str(Path(__file__).absolute().parent.parent))
+import recent2  # noqa: E402
+
+TOOLS = [
+    'git status', 'git commit -m', 'git push origin', 'ls -la', 'cd', 'vim', 'make', 'docker ps',
+    'kubectl get pods -n', 'python3', 'grep -rn', 'ssh', 'cat', 'curl -s', 'tail -f', 'rm -rf'
+]
+ENV_VAR_PREFIX = 'RECENT_BENCH_VAR_'
+SECS_PER_DAY = 24 * 60 * 60
+
+
+# Returns the text of the k-th most popular command.
+def command_text(k):
+    return '{} arg{}'.format(TOOLS[k % len(TOOLS)], k)
+
+
+def env_snapshot(snapshot_num, num_env_vars):
+    return {
+        ENV_VAR_PREFIX + str(i): 'value{}_{}'.format(snapshot_num, i)
+        for i in range(num_env_vars)
+    }
+
+
+def zipf_cum_weights(n, s):
+    cum_weights, total = [], 0.0
+    for k in range(1, n + 1):
+        total += 1 / k**s
+        cum_weights.append(total)
+    return cum_weights
+
+
+class HistoryGenerator:
+    """Generates a synthetic command history.
+
+    Command texts and working directories follow a zipf distribution. The history is spread
+    over `days` days that end now. Sessions run one after another. The last one is the session
+    of this process, so that `recent -cs` finds commands.
+    """
+    def __init__(self, args, rnd):
+        self.args = args
+        self.rnd = rnd
+        self.command_weights = zipf_cum_weights(args.vocabulary, args.zipf)
+        self.pwds = ['/home/bench/src/project{}'.format(i) for i in range(args.pwds)]
+        self.pwd_weights = zipf_cum_weights(args.pwds, args.zipf)
+        self.sessions = [1000000 + i for i in range(args.sessions - 1)] + [os.getppid()]
+        self.end_ts = int(time.time())
+        self.start_ts = self.end_ts - args.days * SECS_PER_DAY
+
+    def command(self):
+        return command_text(
+            self.rnd.choices(range(self.args.vocabulary), cum_weights=self.command_weights)[0])
+
+    def return_value(self):
+        return 0 if self.rnd.random() < 0.9 else self.rnd.choice([1, 2, 127])
+
+    # Yields (ts, command, pid, return_value, pwd, env) tuples in command_ts order.
+    def rows(self, n):
+        for i in range(n):
+            ts = self.start_ts + (self.end_ts - self.start_ts) * i // n
+            pid = self.sessions[i * len(self.sessions) // n]
+            pwd = self.rnd.choices(self.pwds, cum_weights=self.pwd_weights)[0]
+            env = env_snapshot(self.rnd.randrange(self.args.env_snapshots), self.args.env_vars)
+            yield ts, self.command(), pid, self.return_value(), pwd, env
+
+    def write_db(self, conn, n, chunk_size=10000):
+        env_ids, session_ids = {}, {}
+        for pid in self.sessions:
+            session = recent2.Session(pid, sequence=1)
+            recent2.write_with_retry(conn, lambda: session.update(conn))
+            session_ids[pid] = session.id
+        chunk = []
+
+        def write_chunk():
+            for row in chunk:
+                env_key = tuple(sorted(row[-1].items()))
+                if env_key not in env_ids:
+                    env_ids[env_key] = recent2.env_snapshot_id(conn, row[-1])
+            conn.executemany(recent2.DB.INSERT_ROW, [
+                (ts, cmd, pid, ret, pwd, session_ids[pid], env_ids[tuple(sorted(env.items()))])
+                for ts, cmd, pid, ret, pwd, env in chunk])  # yapf: disable
+
+        for row in self.rows(n):
+            chunk.append(row)
+            if len(chunk) == chunk_size:
+                recent2.write_with_retry(conn, write_chunk)
+                chunk = []
+        if chunk:
+            recent2.write_with_retry(conn, write_chunk)
+
+    # Writes n commands in the $HISTFILE format with HISTTIMEFORMAT set.
+    def write_bash_history(self, path, n):
+        with open(path, 'w') as f:
+            for ts, cmd, _, _, _, _ in self.rows(n):
+                f.write('#{}\n{}\n'.format(ts, cmd))
+
+
+def query_ops(generator):
+    # A month in the middle of the history.
+    mid_month = datetime.datetime.fromtimestamp(
+        (generator.start_ts + generator.end_ts) // 2).strftime('%Y-%m')
+    rare_command = command_text(generator.args.vocabulary - 1)
+    return {
+        'query.plain': [],
+        'query.pattern': ['git'],
+        'query.pattern_rare': [rare_command],
+        # In many of the commands, but not in any tool name.
+        'query.pattern_common': ['arg1'],
+        'query.nocase': ['--nocase', 'GIT'],
+        'query.cur_session': ['-cs'],
+        'query.successes_only': ['-so'],
+        'query.failures_only': ['-fo'],
+        'query.status_num': ['-stn', '127'],
+        'query.pwd': ['-w', generator.pwds[-1]],
+        'query.date': ['-d', mid_month],
+        'query.since_until': ['--since', '30d', '--until', '7d'],
+        'query.env_name': ['--env', ENV_VAR_PREFIX + '0'],
+        'query.env_value': ['--env', '{}0:value0_0'.format(ENV_VAR_PREFIX)],
+        'query.char_limit': ['-cl', '20'],
+        'query.return_self': ['--return_self'],
+        'query.sql': ['-sql', 'return_val = 127 and command like "%push%"'],
+        'query.detail': ['--detail', 'git'],
+        'dedup.plain': ['--dedup'],
+        'dedup.pattern': ['--dedup', 'kubectl'],
+        'dedup.pwd': ['--dedup', '-w', generator.pwds[0]],
+        're.literal': ['-re', 'git (commit|push)'],
+        're.common_literal': ['-re', 'git.*arg1'],
+        're.anchored': ['-re', '^ls'],
+        're.no_literal': ['-re', '[0-9]{4}$'],
+    }
+
+
+def summarize(latencies):
+    return {
+        'n': len(latencies),
+        'mean_ms': 1000 * sum(latencies) / len(latencies),
+        'p50_ms': 1000 * percentile(latencies, 50),
+        'p95_ms': 1000 * percentile(latencies, 95),
+        'p99_ms': 1000 * percentile(latencies, 99),
+        'max_ms': 1000 * max(latencies),
+    }
+
+
+# Calls op() iterations times (after one warm up call) and returns the latencies in seconds.
+def measure(op, iterations):
+    op()
+    latencies = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        op()
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def bench_log_command(args, generator):
+    for name, value in env_snapshot(0, args.env_vars).items():
+        os.environ[name] = value
+    pid = 2000000
+    sequence = iter(range(1, sys.maxsize))
+    # The first command of a session is not logged.
+    recent2.log_command('bench', pid, next(sequence), 0, generator.pwds[0])
+    return measure(
+        lambda: recent2.log_command(generator.command(), pid, next(sequence),
+                                    generator.return_value(), generator.pwds[0]),
+        args.log_commands)
+
+
+def bench_import(args, generator, workdir):
+    histfile = os.path.join(workdir, 'bash_history')
+    generator.write_bash_history(histfile, args.import_commands)
+    os.environ['HISTFILE'] = histfile
+    main_db = os.environ['RECENT_DB']
+    latencies = []
+    try:
+        for i in range(args.import_iterations):
+            os.environ['RECENT_DB'] = os.path.join(workdir, 'import{}.db'.format(i))
+            start = time.perf_counter()
+            recent2.import_bash_history()
+            latencies.append(time.perf_counter() - start)
+    finally:
+        os.environ['RECENT_DB'] = main_db
+    return latencies
+
+
+def bench_query(recent_args, iterations):
+    parser = recent2.make_arg_parser_for_recent()
+    args = parser.parse_args(recent_args)
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        return measure(lambda: recent2.handle_recent_command(args, parser.exit), iterations)
+
+
+def run_ops(args, generator, workdir):
+    start = time.perf_counter()
+    conn = recent2.create_connection()
+    generator.write_db(conn, args.commands)
+    conn.close()
+    elapsed = time.perf_counter() - start
+    print('generated {} commands in {:.1f}s'.format(args.commands, elapsed), file=sys.stderr)
+
+    ops = {'log_command': lambda: bench_log_command(args, generator),
+           'import': lambda: bench_import(args, generator, workdir)}
+    for name, recent_args in query_ops(generator).items():
+        ops[name] = lambda recent_args=recent_args: bench_query(recent_args, args.iterations)
+    metrics = {}
+    for name, op in ops.items():
+        if args.ops and not any(name.startswith(prefix) for prefix in args.ops.split(',')):
+            continue
+        print('running ' + name, file=sys.stderr)
+        metrics[name] = summarize(op())
+    return metrics
+
+
+def run(args):
+    workdir = tempfile.mkdtemp(prefix='recent2_bench_')
+    os.environ['RECENT_DB'] = args.db or os.path.join(workdir, 'recent.db')
+    os.environ['PROMPT_COMMAND'] = recent2.EXPECTED_PROMPT
+    # Measure the direct write path and the uncached queries.
+    os.environ['RECENT_DAEMON_SOCKET'] = os.path.join(workdir, 'missing.sock')
+    for name in ['RECENT_SPOOL_DIR', 'RECENT_CACHE_DB', 'RECENT_CUSTOM_PROMPT']:
+        os.environ.pop(name, None)
+    print('RECENT_DB -> ' + os.environ['RECENT_DB'], file=sys.stderr)
+    generator = HistoryGenerator(args, random.Random(args.seed))
+
+    # recent2 prints progress messages (e.g. when building the schema) to stdout.
+    with contextlib.redirect_stdout(sys.stderr):
+        metrics = run_ops(args, generator, workdir)
+
+    result = {
+        'run_id': str(uuid.uuid1()),
+        'time': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'config': {k: v for k, v in vars(args).items() if k not in ('func', 'output')},
+        'metrics': metrics,
+    }
+    text = json.dumps(result, indent=2, sort_keys=True)
+    if args.output:
+        Path(args.output).expanduser().absolute().write_text(text + '\n')
+    else:
+        print(text)
+    print(metrics_table(metrics), file=sys.stderr)
+
+
+def metrics_table(metrics):
+    columns = ['n', 'mean_ms', 'p50_ms', 'p95_ms', 'p99_ms', 'max_ms']
+    table_data = [[name] + [m[c] for c in columns] for name, m in sorted(metrics.items())]
+    return tabulate.tabulate(table_data, headers=['Metric'] + columns, floatfmt='.2f')
+
+
+# Returns the percentiles of `new` that are slower than in `old` by more than threshold (a
+# fraction) and by more than min_ms.
+def regressions(old, new, threshold, min_ms):
+    return [
+        p for p in ('p50_ms', 'p95_ms', 'p99_ms')
+        if new[p] > old[p] * (1 + threshold) and new[p] - old[p] > min_ms
+    ]
+
+
+def compare(args):
+    old = json.loads(Path(args.old).expanduser().read_text())['metrics']
+    new = json.loads(Path(args.new).expanduser().read_text())['metrics']
+    table_data, num_regressions = [], 0
+    for name in sorted(set(old) & set(new)):
+        row = [name]
+        for p in ('p50_ms', 'p95_ms', 'p99_ms'):
+            change = (new[name][p] - old[name][p]) / old[name][p] if old[name][p] else 0
+            row.append('{:.2f} -> {:.2f} ({:+.0%})'.format(old[name][p], new[name][p], change))
+        slower = regressions(old[name], new[name], args.threshold, args.min_ms)
+        num_regressions += bool(slower)
+        row.append('REGRESSION ({})'.format(', '.join(slower)) if slower else '')
+        table_data.append(row)
+    print(tabulate.tabulate(table_data, headers=['Metric', 'p50 ms', 'p95 ms', 'p99 ms', '']))
+    for path, only in [(args.old, set(old) - set(new)), (args.new, set(new) - set(old))]:
+        if only:
+            print('Only in {}: {}'.format(path, ', '.join(sorted(only))))
+    if num_regressions:
+        sys.exit('{} metrics regressed'.format(num_regressions))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    subparsers = parser.add_subparsers(dest='mode', required=True)
+
+    run_parser = subparsers.add_parser('run', help='run the benchmarks')
+    run_parser.set_defaults(func=run)
+    run_parser.add_argument('--commands', type=int, default=200000,
+                            help='number of commands in the generated history')
+    run_parser.add_argument('--vocabulary', type=int, default=20000,
+                            help='number of distinct commands')
+    run_parser.add_argument('--zipf', type=float, default=1.1,
+                            help='zipf exponent of the command and pwd distributions')
+    run_parser.add_argument('--sessions', type=int, default=500, help='number of sessions')
+    run_parser.add_argument('--pwds', type=int, default=200,
+                            help='number of distinct working directories')
+    run_parser.add_argument('--env_vars', type=int, default=10,
+                            help='env vars captured with each command')
+    run_parser.add_argument('--env_snapshots', type=int, default=50,
+                            help='number of distinct sets of env var values')
+    run_parser.add_argument('--days', type=int, default=365,
+                            help='the history spans these many days')
+    run_parser.add_argument('--iterations', type=int, default=50,
+                            help='times each query is run')
+    run_parser.add_argument('--log_commands', type=int, default=500,
+                            help='commands logged via log_command')
+    run_parser.add_argument('--import_commands', type=int, default=50000,
+                            help='commands in the bash history file that is imported')
+    run_parser.add_argument('--import_iterations', type=int, default=5,
+                            help='times the bash history is imported (into a new db)')
+    run_parser.add_argument('--ops', default=None,
+                            help='comma separated metric name prefixes to run, e.g. query,re')
+    run_parser.add_argument('--seed', type=int, default=0, help='seed for the generated history')
+    run_parser.add_argument('--db', default=None,
+                            help=('path for the generated db (to look at it afterwards). Must not '
+                                  'exist: the benchmark writes synthetic commands into it. '
+                                  'Defaults to a new db in /tmp'))
+    run_parser.add_argument('--output', default=None,
+                            help='file to write the json results to. Defaults to stdout')
+
+    compare_parser = subparsers.add_parser(
+        'compare', help='compare two results of run and flag the regressions')
+    compare_parser.set_defaults(func=compare)
+    compare_parser.add_argument('old', help='json results of the baseline run')
+    compare_parser.add_argument('new', help='json results of the new run')
+    compare_parser.add_argument('--threshold', type=float, default=0.25,
+                                help='flag percentiles that are slower by more than this fraction')
+    compare_parser.add_argument('--min_ms', type=float, default=0.5,
+                                help='ignore changes smaller than these many milliseconds')
+
+    args = parser.parse_args()
+    if args.mode == 'run' and args.db and os.path.exists(args.db):
+        parser.error('--db {} already exists. The benchmark would add synthetic commands to '
+                     'it'.format(args.db))
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
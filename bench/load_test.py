@@ -0,0 +1,81 @@
+import argparse
+import os
+import subprocess
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import tabulate
+
+
+# Simulates a shell that runs num_cmds commands. Returns (latencies, lock_failures, failures).
+def run_shell(shell_num, num_cmds, log_recent):
+    latencies, lock_failures, failures = [], 0, 0
+    pid = 100000 + shell_num
+    # The first command of a session is not logged.
+    for seq in range(1, num_cmds + 2):
+        cmd = [log_recent, "-r", "0", "-c", " {} shell{} cmd {}".format(seq, shell_num, seq),
+               "-p", str(pid)]
+        start = time.monotonic()
+        proc = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        latencies.append(time.monotonic() - start)
+        if proc.returncode != 0:
+            failures += 1
+            if b"locked" in proc.stderr:
+                lock_failures += 1
+    return latencies, lock_failures, failures
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Runs log-recent from many simulated shells in parallel against one db")
+    parser.add_argument("--shells", type=int, default=30, help="number of shells")
+    parser.add_argument("--cmds", type=int, default=50, help="commands logged by each shell")
+    parser.add_argument("--db", default=None,
+                        help=("path for the db (to look at it afterwards). Must not exist: the "
+                              "shells log synthetic commands into it. "
+                              "Defaults to a new db in /tmp"))
+    parser.add_argument("--journal_mode", default=None,
+                        help="RECENT_JOURNAL_MODE to use. Defaults to recent's default (wal)")
+    parser.add_argument("--log_recent", default="log-recent", help="log-recent executable")
+    args = parser.parse_args()
+    if args.db and os.path.exists(args.db):
+        parser.error("--db {} already exists. The load test would add synthetic commands to "
+                     "it".format(args.db))
+
+    os.environ["RECENT_DB"] = args.db or "/tmp/recent2_load_{}.db".format(uuid.uuid1())
+    # Measure the direct write path.
+    os.environ["RECENT_DAEMON_SOCKET"] = "/tmp/recent2_load_{}.sock".format(uuid.uuid1())
+    os.environ.pop("RECENT_SPOOL_DIR", None)
+    if args.journal_mode:
+        os.environ["RECENT_JOURNAL_MODE"] = args.journal_mode
+    print("RECENT_DB -> " + os.environ["RECENT_DB"])
+
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=args.shells) as executor:
+        results = list(
+            executor.map(run_shell, range(args.shells), [args.cmds] * args.shells,
+                         [args.log_recent] * args.shells))
+    elapsed = time.monotonic() - start
+
+    latencies = [lat for r in results for lat in r[0]]
+    table_data = [
+        ["shells", args.shells],
+        ["log-recent calls", len(latencies)],
+        ["elapsed secs", "{:.2f}".format(elapsed)],
+        ["p50 latency ms", "{:.1f}".format(percentile(latencies, 50) * 1000)],
+        ["p99 latency ms", "{:.1f}".format(percentile(latencies, 99) * 1000)],
+        ["max latency ms", "{:.1f}".format(max(latencies) * 1000)],
+        ["lock failures", sum(r[1] for r in results)],
+        ["failures", sum(r[2] for r in results)],
+    ]
+    print(tabulate.tabulate(table_data, headers=["Metric", "Value"]))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,16 +1,10 @@
 #!/usr/bin/env python
-import argparse
-import hashlib
-import json
+import functools
 import os
 import re
-import socket
 import sqlite3
 import sys
 import time
-from pathlib import Path
-
-from tabulate import tabulate
 
 
 class Term:
@@ -31,37 +25,58 @@ EXPECTED_PROMPT = 'log-recent -r $? -c "$(HISTTIMEFORMAT= history 1)" -p $$'
 
 
 class DB:
-    SCHEMA_VERSION = 2
+    SCHEMA_VERSION = 13
     CASE_ON = "PRAGMA case_sensitive_like = true"
     GET_COMMANDS_TABLE_SCHEMA = """
         select sql
         from sqlite_master
-        where type = 'table' and name = 'commands'"""
-    # NOTE(dotslash): I haven't found a way to send json using ?s. So doing with string formats.
+        where type in ('table', 'view') and name = 'commands'"""
     INSERT_ROW = """
         insert into commands
-            (command_dt,command,pid,return_val,pwd,session,json_data)
+            (command_ts,command,pid,return_val,pwd,session,env_id)
             values (
-                datetime(?, 'unixepoch'), -- command_dt
+                ?, -- command_ts
                 ?, -- command
                 ?, -- pid
                 ?, -- return_val
                 ?, -- pwd
                 ?, -- session
-                {} -- json_data
+                ? -- env_id
             )"""
+    # Used by log-recent. Inserts the command unless it is the first command of its session or the
+    # shell repeated the last sequence number (e.g - the user pressed enter on an empty line).
+    # Must run before UPSERT_SESSION.
+    INSERT_ROW_IF_NEW_SEQUENCE = """
+        insert into commands
+            (command_ts,command,pid,return_val,pwd,session,env_id)
+            select
+                ?, -- command_ts
+                ?, -- command
+                ?, -- pid
+                ?, -- return_val
+                ?, -- pwd
+                session,
+                ? -- env_id
+            from sessions
+            where session = ? and sequence <> ?"""
     INSERT_ROW_NO_JSON = """
         insert into commands
-            (command_dt,command,pid,return_val,pwd,session,json_data)
+            (command_ts,command,pid,return_val,pwd,session,env_id)
             values (
-                datetime(?, 'unixepoch'), -- command_dt
+                ?, -- command_ts
                 ?, -- command
                 ?, -- pid
                 ?, -- return_val
                 ?, -- pwd
                 ?, -- session
-                null -- json_data
+                null -- env_id
             )"""
+    # Env vars captured by log-recent are stored once per distinct set of values.
+    GET_ENV_SNAPSHOT_ID = "select id from env_snapshots where hash = ?"
+    GET_ENV_SNAPSHOT_ID_BY_JSON = "select id from env_snapshots where json_data = json(?)"
+    INSERT_ENV_SNAPSHOT = "insert into env_snapshots (hash, json_data) values (?, json(?))"
+    INSERT_ENV_SNAPSHOT_VAR = """
+        insert into env_snapshot_vars (snapshot_id, name, value) values (?, ?, ?)"""
     INSERT_SESSION = """
         insert into sessions
             (created_dt, updated_dt, term, hostname, user, sequence, session)
@@ -73,32 +88,69 @@ class DB:
                 ?, -- sequence
                 ?  -- session
             )"""
+    UPSERT_SESSION = """
+        insert into sessions
+            (created_dt, updated_dt, term, hostname, user, sequence, session)
+            values (
+                datetime('now','localtime'), datetime('now','localtime'), -- created_dt, updated_dt
+                ?, -- term
+                ?, -- hostname
+                ?, -- user
+                ?, -- sequence
+                ?  -- session
+            )
+            on conflict (session) do update set
+                updated_dt = excluded.updated_dt, sequence = excluded.sequence"""
+    # Session for the commands imported from a history file by recent-import-history.
+    INSERT_IMPORT_SESSION = """
+        insert or ignore into sessions
+            (created_dt, updated_dt, term, hostname, user, sequence, session)
+            values (
+                datetime('now','localtime'), datetime('now','localtime'), -- created_dt, updated_dt
+                '', -- term
+                ?, -- hostname
+                '', -- user
+                -1, -- sequence
+                ?  -- session
+            )"""
     UPDATE_SESSION = """
         update sessions
         set updated_dt = datetime('now','localtime'), sequence = ?
         where session = ?"""
     # TAIL_N_ROWS's columns (column order is same as TAIL_N_ROWS
     TAIL_N_ROWS_COLUMNS = 'command_dt,command,pid,return_val,pwd,session,json_data'.split(',')
-    TAIL_N_ROWS_DEDUP_COLUMNS = 'command_dt,command'.split(',')
+    TAIL_N_ROWS_DEDUP_COLUMNS = 'command_dt,command,run_count'.split(',')
+    # Commands logged in the same second are ordered by id (i.e - insertion order).
     TAIL_N_ROWS_TEMPLATE = """
-        select command_dt,command,pid,return_val,pwd,session,json_data
+        select c.command_dt,c.command,c.pid,c.return_val,c.pwd,c.session,e.json_data
         from (
             select *
             from commands
             where
-            order by command_dt desc limit ?
-        )
-        order by command_dt"""
+            order by command_ts desc, id desc limit ?
+        ) c left join env_snapshots e on e.id = c.env_id
+        order by c.command_ts, c.id"""
     TAIL_N_ROWS_TEMPLATE_DEDUP = """
-        select *
+        select datetime(command_ts, 'unixepoch') as command_dt, command, run_count
         from (
-            select max(command_dt) as command_dt, command
+            select max(command_ts) as command_ts, max(id) as id, command, count(*) as run_count
             from commands
             where
             group by command
-            order by command_dt desc limit ?
+            order by command_ts desc, id desc limit ?
         )
-        order by command_dt"""
+        order by command_ts, id"""
+    # Same as TAIL_N_ROWS_TEMPLATE_DEDUP, but reads from command_stats. Can only be used when all
+    # the filters are on the command text.
+    TAIL_N_ROWS_TEMPLATE_DEDUP_STATS = """
+        select datetime(last_ts, 'unixepoch') as command_dt, command, run_count
+        from (
+            select last_ts, last_id, command, run_count
+            from command_stats
+            where
+            order by last_ts desc, last_id desc limit ?
+        )
+        order by last_ts, last_id"""
     GET_SESSION_SEQUENCE = """select sequence from sessions where session = ?"""
 
     # Setup: Create tables.
@@ -130,11 +182,478 @@ class DB:
     UPDATE_SCHEMA_VERSION = """pragma user_version = """
     # Migrate from v1 to v2.
     MIGRATE_1_2 = "alter table commands add column json_data json"
+    # Migrate from v2 to v3: Trigram index over commands.command. The index is optional. It is
+    # not created if sqlite is not built with fts5 (or is older than 3.34, which added trigram).
+    CREATE_FTS_TRIGGERS = [
+        """create trigger commands_fts_insert after insert on commands begin
+            insert into commands_fts(rowid, command) values (new.rowid, new.command);
+        end""",
+        """create trigger commands_fts_delete after delete on commands begin
+            insert into commands_fts(commands_fts, rowid, command)
+                values ('delete', old.rowid, old.command);
+        end""",
+        """create trigger commands_fts_update after update of command on commands begin
+            insert into commands_fts(commands_fts, rowid, command)
+                values ('delete', old.rowid, old.command);
+            insert into commands_fts(rowid, command) values (new.rowid, new.command);
+        end""",
+    ]
+    MIGRATE_2_3 = [
+        """create virtual table commands_fts using fts5(
+            command, content='commands', content_rowid='rowid', tokenize='trigram')""",
+        *CREATE_FTS_TRIGGERS,
+        # Backfill the index with the existing commands.
+        "insert into commands_fts(commands_fts) values ('rebuild')",
+    ]
+    # Migrate from v3 to v4: One row per distinct command. Kept up to date by a trigger, so that
+    # every write path (log-recent, recent-daemon, spool, imports) maintains it.
+    MIGRATE_3_4 = [
+        """create table command_stats (
+            command text primary key not null,
+            first_dt timestamp,
+            last_dt timestamp,
+            run_count int,
+            last_return_val int,
+            last_pwd text
+        )""",
+        "create index command_stats_last_dt_ind on command_stats (last_dt)",
+        """create trigger command_stats_insert after insert on commands begin
+            insert into command_stats
+                (command, first_dt, last_dt, run_count, last_return_val, last_pwd)
+                values (new.command, new.command_dt, new.command_dt, 1, new.return_val, new.pwd)
+            on conflict (command) do update set
+                first_dt = min(first_dt, excluded.first_dt),
+                last_dt = max(last_dt, excluded.last_dt),
+                run_count = run_count + 1,
+                -- Imports can insert commands older than the ones we have seen.
+                last_return_val = case when excluded.last_dt >= last_dt
+                    then excluded.last_return_val else last_return_val end,
+                last_pwd = case when excluded.last_dt >= last_dt
+                    then excluded.last_pwd else last_pwd end;
+        end""",
+        # Backfill. min() and max() are computed separately because sqlite picks the bare columns
+        # (return_val, pwd) from the max() row only when there is a single min/max aggregate.
+        """insert into command_stats (command, first_dt)
+            select command, min(command_dt) from commands where true group by command""",
+        """insert into command_stats (command, last_dt, last_return_val, last_pwd, run_count)
+            select command, max(command_dt), return_val, pwd, count(*)
+            from commands where true group by command
+            on conflict (command) do update set
+                last_dt = excluded.last_dt,
+                last_return_val = excluded.last_return_val,
+                last_pwd = excluded.last_pwd,
+                run_count = excluded.run_count""",
+    ]
+    # Migrate from v4 to v5: Indexes for the filters that query_builder emits. Each of them ends
+    # with command_dt so that "order by command_dt desc limit n" can walk the index.
+    MIGRATE_4_5 = [
+        "create index commands_session_dt_ind on commands (session, command_dt)",
+        "create index commands_pwd_dt_ind on commands (pwd, command_dt)",
+        "create index commands_return_val_dt_ind on commands (return_val, command_dt)",
+    ]
+    # Migrate from v5 to v6: Store the time as epoch seconds (command_ts) instead of text.
+    # command_dt is kept as a generated column, so that -sql patterns and the output dont change.
+    # id is an alias for rowid. Making it explicit keeps the rowids (which commands_fts relies on)
+    # stable across VACUUM.
+    MIGRATE_5_6 = [
+        """create table commands_v6 (
+            id integer primary key,
+            command_ts int,
+            command_dt timestamp generated always as (datetime(command_ts, 'unixepoch')) virtual,
+            command text,
+            pid int,
+            return_val int,
+            pwd text,
+            session text,
+            json_data json
+        )""",
+        """insert into commands_v6
+            (id, command_ts, command, pid, return_val, pwd, session, json_data)
+            select rowid, cast(strftime('%s', command_dt) as int), command, pid, return_val, pwd,
+                session, json_data
+            from commands""",
+        # Drops the old indexes and triggers too.
+        "drop table commands",
+        "alter table commands_v6 rename to commands",
+        "create index command_ts_ind on commands (command_ts)",
+        "create index commands_session_ts_ind on commands (session, command_ts)",
+        "create index commands_pwd_ts_ind on commands (pwd, command_ts)",
+        "create index commands_return_val_ts_ind on commands (return_val, command_ts)",
+        "drop table command_stats",
+        """create table command_stats (
+            command text primary key not null,
+            first_ts int,
+            last_ts int,
+            last_id int,
+            run_count int,
+            last_return_val int,
+            last_pwd text
+        )""",
+        "create index command_stats_last_ts_ind on command_stats (last_ts, last_id)",
+        """create trigger command_stats_insert after insert on commands begin
+            insert into command_stats
+                (command, first_ts, last_ts, last_id, run_count, last_return_val, last_pwd)
+                values (new.command, new.command_ts, new.command_ts, new.id, 1, new.return_val,
+                    new.pwd)
+            on conflict (command) do update set
+                first_ts = min(first_ts, excluded.first_ts),
+                run_count = run_count + 1,
+                -- Imports can insert commands older than the ones we have seen.
+                last_ts = max(last_ts, excluded.last_ts),
+                last_id = case when excluded.last_ts >= last_ts
+                    then excluded.last_id else last_id end,
+                last_return_val = case when excluded.last_ts >= last_ts
+                    then excluded.last_return_val else last_return_val end,
+                last_pwd = case when excluded.last_ts >= last_ts
+                    then excluded.last_pwd else last_pwd end;
+        end""",
+        """insert into command_stats
+            (command, first_ts, last_ts, last_id, run_count, last_return_val, last_pwd)
+            select command, first_ts, command_ts, id, run_count, return_val, pwd
+            from (
+                select command, command_ts, id, return_val, pwd,
+                    min(command_ts) over all_runs as first_ts,
+                    count(*) over all_runs as run_count,
+                    row_number() over (
+                        partition by command order by command_ts desc, id desc) as run_num
+                from commands
+                window all_runs as (partition by command)
+            )
+            where run_num = 1""",
+    ]
+    # Migrate from v6 to v7: Move json_data into env_snapshots. Commands refer to a snapshot via
+    # env_id. env_snapshot_vars has one row per env var in a snapshot, so that --env can find the
+    # snapshots via an index instead of running json_extract on every command.
+    # {} is commands or command_runs depending on the layout.
+    MIGRATE_6_7 = [
+        """create table env_snapshots (
+            id integer primary key,
+            hash text not null unique,
+            json_data json
+        )""",
+        """create table env_snapshot_vars (
+            snapshot_id int,
+            name text,
+            value text
+        )""",
+        "create index env_snapshot_vars_ind on env_snapshot_vars (name, value, snapshot_id)",
+        "alter table {} add column env_id int",
+        "create index commands_env_ts_ind on {} (env_id, command_ts)",
+    ]
+    # Backfilled by migrate_6_7 with the distinct json_data values in the commands table.
+    CREATE_ENV_MIGRATION_MAP = """
+        create temp table env_migration_map (json_data text primary key, env_id int)"""
+    UPDATE_ENV_IDS = """
+        update {} set
+            env_id = (select m.env_id from temp.env_migration_map m where m.json_data = json_data),
+            json_data = null
+        where json_data is not null"""
+    # Migrate from v7 to v8: Checkpoints for recent-import-bash-history. offset is where the
+    # import stopped in histfile and tail_md5 is the hash of the bytes just before it, to detect
+    # that the file was rewritten since.
+    MIGRATE_7_8 = """
+        create table history_imports (
+            histfile text primary key,
+            offset int,
+            last_ts int,
+            tail_md5 text
+        )"""
+    # Migrate from v8 to v9: recent_snapshot has the last commands that plain `recent` prints, and
+    # recent_session_snapshot the last commands of each session (for `recent -cs`). They are kept
+    # up to date by triggers, so that these queries do not depend on the size of commands.
+    SNAPSHOT_ROWS = 500
+    SESSION_SNAPSHOT_ROWS = 200
+    # Sessions without commands for this long are dropped from recent_session_snapshot.
+    SESSION_SNAPSHOT_SECS = 30 * 24 * 3600
+    # Only the commands that pass the default filters of recent (See query_builder) are in the
+    # snapshots: no `recent` commands (case sensitive) and the default --char_limit.
+    SNAPSHOT_CHAR_LIMIT = 400
+    SNAPSHOT_FILTER = "substr({0}, 1, 6) <> 'recent' and length({0}) <= 400"
+    SNAPSHOT_COLUMNS = "id, command_ts, command, pid, return_val, pwd, session, env_id"
+    MIGRATE_8_9 = [
+        """create table recent_snapshot (
+            id integer primary key,
+            command_ts int,
+            command text,
+            pid int,
+            return_val int,
+            pwd text,
+            session text,
+            env_id int
+        )""",
+        "create index recent_snapshot_ts_ind on recent_snapshot (command_ts, id)",
+        """create table recent_session_snapshot (
+            id integer primary key,
+            command_ts int,
+            command text,
+            pid int,
+            return_val int,
+            pwd text,
+            session text,
+            env_id int
+        )""",
+        """create index recent_session_snapshot_ind
+            on recent_session_snapshot (session, command_ts, id)""",
+        "create index recent_session_snapshot_ts_ind on recent_session_snapshot (command_ts)",
+        # commands is a view with the same columns in the interned layout.
+        """insert into recent_snapshot
+            select {0} from commands where {1}
+            order by command_ts desc, id desc limit {2}""".format(
+            SNAPSHOT_COLUMNS, SNAPSHOT_FILTER.format('command'), SNAPSHOT_ROWS),
+        """insert into recent_session_snapshot
+            select {0} from (
+                select {0}, row_number() over (
+                    partition by session order by command_ts desc, id desc) as rn
+                from commands
+                where {1} and command_ts >= (select max(command_ts) from commands) - {2}
+            )
+            where rn <= {3}""".format(SNAPSHOT_COLUMNS, SNAPSHOT_FILTER.format('command'),
+                                      SESSION_SNAPSHOT_SECS, SESSION_SNAPSHOT_ROWS),
+    ]
+    # {runs} is commands or command_runs depending on the layout and {command} the command of the
+    # new row. Old rows are evicted every 50 commands (so the snapshots can have up to 50 extra
+    # rows) to keep inserts cheap.
+    CREATE_SNAPSHOT_TRIGGERS = [
+        "drop trigger if exists recent_snapshot_insert",
+        """create trigger recent_snapshot_insert after insert on {runs}
+            when """ + SNAPSHOT_FILTER.format('{command}') + """ begin
+            insert into recent_snapshot values (new.id, new.command_ts, {command}, new.pid,
+                new.return_val, new.pwd, new.session, new.env_id);
+            insert into recent_session_snapshot values (new.id, new.command_ts, {command}, new.pid,
+                new.return_val, new.pwd, new.session, new.env_id);
+            delete from recent_session_snapshot where command_ts < new.command_ts - """ + str(
+            SESSION_SNAPSHOT_SECS) + """;
+            delete from recent_snapshot where new.id % 50 = 0 and id in (
+                select id from recent_snapshot order by command_ts desc, id desc
+                limit -1 offset """ + str(SNAPSHOT_ROWS) + """);
+            delete from recent_session_snapshot where new.id % 50 = 0 and id in (
+                select id from recent_session_snapshot where session = new.session
+                order by command_ts desc, id desc limit -1 offset """ + str(
+            SESSION_SNAPSHOT_ROWS) + """);
+        end""",
+        "drop trigger if exists recent_snapshot_delete",
+        """create trigger recent_snapshot_delete after delete on {runs} begin
+            delete from recent_snapshot where id = old.id;
+            delete from recent_session_snapshot where id = old.id;
+        end""",
+    ]
+    TAIL_N_ROWS_SNAPSHOT_TEMPLATE = """
+        select datetime(c.command_ts, 'unixepoch') as command_dt,c.command,c.pid,c.return_val,
+            c.pwd,c.session,e.json_data
+        from (
+            select * from {table} {where} order by command_ts desc, id desc limit ?
+        ) c left join env_snapshots e on e.id = c.env_id
+        order by c.command_ts, c.id"""
+    # Migrate from v9 to v10: timings of log-recent and recent invocations (See Profile).
+    MIGRATE_9_10 = """
+        create table profile_runs (
+            id integer primary key,
+            ts int,
+            program text,
+            phases json -- {"<phase>": <seconds>, ...}
+        )"""
+    # Only the last these many runs are kept.
+    PROFILE_RUNS = 10000
+    INSERT_PROFILE_RUN = "insert into profile_runs (ts, program, phases) values (?, ?, ?)"
+    TRIM_PROFILE_RUNS = "delete from profile_runs where id <= ? - {}".format(PROFILE_RUNS)
+    GET_PROFILE_RUNS = "select program, phases from profile_runs order by id desc limit ?"
+    # Migrate from v10 to v11: recent queries slower than RECENT_SLOW_QUERY_MS (See SlowQueryLog).
+    MIGRATE_10_11 = """
+        create table slow_queries (
+            id integer primary key,
+            ts int,
+            options text, -- recent options that were set (without their values), e.g. "pattern w"
+            duration_ms real,
+            row_count int,
+            query text,
+            parameters json,
+            plan text
+        )"""
+    # recent-gc archives and deletes the oldest commands first. {runs} is commands or command_runs
+    # depending on the layout.
+    GC_COUNT_OLDER_THAN = "select count(*) from {runs} where command_ts < ?"
+    GC_COUNT_COMMANDS = "select count(*) from {runs}"
+    GC_NTH_OLDEST_TS = "select command_ts from {runs} order by command_ts, id limit 1 offset ?"
+    GC_OLDEST_COMMANDS = """
+        select c.id, c.command_ts, c.command, c.pid, c.return_val, c.pwd, c.session, e.json_data
+        from commands c left join env_snapshots e on e.id = c.env_id
+        order by c.command_ts, c.id limit ?"""
+    GC_DELETE_RUNS = "delete from {runs} where id in (select value from json_each(?))"
+    # The archived runs are the oldest runs of their commands, so the last_* columns of
+    # command_stats stay valid. first_ts is left as is.
+    GC_DELETE_COMMAND_STATS = "delete from command_stats where command = ? and run_count <= ?"
+    GC_UPDATE_COMMAND_STATS = """
+        update command_stats set run_count = run_count - ? where command = ?"""
+    GC_DELETE_COMMAND_TEXT = "delete from command_text where command = ?"
+    # Loads archived commands into the in memory db that recent --archive queries.
+    INSERT_ARCHIVED_ROW = """
+        insert or ignore into commands
+            (id, command_ts, command, pid, return_val, pwd, session, env_id)
+            values (?, ?, ?, ?, ?, ?, ?, ?)"""
+    # RECENT_SHARD_DIR: the commands from before the current month are moved to a db per month
+    # (See rotate_shards). The shard is attached as "shard" while commands are moved to it.
+    ATTACH_SHARD = "attach database ? as shard"
+    DETACH_SHARD = "detach database shard"
+    SHARD_OLDEST_COMMANDS = """
+        select id, command from commands where command_ts < ? order by command_ts, id limit ?"""
+    # The env snapshots keep their ids in the shard.
+    COPY_ENV_SNAPSHOT_VARS_TO_SHARD = """
+        insert into shard.env_snapshot_vars (snapshot_id, name, value)
+            select snapshot_id, name, value from main.env_snapshot_vars
+            where snapshot_id in (
+                select env_id from main.commands where id in (select value from json_each(?)))
+            and snapshot_id not in (select id from shard.env_snapshots)"""
+    COPY_ENV_SNAPSHOTS_TO_SHARD = """
+        insert or ignore into shard.env_snapshots (id, hash, json_data)
+            select id, hash, json_data from main.env_snapshots
+            where id in (
+                select env_id from main.commands where id in (select value from json_each(?)))"""
+    COPY_COMMANDS_TO_SHARD = """
+        insert or ignore into shard.commands
+            (id, command_ts, command, pid, return_val, pwd, session, env_id)
+            select id, command_ts, command, pid, return_val, pwd, session, env_id
+            from main.commands where id in (select value from json_each(?))"""
+    # Migrate from v11 to v12: env snapshots are looked up by their json (See env_snapshot_id).
+    MIGRATE_11_12 = """
+        create index if not exists env_snapshots_json_ind on env_snapshots (json_data)"""
+    # Migrate from v12 to v13: a counter of the inserts and deletes of commands. ResultCache
+    # compares it instead of reading the commands.
+    MIGRATE_12_13 = [
+        "create table commands_generation (generation int)",
+        "insert into commands_generation values (0)",
+    ]
+    INCREMENT_COMMANDS_GENERATION = "update commands_generation set generation = generation + 1"
+    CREATE_GENERATION_TRIGGERS = [
+        "drop trigger if exists commands_generation_insert",
+        """create trigger commands_generation_insert after insert on {runs} begin
+            """ + INCREMENT_COMMANDS_GENERATION + """;
+        end""",
+        "drop trigger if exists commands_generation_delete",
+        """create trigger commands_generation_delete after delete on {runs} begin
+            """ + INCREMENT_COMMANDS_GENERATION + """;
+        end""",
+    ]
+    GET_COMMANDS_GENERATION = "select generation from commands_generation"
+    # Only the last these many slow queries are kept.
+    SLOW_QUERIES = 1000
+    INSERT_SLOW_QUERY = """
+        insert into slow_queries (ts, options, duration_ms, row_count, query, parameters, plan)
+        values (?, ?, ?, ?, ?, ?, ?)"""
+    TRIM_SLOW_QUERIES = "delete from slow_queries where id <= ? - {}".format(SLOW_QUERIES)
+    # One row per set of options. The other columns are from the slowest query of the set.
+    GET_SLOW_QUERIES = """
+        select options, count(*), avg(duration_ms), max(duration_ms), ts, row_count, query,
+            parameters, plan
+        from slow_queries
+        group by options
+        order by max(duration_ms) desc
+        limit ?"""
+    GET_HISTORY_IMPORT = "select offset, last_ts, tail_md5 from history_imports where histfile = ?"
+    UPSERT_HISTORY_IMPORT = """
+        insert into history_imports (histfile, offset, last_ts, tail_md5) values (?, ?, ?, ?)
+        on conflict (histfile) do update set
+            offset = excluded.offset, last_ts = excluded.last_ts, tail_md5 = excluded.tail_md5"""
+    # The commands view (and the triggers to write via it) for the interned layout.
+    CREATE_COMMANDS_VIEW = [
+        """create view commands as
+            select r.id as id, r.command_ts as command_ts,
+                datetime(r.command_ts, 'unixepoch') as command_dt, t.command as command,
+                r.pid as pid, r.return_val as return_val, r.pwd as pwd, r.session as session,
+                r.json_data as json_data, r.command_id as command_id, r.env_id as env_id
+            from command_runs r left join command_text t on t.id = r.command_id""",
+        """create trigger commands_insert instead of insert on commands begin
+            insert or ignore into command_text (command) values (new.command);
+            insert into command_runs
+                (command_ts, command_id, pid, return_val, pwd, session, json_data, env_id)
+                values (new.command_ts, (select id from command_text where command = new.command),
+                    new.pid, new.return_val, new.pwd, new.session, new.json_data, new.env_id);
+        end""",
+        """create trigger commands_delete instead of delete on commands begin
+            delete from command_runs where id = old.id;
+        end""",
+    ]
+    # Opt-in (RECENT_INTERN_COMMANDS) storage layout. Each distinct command is stored once in
+    # command_text and command_runs refers to it. commands becomes a view with the same columns as
+    # the table, so the queries (and -sql patterns) work with both layouts.
+    INTERN_COMMANDS = [
+        """create table command_text (
+            id integer primary key,
+            command text not null unique
+        )""",
+        """insert into command_text (command)
+            select command from commands where command is not null group by command
+            order by min(id)""",
+        """create table command_runs (
+            id integer primary key,
+            command_ts int,
+            command_id int,
+            pid int,
+            return_val int,
+            pwd text,
+            session text,
+            json_data json,
+            env_id int
+        )""",
+        """insert into command_runs
+            (id, command_ts, command_id, pid, return_val, pwd, session, json_data, env_id)
+            select c.id, c.command_ts, t.id, c.pid, c.return_val, c.pwd, c.session, c.json_data,
+                c.env_id
+            from commands c left join command_text t on t.command = c.command""",
+        # Drops the old indexes and triggers too.
+        "drop table commands",
+        *CREATE_COMMANDS_VIEW,
+        "create index command_ts_ind on command_runs (command_ts)",
+        "create index commands_session_ts_ind on command_runs (session, command_ts)",
+        "create index commands_pwd_ts_ind on command_runs (pwd, command_ts)",
+        "create index commands_return_val_ts_ind on command_runs (return_val, command_ts)",
+        "create index commands_env_ts_ind on command_runs (env_id, command_ts)",
+        "drop trigger if exists command_stats_insert",
+        """create trigger command_stats_insert after insert on command_runs begin
+            insert into command_stats
+                (command, first_ts, last_ts, last_id, run_count, last_return_val, last_pwd)
+                values ((select command from command_text where id = new.command_id),
+                    new.command_ts, new.command_ts, new.id, 1, new.return_val, new.pwd)
+            on conflict (command) do update set
+                first_ts = min(first_ts, excluded.first_ts),
+                run_count = run_count + 1,
+                last_ts = max(last_ts, excluded.last_ts),
+                last_id = case when excluded.last_ts >= last_ts
+                    then excluded.last_id else last_id end,
+                last_return_val = case when excluded.last_ts >= last_ts
+                    then excluded.last_return_val else last_return_val end,
+                last_pwd = case when excluded.last_ts >= last_ts
+                    then excluded.last_pwd else last_pwd end;
+        end""",
+    ]
+    # With the interned layout the trigram index is over the distinct commands.
+    INTERN_COMMANDS_FTS = [
+        "drop table if exists commands_fts",
+        """create virtual table command_text_fts using fts5(
+            command, content='command_text', content_rowid='id', tokenize='trigram')""",
+        """create trigger command_text_fts_insert after insert on command_text begin
+            insert into command_text_fts(rowid, command) values (new.id, new.command);
+        end""",
+        """create trigger command_text_fts_delete after delete on command_text begin
+            insert into command_text_fts(command_text_fts, rowid, command)
+                values ('delete', old.id, old.command);
+        end""",
+        "insert into command_text_fts(command_text_fts) values ('rebuild')",
+    ]
+    # The rows that are not older than the one at offset {} from the newest. All of them if there
+    # are not that many.
+    SCAN_NEWEST_ROWS_FILTER = """command_ts >= ifnull(
+        (select command_ts from commands order by command_ts desc, id desc limit 1 offset {}),
+        (select min(command_ts) from commands))"""
+    FTS_FILTER = 'rowid in (select rowid from commands_fts where commands_fts match ?)'
+    FTS_FILTER_INTERNED = (
+        'command_id in (select rowid from command_text_fts where command_text_fts match ?)')
+    HAS_TABLE = "select 1 from sqlite_master where type = 'table' and name = ?"
 
 
 class Session:
     @classmethod
     def session_id_string(cls, pid=None):
+        import hashlib
         # TODO(sai): Should this always be ppid?
         pid = pid or os.getppid()
         # This combination of ENV vars *should* provide a unique session
@@ -154,16 +673,28 @@ class Session:
         )  # yapf: disable
         return hashlib.md5(seed.encode('utf-8')).hexdigest()
 
-    def __init__(self, pid, sequence):
+    # Same as session_id_string, but uses the id that recent-session-init computed for the shell
+    # if there is one.
+    @classmethod
+    def id_for_pid(cls, pid=None):
+        pid = pid or os.getppid()
+        init_pid, _, session_id = os.getenv('RECENT_SESSION', '').partition(':')
+        if session_id and init_pid == str(pid):
+            return session_id
+        return cls.session_id_string(pid)
+
+    def __init__(self, pid, sequence, session_id=None):
         self.sequence = sequence
         self.empty = False
-        self.id = Session.session_id_string(pid)
+        # session_id is passed in when the session was computed in a different process.
+        # E.g - by the shell that sent a command to recent-daemon.
+        self.id = session_id or Session.session_id_string(pid)
 
-    def update(self, conn):
+    def update(self, conn, term=None):
         c = conn.cursor()
         try:
-            term = os.getenv('TERM', '')
-            hostname = socket.gethostname()
+            term = os.getenv('TERM', '') if term is None else term
+            hostname = os.uname().nodename
             user = os.getenv('USER', '')
             c.execute(DB.INSERT_SESSION, [term, hostname, user, self.sequence, self.id])
             self.empty = True
@@ -176,27 +707,269 @@ class Session:
         c.close()
 
 
+# Returns the value of the env var name. None if it is not set, or set to '', 0, false, no or off.
+def env_flag(name):
+    value = os.getenv(name)
+    if value is None or value.strip().lower() in ('', '0', 'false', 'no', 'off'):
+        return None
+    return value
+
+
+# Seconds since this process was started. None if it is not known (needs /proc).
+def process_age_secs():
+    try:
+        with open('/proc/self/stat') as f:
+            # The 2nd field (the command name) can have spaces. starttime is the 22nd field.
+            start_ticks = int(f.read().rsplit(')', 1)[1].split()[19])
+        return time.clock_gettime(time.CLOCK_BOOTTIME) - start_ticks / os.sysconf('SC_CLK_TCK')
+    except (OSError, ValueError, IndexError, AttributeError):
+        return None
+
+
+# Nearest rank percentile (p in 0-100) of a non empty list.
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+class Profile:
+    """Time spent in each phase of a log-recent or recent invocation.
+
+    Enabled by RECENT_PROFILE (or recent --profile). RECENT_PROFILE=stderr prints the timings to
+    stderr. Any other value appends them to the profile_runs table, which recent --perf-report
+    summarizes. 0, false and '' leave it off (See env_flag). Phases nest. The time of a phase does
+    not include the phases inside it.
+    """
+    class Phase:
+        def __init__(self, profile, name):
+            self.profile = profile
+            self.name = name
+
+        def __enter__(self):
+            self.start = time.monotonic()
+            self.inner_secs = 0.0
+            self.profile.stack.append(self)
+
+        def __exit__(self, *exc_info):
+            secs = time.monotonic() - self.start
+            self.profile.stack.pop()
+            if self.profile.stack:
+                self.profile.stack[-1].inner_secs += secs
+            phases = self.profile.phases
+            phases[self.name] = phases.get(self.name, 0.0) + secs - self.inner_secs
+
+    class NoPhase:
+        def __enter__(self):
+            pass
+
+        def __exit__(self, *exc_info):
+            pass
+
+    NO_PHASE = NoPhase()
+
+    def __init__(self):
+        self.program = None
+        self.destination = None
+        self.phases = {}
+        self.stack = []
+
+    @property
+    def enabled(self):
+        return self.destination is not None
+
+    def enable(self, program, to_stderr=False):
+        destination = 'stderr' if to_stderr else env_flag('RECENT_PROFILE')
+        if not destination:
+            return
+        if not self.enabled:
+            self.program = program
+            self.start = time.monotonic()
+            # Interpreter start and imports.
+            startup_secs = process_age_secs()
+            if startup_secs is not None:
+                self.phases['startup'] = startup_secs
+        self.destination = destination
+
+    def phase(self, name):
+        return Profile.Phase(self, name) if self.enabled else Profile.NO_PHASE
+
+    # Iterates over iterable. The time spent producing the items goes to phase `name`.
+    def timed_iter(self, name, iterable):
+        if not self.enabled:
+            yield from iterable
+            return
+        iterator, done = iter(iterable), object()
+        while True:
+            with self.phase(name):
+                item = next(iterator, done)
+            if item is done:
+                return
+            yield item
+
+    # Records the timings of this invocation and disables the profile.
+    def finish(self):
+        if not self.enabled:
+            return
+        import json
+        self.phases['total'] = self.phases.get('startup', 0.0) + time.monotonic() - self.start
+        program, phases, destination = self.program, self.phases, self.destination
+        self.__init__()
+        if destination == 'stderr':
+            print('{} profile: {}'.format(
+                program, ' '.join('{}={:.1f}ms'.format(name, 1000 * secs)
+                                  for name, secs in phases.items())),
+                  file=sys.stderr)
+            return
+        conn = create_connection()
+
+        def write():
+            c = conn.execute(DB.INSERT_PROFILE_RUN, [int(time.time()), program, json.dumps(phases)])
+            conn.execute(DB.TRIM_PROFILE_RUNS, [c.lastrowid])
+
+        write_with_retry(conn, write)
+        conn.close()
+
+
+PROFILE = Profile()
+
+
 def migrate(cur_version, conn):
-    if cur_version not in (0, 1):
+    if cur_version not in range(0, DB.SCHEMA_VERSION):
         exit(Term.FAIL + ('recent: your command history database does not '
                           'match recent, please update') + Term.ENDC)
 
     c = conn.cursor()
-    if cur_version == 1:
-        # Schema version is v1. Migrate to v2.
-        print(Term.WARNING + 'recent: migrating schema to version {}'.format(DB.SCHEMA_VERSION) +
-              Term.ENDC)
-        c.execute(DB.MIGRATE_1_2)
-    else:
+    if cur_version == 0:
         print(Term.WARNING + 'recent: building schema' + Term.ENDC)
+        # Build the v2 schema and let the migrations below take it to the latest version.
         c.execute(DB.CREATE_COMMANDS_TABLE)
         c.execute(DB.CREATE_SESSIONS_TABLE)
         c.execute(DB.CREATE_DATE_INDEX)
+        cur_version = 2
+    else:
+        print(Term.WARNING + 'recent: migrating schema to version {}'.format(DB.SCHEMA_VERSION) +
+              Term.ENDC)
+    if cur_version == 1:
+        c.execute(DB.MIGRATE_1_2)
+        cur_version = 2
+    if cur_version == 2:
+        migrate_2_3(conn)
+        cur_version = 3
+    if cur_version == 3:
+        for stmt in DB.MIGRATE_3_4:
+            c.execute(stmt)
+        cur_version = 4
+    if cur_version == 4:
+        for stmt in DB.MIGRATE_4_5:
+            c.execute(stmt)
+        cur_version = 5
+    if cur_version == 5:
+        fts = has_table(conn, 'commands_fts')
+        for stmt in DB.MIGRATE_5_6:
+            c.execute(stmt)
+        if fts:
+            for stmt in DB.CREATE_FTS_TRIGGERS:
+                c.execute(stmt)
+        cur_version = 6
+    if cur_version == 6:
+        migrate_6_7(conn)
+        cur_version = 7
+    if cur_version == 7:
+        c.execute(DB.MIGRATE_7_8)
+        cur_version = 8
+    if cur_version == 8:
+        for stmt in DB.MIGRATE_8_9:
+            c.execute(stmt)
+        create_snapshot_triggers(conn)
+        cur_version = 9
+    if cur_version == 9:
+        c.execute(DB.MIGRATE_9_10)
+        cur_version = 10
+    if cur_version == 10:
+        c.execute(DB.MIGRATE_10_11)
+        cur_version = 11
+    if cur_version == 11:
+        c.execute(DB.MIGRATE_11_12)
+        cur_version = 12
+    if cur_version == 12:
+        for stmt in DB.MIGRATE_12_13:
+            c.execute(stmt)
+        create_generation_triggers(conn)
+        cur_version = 13
 
     c.execute(DB.UPDATE_SCHEMA_VERSION + str(DB.SCHEMA_VERSION))
     conn.commit()
 
 
+def migrate_2_3(conn):
+    c = conn.cursor()
+    c.execute('savepoint migrate_2_3')
+    try:
+        for stmt in DB.MIGRATE_2_3:
+            c.execute(stmt)
+        c.execute('release migrate_2_3')
+    except sqlite3.OperationalError:
+        # No fts5/trigram in this sqlite build. Queries will fall back to scanning the table.
+        c.execute('rollback to migrate_2_3')
+        c.execute('release migrate_2_3')
+
+
+def migrate_6_7(conn):
+    import json
+    c = conn.cursor()
+    interned = is_interned(conn)
+    table = 'command_runs' if interned else 'commands'
+    for stmt in DB.MIGRATE_6_7:
+        c.execute(stmt.format(table))
+    # Indexes from RECENT_ENV_VARS (schema v5, v6). env_snapshot_vars replaces them.
+    env_indexes = c.execute("""select name from sqlite_master
+                               where type = 'index' and name like 'commands_env_%_ind'
+                                   and name <> 'commands_env_ts_ind'""").fetchall()
+    for (name, ) in env_indexes:
+        c.execute('drop index ' + name)
+    c.execute(DB.CREATE_ENV_MIGRATION_MAP)
+    distinct_json = c.execute(
+        'select distinct json_data from {} where json_data is not null'.format(table)).fetchall()
+    for (json_data, ) in distinct_json:
+        try:
+            env = json.loads(json_data).get('env', {})
+        except (ValueError, AttributeError):
+            continue
+        c.execute('insert into temp.env_migration_map values (?, ?)',
+                  [json_data, env_snapshot_id(conn, env)])
+    c.execute(DB.UPDATE_ENV_IDS.format(table))
+    c.execute('drop table temp.env_migration_map')
+    if interned:
+        # The view has a new column.
+        c.execute('drop view commands')
+        for stmt in DB.CREATE_COMMANDS_VIEW:
+            c.execute(stmt)
+
+
+# Returns the id of the env snapshot with the given env vars. Creates the snapshot if needed.
+def env_snapshot_id(conn, env):
+    import json
+    json_data = json.dumps({'env': env}, sort_keys=True)
+    c = conn.cursor()
+    # Almost every command reuses an existing snapshot. Only hash the new ones.
+    row = c.execute(DB.GET_ENV_SNAPSHOT_ID_BY_JSON, [json_data]).fetchone()
+    if row:
+        return row[0]
+    import hashlib
+    snapshot_hash = hashlib.md5(json_data.encode('utf-8')).hexdigest()
+    row = c.execute(DB.GET_ENV_SNAPSHOT_ID, [snapshot_hash]).fetchone()
+    if row:
+        return row[0]
+    c.execute(DB.INSERT_ENV_SNAPSHOT, [snapshot_hash, json_data])
+    snapshot_id = c.lastrowid
+    c.executemany(DB.INSERT_ENV_SNAPSHOT_VAR, [(snapshot_id, k, v) for k, v in env.items()])
+    return snapshot_id
+
+
+def has_table(conn, name):
+    return conn.execute(DB.HAS_TABLE, [name]).fetchone() is not None
+
+
 # Parses history command.
 # This parse the output of `HISTTIMEFORMAT= history 1`
 # Format: optional_whitespace + required_sequence_number + required_whitespace + command
@@ -215,46 +988,251 @@ def parse_history(history):
         return None, None
 
 
-def parse_date(date_format):
-    if re.match(r'^\d{4}$', date_format):
-        return 'strftime(\'%Y\', command_dt) = ?'
-    if re.match(r'^\d{4}-\d{2}$', date_format):
-        return 'strftime(\'%Y-%m\', command_dt) = ?'
-    if re.match(r'^\d{4}-\d{2}-\d{2}$', date_format):
-        return 'date(command_dt) = ?'
-    else:
-        print("Invalid date passed to -d")
-        sys.exit(1)
+# Returns the [start, end) range of epoch seconds covered by date_str. The dates are in UTC, same
+# as command_dt. E.g - 2020-07 => [2020-07-01 00:00:00, 2020-08-01 00:00:00).
+# Returns None if date_str is not a valid date.
+def parse_date(date_str):
+    from datetime import datetime, timedelta, timezone
+
+    def next_month(dt):
+        return dt.replace(year=dt.year + 1, month=1) if dt.month == 12 else dt.replace(
+            month=dt.month + 1)
+
+    formats = [
+        ('%Y', lambda dt: dt.replace(year=dt.year + 1)),
+        ('%Y-%m', next_month),
+        ('%Y-%m-%d', lambda dt: dt + timedelta(days=1)),
+        ('%Y-%m-%d %H:%M', lambda dt: dt + timedelta(minutes=1)),
+        ('%Y-%m-%d %H:%M:%S', lambda dt: dt + timedelta(seconds=1)),
+    ]
+    for fmt, period_end in formats:
+        try:
+            start = datetime.strptime(date_str, fmt).replace(tzinfo=timezone.utc)
+        except ValueError:
+            continue
+        return int(start.timestamp()), int(period_end(start).timestamp())
+    return None
+
+
+DURATION_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 7 * 86400}
 
 
-def create_connection():
-    recent_db = os.getenv('RECENT_DB', os.environ['HOME'] + '/.recent.db')
-    conn = sqlite3.connect(recent_db, uri=recent_db.startswith("file:"))
-    build_schema(conn)
+# Parses the value of --since/--until. Accepts the dates that parse_date accepts and durations
+# like 2h, 3d (meaning that long ago). Returns the [start, end) epoch range.
+def parse_time_bound(value, option, failure_exit_func):
+    duration = re.match(r'^(\d+)([smhdw])$', value)
+    if duration:
+        ts = int(time.time()) - int(duration.group(1)) * DURATION_UNITS[duration.group(2)]
+        return ts, ts
+    date_range = parse_date(value)
+    if date_range is None:
+        print(Term.FAIL + 'Invalid value passed to {}: {}'.format(option, value) + Term.ENDC)
+        failure_exit_func(1)
+    return date_range
+
+
+# How long a connection waits for another process to release its lock before giving up.
+BUSY_TIMEOUT_SECS = 2
+# Writes that still fail with "database is locked" are retried with exponential backoff.
+WRITE_ATTEMPTS = 5
+WRITE_BACKOFF_SECS = 0.02
+
+
+# With RECENT_HOST_DB_DIR set (e.g. to a directory in an NFS home), every host writes to a db of
+# its own in it, so that no two hosts write to the same file. recent reads all of them.
+def recent_db_path():
+    host_db_dir = os.getenv('RECENT_HOST_DB_DIR')
+    if host_db_dir:
+        return os.path.join(host_db_dir, os.uname().nodename + '.db')
+    return os.getenv('RECENT_DB', os.environ['HOME'] + '/.recent.db')
+
+
+# The schema uses generated columns (sqlite 3.31), window functions (3.25) and upserts (3.24).
+MIN_SQLITE_VERSION = (3, 31, 0)
+
+
+def check_sqlite_version():
+    if sqlite3.sqlite_version_info < MIN_SQLITE_VERSION:
+        exit(Term.FAIL + ('recent needs sqlite >= {}, but python is using sqlite {}. Use a python '
+                          'built with a newer sqlite.').format(
+                              '.'.join(map(str, MIN_SQLITE_VERSION)), sqlite3.sqlite_version) +
+             Term.ENDC)
+
+
+# Queries pass read_only=True. If the db is already at DB.SCHEMA_VERSION, it is then opened
+# read-only and the journal mode and schema setup is skipped.
+def create_connection(read_only=False, path=None):
+    check_sqlite_version()
+    recent_db = path or recent_db_path()
+    if read_only:
+        conn = connect_read_only(recent_db)
+        if conn:
+            return conn
+    with PROFILE.phase('connect'):
+        if os.getenv('RECENT_HOST_DB_DIR'):
+            os.makedirs(os.getenv('RECENT_HOST_DB_DIR'), mode=0o700, exist_ok=True)
+        conn = sqlite3.connect(recent_db,
+                               uri=recent_db.startswith("file:"),
+                               timeout=BUSY_TIMEOUT_SECS)
+        # Lets recent-gc give the space of the archived commands back to the file system. It only
+        # takes effect for new dbs, and has to be set before the journal mode.
+        conn.execute('pragma auto_vacuum = incremental')
+        set_journal_mode(conn)
+    with PROFILE.phase('build_schema'):
+        build_schema(conn)
     return conn
 
 
-def build_schema(conn):
+# Returns a read-only connection to recent_db. None if the db does not exist yet or needs a
+# migration. user_version (in the db header) is the only thing that is read to check the latter.
+# any_layout accepts the db even if it is not interned while RECENT_INTERN_COMMANDS is set.
+def connect_read_only(recent_db, any_layout=False):
+    if recent_db.startswith('file:') or not os.path.exists(recent_db):
+        return None
+    path = os.path.abspath(recent_db).replace('%', '%25').replace('?', '%3f').replace('#', '%23')
+    with PROFILE.phase('connect'):
+        try:
+            conn = sqlite3.connect('file:{}?mode=ro'.format(path),
+                                   uri=True,
+                                   timeout=BUSY_TIMEOUT_SECS)
+        except sqlite3.Error:
+            return None
+        current = schema_version(conn) == DB.SCHEMA_VERSION and (
+            any_layout or not env_flag('RECENT_INTERN_COMMANDS') or is_interned(conn))
+    if not current:
+        conn.close()
+        return None
+    return conn
+
+
+# WAL lets recent read while log-recent writes, and makes commits cheaper. Set RECENT_JOURNAL_MODE
+# (e.g. to delete) if the db is on a file system that does not support WAL.
+def set_journal_mode(conn):
+    # WAL needs shared memory, which hosts reading each other's dbs over NFS do not share.
+    default = 'delete' if os.getenv('RECENT_HOST_DB_DIR') else 'wal'
+    journal_mode = os.getenv('RECENT_JOURNAL_MODE', default).lower()
     try:
-        c = conn.cursor()
-        current = c.execute(DB.GET_SCHEMA_VERSION).fetchone()[0]
+        current = conn.execute('pragma journal_mode').fetchone()[0]
+        if current not in (journal_mode, 'memory'):
+            current = conn.execute('pragma journal_mode = ' + journal_mode).fetchone()[0]
+    except sqlite3.OperationalError:
+        # Another connection is using the db. Changing the journal mode will be retried the next
+        # time the db is opened.
+        return
+    if current == 'wal':
+        # Commits in WAL mode stay durable across application crashes with synchronous=normal.
+        conn.execute('pragma synchronous = normal')
+
+
+# Runs write(), which should only touch the db via conn, in a single write transaction.
+# Retries if the db stays locked longer than the busy timeout.
+def write_with_retry(conn, write):
+    import random
+    for attempt in range(WRITE_ATTEMPTS):
+        try:
+            # Take the write lock upfront. A deferred transaction that reads first and then
+            # writes fails right away (without waiting for the busy timeout) if another
+            # connection wrote in between.
+            conn.execute('begin immediate')
+            write()
+            with PROFILE.phase('commit'):
+                conn.commit()
+            return
+        except sqlite3.OperationalError as e:
+            conn.rollback()
+            if 'locked' not in str(e) or attempt == WRITE_ATTEMPTS - 1:
+                raise
+        except BaseException:
+            conn.rollback()
+            raise
+        time.sleep(WRITE_BACKOFF_SECS * 2**attempt * random.uniform(0.5, 1.5))
+
+
+def build_schema(conn):
+    if schema_version(conn) != DB.SCHEMA_VERSION:
+        # Many shells can open a new (or old) db at the same time. Only one of them migrates it.
+        conn.execute('begin immediate')
+        current = schema_version(conn)
         if current != DB.SCHEMA_VERSION:
             migrate(current, conn)
+        conn.commit()
+    if env_flag('RECENT_INTERN_COMMANDS') and not is_interned(conn):
+        conn.execute('begin immediate')
+        if not is_interned(conn):
+            intern_commands(conn)
+        conn.commit()
+
+
+def schema_version(conn):
+    try:
+        return conn.execute(DB.GET_SCHEMA_VERSION).fetchone()[0]
     except (sqlite3.OperationalError, TypeError):
-        migrate(0, conn)
+        return 0
+
+
+# Returns true if the db uses the interned command layout (See DB.INTERN_COMMANDS).
+def is_interned(conn):
+    return has_table(conn, 'command_text')
+
+
+def intern_commands(conn):
+    print(Term.WARNING + 'recent: moving the commands to command_text' + Term.ENDC)
+    fts = has_table(conn, 'commands_fts')
+    c = conn.cursor()
+    c.execute('savepoint intern_commands')
+    for stmt in DB.INTERN_COMMANDS:
+        c.execute(stmt)
+    if fts:
+        for stmt in DB.INTERN_COMMANDS_FTS:
+            c.execute(stmt)
+    # The triggers were dropped with the commands table.
+    create_snapshot_triggers(conn)
+    create_generation_triggers(conn)
+    c.execute(DB.INCREMENT_COMMANDS_GENERATION)
+    c.execute('release intern_commands')
+    conn.commit()
+
+
+def create_snapshot_triggers(conn):
+    if is_interned(conn):
+        runs = 'command_runs'
+        command = '(select command from command_text where id = new.command_id)'
+    else:
+        runs, command = 'commands', 'new.command'
+    for stmt in DB.CREATE_SNAPSHOT_TRIGGERS:
+        conn.execute(stmt.format(runs=runs, command=command))
+
+
+def create_generation_triggers(conn):
+    runs = 'command_runs' if is_interned(conn) else 'commands'
+    for stmt in DB.CREATE_GENERATION_TRIGGERS:
+        conn.execute(stmt.format(runs=runs))
+
+
+# Returns the filter to use for looking up the trigram index. None if there is no index.
+def fts_filter(conn):
+    if has_table(conn, 'command_text_fts'):
+        return DB.FTS_FILTER_INTERNED
+    if has_table(conn, 'commands_fts'):
+        return DB.FTS_FILTER
+    return None
 
 
 def envvars_to_log():
+    import fnmatch
     envvar_whitelist = {k.strip() for k in os.getenv('RECENT_ENV_VARS', '').split(',') if k.strip()}
 
     def is_var_interesting(name: str):
+        # RECENT_SESSION differs in every shell. Logging it would create a snapshot per session.
+        if name == "RECENT_SESSION":
+            return False
         # Anything starting with RECENT_ is welcome.
         if name.startswith("RECENT_"):
             return True
         for interesting_var in envvar_whitelist:
             # if name matches glob(interesting_var) then we will store it.
             # E.g - CONDA_* => we are interested in all env vars that start with CONDA_.
-            if Path(name).match(interesting_var):
+            if fnmatch.fnmatchcase(name, interesting_var):
                 return True
         return False
 
@@ -263,6 +1241,50 @@ def envvars_to_log():
 
 # Entry point to recent-log command.
 def log(args_for_test=None):
+    PROFILE.enable('log-recent')
+    with PROFILE.phase('parse_args'):
+        args = parse_log_args(sys.argv[1:] if args_for_test is None else args_for_test)
+
+    sequence, command = parse_history(args['command'])
+    pid, return_value = args['pid'], args['return_value']
+    pwd = os.getenv('PWD', '')
+
+    if not sequence or not command:
+        print(Term.WARNING + ('recent: cannot parse command output, please check your bash '
+                              'trigger looks like this:') + Term.ENDC)
+        exit("""export PROMPT_COMMAND='{}'""".format(EXPECTED_PROMPT))
+    log_command(command=command, pid=pid, sequence=sequence, return_value=return_value, pwd=pwd)
+    PROFILE.finish()
+
+
+# log-recent runs on every prompt, always with the arguments in EXPECTED_PROMPT. Parse those by
+# hand and leave the rest (e.g. --help) to argparse, which takes longer to import than the rest of
+# log-recent takes to run.
+LOG_ARG_NAMES = {
+    '-r': 'return_value',
+    '--return_value': 'return_value',
+    '-c': 'command',
+    '--command': 'command',
+    '-p': 'pid',
+    '--pid': 'pid',
+}
+
+
+def parse_log_args(argv):
+    args = {'return_value': 0, 'command': '', 'pid': 0}
+    try:
+        if len(argv) % 2 != 0:
+            raise ValueError
+        for i in range(0, len(argv), 2):
+            name = LOG_ARG_NAMES[argv[i]]
+            args[name] = argv[i + 1] if name == 'command' else int(argv[i + 1])
+        return args
+    except (KeyError, ValueError):
+        return vars(make_arg_parser_for_log().parse_args(argv))
+
+
+def make_arg_parser_for_log():
+    import argparse
     parser = argparse.ArgumentParser()
     parser.add_argument('-r',
                         '--return_value',
@@ -271,61 +1293,405 @@ def log(args_for_test=None):
                         type=int)
     parser.add_argument('-c', '--command', help='Set to $(HISTTIMEFORMAT= history 1)', default='')
     parser.add_argument('-p', '--pid', help='Shell pid. Set to $$', default=0, type=int)
+    return parser
+
+
+def log_command(command, pid, sequence, return_value, pwd):
+    with PROFILE.phase('envvars_to_log'):
+        env = envvars_to_log()
+    record = {
+        'command': command,
+        'pid': pid,
+        'sequence': sequence,
+        'return_value': return_value,
+        'pwd': pwd,
+        'session': Session.id_for_pid(pid),
+        'term': os.getenv('TERM', ''),
+        'env': env,
+        # We pass current time instead of using 'now' in sql to mock this value.
+        'ts': int(time.time()),
+    }
+    with PROFILE.phase('send_to_daemon'):
+        sent = send_to_daemon(record)
+    if sent:
+        # recent-daemon owns the write now.
+        return
+    with PROFILE.phase('append_to_spool'):
+        spooled = append_to_spool(record)
+    if spooled:
+        # The record will be written to the db the next time recent runs.
+        return
+    conn = create_connection()
+    try:
+        # The session update and the insert happen in one transaction.
+        write_with_retry(conn, lambda: write_command(conn, record))
+        with PROFILE.phase('rotate_shards'):
+            try_rotate_shards(conn)
+    finally:
+        conn.close()
+
+
+# Writes a record built by log_command into the db. The caller owns the transaction.
+# Used both by the direct path in log_command and by recent-daemon.
+# The command is not written if it is the first command of its session or if its sequence is the
+# same as the previous command's (See Session.update).
+def write_command(conn, record):
+    session_id = record.get('session') or Session.id_for_pid(record['pid'])
+    c = conn.cursor()
+    with PROFILE.phase('insert'):
+        env_id = env_snapshot_id(conn, record.get('env', {}))
+        c.execute(DB.INSERT_ROW_IF_NEW_SEQUENCE, [
+            record['ts'], record['command'], record['pid'], record['return_value'], record['pwd'],
+            env_id, session_id, record['sequence']])  # yapf: disable
+    with PROFILE.phase('session_update'):
+        term = record.get('term')
+        c.execute(DB.UPSERT_SESSION, [
+            os.getenv('TERM', '') if term is None else term, os.uname().nodename,
+            os.getenv('USER', ''), record['sequence'], session_id])  # yapf: disable
+    c.close()
+
+
+def daemon_socket_path():
+    runtime_dir = os.getenv('XDG_RUNTIME_DIR') or '/tmp'
+    default_path = os.path.join(runtime_dir, 'recent2-{}.sock'.format(os.getuid()))
+    return os.getenv('RECENT_DAEMON_SOCKET', default_path)
+
+
+# Hands the record to recent-daemon. Returns False if the daemon is not running, in which case
+# the caller should write to the db directly.
+def send_to_daemon(record):
+    path = daemon_socket_path()
+    if not os.path.exists(path):
+        return False
+    import json
+    import socket
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+            s.settimeout(0.5)
+            s.connect(path)
+            s.sendall((json.dumps(record) + '\n').encode('utf-8'))
+        return True
+    except OSError:
+        return False
+
+
+def daemon_is_running(path):
+    import socket
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+            s.settimeout(0.5)
+            s.connect(path)
+        return True
+    except OSError:
+        return False
+
+
+# Long lived process that owns a single connection to RECENT_DB. Clients write one json
+# record per line (see log_command for the format) to a unix socket. Records are queued and
+# written by a single writer thread which commits them in batches.
+class LogDaemon:
+    # Types of the keys of the records built by log_command.
+    REQUIRED_KEYS = {'command': str, 'pid': int, 'sequence': int, 'return_value': int,
+                     'pwd': str, 'ts': int}
+    OPTIONAL_KEYS = {'session': str, 'term': str, 'env': dict}
+
+    def __init__(self, socket_path, batch_size=100, batch_window_secs=0.05):
+        import queue
+        import threading
+        self.socket_path = socket_path
+        self.batch_size = batch_size
+        self.batch_window_secs = batch_window_secs
+        self.queue = queue.Queue()
+        self.server = self._make_server()
+        self.writer = threading.Thread(target=self._write_loop, name='recent-daemon-writer')
+
+    def _make_server(self):
+        import socketserver
+        daemon = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                for line in self.rfile:
+                    daemon.enqueue(line)
+
+        if os.path.exists(self.socket_path):
+            # Stale socket from a previous run. A live daemon would have accepted the connection.
+            if daemon_is_running(self.socket_path):
+                sys.exit(Term.FAIL + 'recent-daemon: already running at ' + self.socket_path +
+                         Term.ENDC)
+            os.unlink(self.socket_path)
+        old_umask = os.umask(0o077)
+        try:
+            server = socketserver.ThreadingUnixStreamServer(self.socket_path, Handler)
+        finally:
+            os.umask(old_umask)
+        server.daemon_threads = True
+        return server
+
+    def enqueue(self, line):
+        import json
+        try:
+            record = json.loads(line)
+            LogDaemon.check_record(record)
+        except ValueError as e:
+            print('recent-daemon: dropping bad record: {}'.format(e), file=sys.stderr)
+            return
+        self.queue.put(record)
+
+    # Raises ValueError if write_command can not write the record.
+    @staticmethod
+    def check_record(record):
+        if not isinstance(record, dict):
+            raise ValueError('not an object')
+        missing = [k for k in LogDaemon.REQUIRED_KEYS if k not in record]
+        if missing:
+            raise ValueError('missing keys {}'.format(missing))
+        for key, value in record.items():
+            expected = LogDaemon.REQUIRED_KEYS.get(key) or LogDaemon.OPTIONAL_KEYS.get(key)
+            if expected is None or (value is None and key in LogDaemon.OPTIONAL_KEYS):
+                continue
+            if not isinstance(value, expected):
+                raise ValueError('{} is not a {}'.format(key, expected.__name__))
+        env = record.get('env') or {}
+        if not all(isinstance(v, str) for v in env.values()):
+            raise ValueError('env values are not strings')
+
+    def _next_batch(self):
+        import queue
+        batch = [self.queue.get()]
+        deadline = time.monotonic() + self.batch_window_secs
+        while batch[-1] is not None and len(batch) < self.batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def _write_loop(self):
+        conn = create_connection()
+        stop = False
+        while not stop:
+            batch = self._next_batch()
+            records = [r for r in batch if r is not None]
+            stop = len(records) != len(batch)
+
+            def write_batch():
+                c = conn.cursor()
+                for record in records:
+                    # A record that can not be written must not take the rest of the batch (or
+                    # this thread) down with it.
+                    c.execute('savepoint daemon_record')
+                    try:
+                        write_command(conn, record)
+                    except sqlite3.OperationalError:
+                        # E.g - database is locked. write_with_retry retries the batch.
+                        raise
+                    except Exception as e:
+                        c.execute('rollback to daemon_record')
+                        print('recent-daemon: dropping record: {!r}'.format(e), file=sys.stderr)
+                    c.execute('release daemon_record')
+
+            try:
+                # Group commit: one transaction for the whole batch.
+                write_with_retry(conn, write_batch)
+            except sqlite3.Error as e:
+                print('recent-daemon: failed to write {} records: {}'.format(len(records), e),
+                      file=sys.stderr)
+            try_rotate_shards(conn)
+            for _ in batch:
+                self.queue.task_done()
+        conn.close()
+
+    # Blocks till every queued record is written to the db.
+    def flush(self):
+        self.queue.join()
+
+    def serve_forever(self):
+        self.writer.start()
+        try:
+            self.server.serve_forever()
+        finally:
+            self.close()
+
+    def shutdown(self):
+        self.server.shutdown()
+
+    def close(self):
+        self.server.server_close()
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        if self.writer.is_alive():
+            self.queue.put(None)
+            self.writer.join()
+
+
+# Entry point to recent-session-init command. Meant to be run once per shell from ~/.bashrc as
+#   eval "$(recent-session-init -p $$)"
+# log-recent and recent -cs then read the session id from RECENT_SESSION instead of computing it.
+def session_init_entry_point(args_for_test=None):
+    import argparse
+    description = ('recent-session-init prints a RECENT_SESSION export for the shell with the '
+                   'given pid, so that log-recent does not compute the session id on every prompt.')
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('-p', '--pid', help='Shell pid. Set to $$', default=os.getppid(), type=int)
     args = parser.parse_args(args_for_test)
+    print('export RECENT_SESSION={}:{}'.format(args.pid, Session.session_id_string(args.pid)))
 
-    sequence, command = parse_history(args.command)
-    pid, return_value = args.pid, args.return_value
-    pwd = os.getenv('PWD', '')
 
-    if not sequence or not command:
-        print(Term.WARNING + ('recent: cannot parse command output, please check your bash '
-                              'trigger looks like this:') + Term.ENDC)
-        exit("""export PROMPT_COMMAND='{}'""".format(EXPECTED_PROMPT))
-    log_command(command=command, pid=pid, sequence=sequence, return_value=return_value, pwd=pwd)
+# Entry point to recent-daemon command.
+def daemon_entry_point(args_for_test=None):
+    import argparse
+    description = ('recent-daemon keeps ~/.recent.db open and writes the commands logged by '
+                   'log-recent in batches. log-recent writes to the db directly when the daemon '
+                   'is not running.')
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('--socket',
+                        help='Unix socket to listen on. Defaults to $RECENT_DAEMON_SOCKET or '
+                        '$XDG_RUNTIME_DIR/recent2-<uid>.sock',
+                        default=daemon_socket_path())
+    parser.add_argument('--batch_size',
+                        help='Max commands to write in one transaction',
+                        default=100,
+                        type=int)
+    parser.add_argument('--batch_window_ms',
+                        help='Max time to wait for more commands before committing a batch',
+                        default=50,
+                        type=int)
+    args = parser.parse_args(args_for_test)
 
+    import signal
+    import threading
+    daemon = LogDaemon(args.socket,
+                       batch_size=args.batch_size,
+                       batch_window_secs=args.batch_window_ms / 1000)
 
-def log_command(command, pid, sequence, return_value, pwd):
-    conn = create_connection()
-    session = Session(pid, sequence)
-    session.update(conn)
+    def on_sigterm(signum, frame):
+        # serve_forever has to be stopped from a different thread.
+        threading.Thread(target=daemon.shutdown).start()
 
-    if not session.empty:
-        c = conn.cursor()
-        json_data = "json('{}')".format(json.dumps({'env': envvars_to_log()}))
-        # We pass current time instead of using 'now' in sql to mock this value.
-        c.execute(DB.INSERT_ROW.format(json_data),
-                  [int(time.time()), command, pid, return_value, pwd, session.id])
+    signal.signal(signal.SIGTERM, on_sigterm)
+    print('recent-daemon: listening on ' + args.socket)
+    try:
+        daemon.serve_forever()
+    except KeyboardInterrupt:
+        pass
 
-    conn.commit()
-    conn.close()
+
+SPOOL_SUFFIX = '.spool'
+
+
+# Appends the record built by log_command to a per session spool file in RECENT_SPOOL_DIR.
+# Returns False if spooling is not enabled. The spooled records are folded into the db by
+# compact_spool.
+def append_to_spool(record):
+    spool_dir = os.getenv('RECENT_SPOOL_DIR')
+    if not spool_dir:
+        return False
+    import fcntl
+    import json
+    path = os.path.join(spool_dir, record['session'] + SPOOL_SUFFIX)
+    line = (json.dumps(record) + '\n').encode('utf-8')
+    flags = os.O_WRONLY | os.O_APPEND | os.O_CREAT
+    try:
+        fd = os.open(path, flags, 0o600)
+    except FileNotFoundError:
+        os.makedirs(spool_dir, mode=0o700, exist_ok=True)
+        fd = os.open(path, flags, 0o600)
+    try:
+        # Shared lock: appends from different shells dont block each other, but they wait while
+        # compact_spool is reading the file.
+        fcntl.flock(fd, fcntl.LOCK_SH)
+        os.write(fd, line)
+    finally:
+        os.close(fd)
+    return True
+
+
+# Writes all the records from the spool files into the db in a single transaction and empties
+# the spool files. Returns the number of records written.
+def compact_spool(conn):
+    spool_dir = os.getenv('RECENT_SPOOL_DIR')
+    if not spool_dir or not os.path.isdir(spool_dir):
+        return 0
+    import contextlib
+    import fcntl
+    import json
+    from pathlib import Path
+    with contextlib.ExitStack() as stack:
+        spool_files = []
+        records = []
+        for path in sorted(Path(spool_dir).glob('*' + SPOOL_SUFFIX)):
+            f = stack.enter_context(open(path, 'r+b'))
+            fcntl.flock(f, fcntl.LOCK_EX)
+            spool_files.append(f)
+            for line in f.read().splitlines():
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    # Partially written record. Nothing useful to recover from it.
+                    continue
+        if not records:
+            return 0
+
+        def write_records():
+            for record in records:
+                write_command(conn, record)
+
+        write_with_retry(conn, write_records)
+        try_rotate_shards(conn)
+        # Only empty the files once the records are committed. The files are not deleted
+        # because a shell might already be waiting to append to them.
+        for f in spool_files:
+            f.truncate(0)
+    return len(records)
 
 
 # Imports bash_history into RECENT_DB
 # Entry point to recent-import-bash-history command.
 def import_bash_history_entry_point(args_for_test=None):
+    import argparse
+    from pathlib import Path
     description = ('recent-import-bash-history imports bash_history into ~/.recent.db. '
+                   'Run it again to import the commands added to bash_history since. '
                    'Run `recent -h` for info about recent command.')
     parser = argparse.ArgumentParser(description=description)
     parser.add_argument('-f',
-                        help='Force import bash history ignoring previous imports',
+                        help='Force import all of bash history ignoring previous imports',
                         action='store_true')
     args = parser.parse_args(args_for_test)
+    # Older versions of recent touched this file after importing all of bash history.
     import_marker = Path(
         os.environ.get("RECENT_TEST_IMPORT_FILE", "~/.recent_imported_bash_history"))
     import_marker = import_marker.expanduser().absolute()
-    print(import_marker)
-    if not args.f and import_marker.exists():
+    histfile = bash_history_file()
+    conn = create_connection()
+    checkpoint = conn.execute(DB.GET_HISTORY_IMPORT, [str(histfile)]).fetchone()
+    conn.close()
+    if not args.f and not checkpoint and import_marker.exists():
         print(Term.FAIL +
               'recent-import-bash-history failed: Bash history already imported into ~/.recent.db')
         print('Run the command with -f option if you are absolutely sure.' + Term.ENDC)
         parser.print_help()
         sys.exit(1)
-    import_bash_history()
-    import_marker.touch()
+    imported = import_bash_history(force=args.f)
+    print('recent: imported {} commands from {}'.format(imported, histfile))
 
 
-def import_bash_history():
-    # Construct history from bash_history.
+def bash_history_file():
+    from pathlib import Path
+    return Path(os.environ.get("HISTFILE", "~/.bash_history")).expanduser().absolute()
+
+
+# Commands are imported (and the import checkpointed) in transactions of this many commands.
+IMPORT_CHUNK_SIZE = 10000
+
+
+def parse_bash_history(f, last_ts=-1):
+    # Yields (command_ts, command, offset) for the commands in bash_history. f is opened in binary
+    # mode. offset is the position in f right after the command.
     # Example bash_history. The history has 3 entries. First entry has no timestamp attached to it.
     # The next 2 entries have timestamp attached to them. The last entry has some unknown comment
     # which we will ignore.
@@ -337,57 +1703,764 @@ def import_bash_history():
     #useless comment that should be ignored.
     cat bar
     """
-    history = []
-    # Phase 1 starts: After this phase history will be like this
-    # [(-1, "ls /"), # This entry has no timestamp.
-    #  (1571012545, "echo foo"),
-    #  (1571012560, "cat bar")]
-    last_ts = -1
-    histfile = Path(os.environ.get("HISTFILE", "~/.bash_history")).expanduser()
-    if not histfile.exists():
-        return
-    for line in histfile.read_text().splitlines():
+    # This yields
+    # (1571012545, "ls /"), # Timestamp for this comes from the next timestamp.
+    # (1571012545, "echo foo"),
+    # (1571012560, "cat bar")
+    offset = f.tell()
+    # Commands without a timestamp wait here for the next timestamp. Bounded, in case the file
+    # has no timestamps at all.
+    pending = []
+    for raw_line in f:
+        offset += len(raw_line)
+        line = raw_line.decode('utf-8', errors='replace').rstrip('\r\n')
         if not line:
             continue
         if line[0] == '#':
             try:
                 last_ts = int(line[1:].strip())
-            except Exception:
-                # Ignore the exception.
-                pass
-            continue
-        history.append([last_ts, line.strip()])
-
-    # Phase 2 starts: After this phase history will be like this
-    # [(1571012545, "ls /"), # Timestamp for this comes from its next entry
-    #  (1571012545, "echo foo"),
-    #  (1571012560, "cat bar")]
-    last_ts = -1
-    for i in range(len(history) - 1, -1, -1):
-        if history[i][0] == -1 and last_ts != -1:
-            history[i][0] = last_ts
-        elif history[i][0] != -1 and last_ts == -1:
-            last_ts = history[i][0]
-    # Add the history entries into recent's DB.
+            except ValueError:
+                # Ignore the comment.
+                continue
+            yield from ((last_ts, cmd, cmd_offset) for cmd, cmd_offset in pending)
+            pending = []
+        elif last_ts == -1 and len(pending) < IMPORT_CHUNK_SIZE:
+            pending.append((line.strip(), offset))
+        else:
+            yield from ((-1, cmd, cmd_offset) for cmd, cmd_offset in pending)
+            pending = []
+            yield last_ts, line.strip(), offset
+    yield from ((last_ts, cmd, cmd_offset) for cmd, cmd_offset in pending)
+
+
+# Hash of the bytes right before offset in f. See DB.MIGRATE_7_8.
+def history_tail_md5(f, offset):
+    import hashlib
+    n = min(offset, 256)
+    return hashlib.md5(os.pread(f.fileno(), n, offset - n)).hexdigest()
+
+
+# Imports the commands added to bash_history since the last import (all of it if force is set).
+# Returns the number of commands imported.
+def import_bash_history(force=False):
+    histfile = bash_history_file()
+    if not histfile.exists():
+        return 0
     conn = create_connection()
     import random
     # Create a session with a random -ve pid and random -ve sequence id.
     pid = -random.randint(1, 10000000)
     session = Session(pid=pid, sequence=-random.randint(1, 10000000))
-    session.update(conn)
-    for cmd_ts, cmd in history:
-        c = conn.cursor()
-        c.execute(DB.INSERT_ROW_NO_JSON, [
-            cmd_ts, cmd, pid,
-            # exit status=-1, working directory=/unknown
-            -1, "/unknown", session.id])  # yapf: disable
-    conn.commit()
+    write_with_retry(conn, lambda: session.update(conn))
+    size = histfile.stat().st_size
+    imported = 0
+    with open(histfile, 'rb') as f:
+        checkpoint = None if force else conn.execute(DB.GET_HISTORY_IMPORT,
+                                                     [str(histfile)]).fetchone()
+        last_ts = -1
+        if checkpoint:
+            offset, last_ts, tail_md5 = checkpoint
+            if offset > size or history_tail_md5(f, offset) != tail_md5:
+                conn.close()
+                exit(Term.FAIL + ('recent-import-bash-history failed: {} changed since the last '
+                                  'import. Run the command with -f option to import all of it '
+                                  'again.').format(histfile) + Term.ENDC)
+            f.seek(offset)
+
+        chunk = []
+
+        def write_chunk():
+            write_history_chunk(conn, histfile, chunk, pid, session.id,
+                                history_tail_md5(f, chunk[-1][2]))
+
+        for entry in parse_bash_history(f, last_ts):
+            chunk.append(entry)
+            if len(chunk) < IMPORT_CHUNK_SIZE:
+                continue
+            write_with_retry(conn, write_chunk)
+            imported += len(chunk)
+            if sys.stderr.isatty():
+                print('\rrecent: imported {} commands ({}%)'.format(
+                    imported, 100 * entry[2] // max(size, 1)), end='', file=sys.stderr)
+            chunk = []
+        if chunk:
+            write_with_retry(conn, write_chunk)
+            imported += len(chunk)
+        if imported >= IMPORT_CHUNK_SIZE and sys.stderr.isatty():
+            print(file=sys.stderr)
+    conn.close()
+    return imported
+
+
+# Inserts the commands in chunk (from parse_bash_history or the other HISTORY_PARSERS) and
+# checkpoints the import of histfile. The caller owns the transaction.
+def write_history_chunk(conn, histfile, chunk, pid, session_id, tail_md5):
+    c = conn.cursor()
+    c.executemany(DB.INSERT_ROW_NO_JSON, [
+        (cmd_ts, cmd, pid,
+         # exit status=-1, working directory=/unknown
+         -1, "/unknown", session_id) for cmd_ts, cmd, _ in chunk])  # yapf: disable
+    cmd_ts, _, offset = chunk[-1]
+    c.execute(DB.UPSERT_HISTORY_IMPORT, [str(histfile), offset, cmd_ts, tail_md5])
+    c.close()
+
+
+def parse_zsh_history(f, last_ts=-1):
+    # Same as parse_bash_history, for zsh history. With EXTENDED_HISTORY the lines look like
+    # ": 1571012545:0;ls /", otherwise they only have the command. Lines of multi line commands end
+    # with a backslash.
+    offset = f.tell()
+    lines = []
+    for raw_line in f:
+        offset += len(raw_line)
+        # zsh "metafies" some bytes: 0x83 followed by the byte xor 32.
+        raw_line = re.sub(b'\x83(.)', lambda m: bytes([m.group(1)[0] ^ 32]), raw_line, flags=re.S)
+        line = raw_line.decode('utf-8', errors='replace').rstrip('\r\n')
+        if line.endswith('\\'):
+            lines.append(line[:-1])
+            continue
+        lines.append(line)
+        entry, lines = '\n'.join(lines), []
+        match = re.match(r'^: (\d+):\d+;(.*)$', entry, re.S)
+        if match:
+            last_ts, entry = int(match.group(1)), match.group(2)
+        if entry.strip():
+            yield last_ts, entry.strip(), offset
+
+
+def parse_fish_history(f, last_ts=-1):
+    # Same as parse_bash_history, for fish history. Entries look like this.
+    """
+    - cmd: echo foo\\nbar
+      when: 1571012545
+      paths:
+        - foo
+    """
+    def unescape(cmd):
+        return re.sub(r'\\(.)', lambda m: '\n' if m.group(1) == 'n' else m.group(1), cmd)
+
+    offset = f.tell()
+    cmd, cmd_ts = None, last_ts
+    for raw_line in f:
+        line_start, offset = offset, offset + len(raw_line)
+        line = raw_line.decode('utf-8', errors='replace').rstrip('\r\n')
+        if line.startswith('- cmd: '):
+            if cmd:
+                # The entry ends where the next one starts.
+                yield cmd_ts, cmd, line_start
+            cmd, cmd_ts = unescape(line[len('- cmd: '):]).strip(), last_ts
+        elif line.startswith('  when: ') and cmd is not None:
+            try:
+                cmd_ts = last_ts = int(line[len('  when: '):])
+            except ValueError:
+                pass
+    if cmd:
+        yield cmd_ts, cmd, offset
+
+
+HISTORY_PARSERS = {
+    'bash': parse_bash_history,
+    'zsh': parse_zsh_history,
+    'fish': parse_fish_history,
+}
+
+
+# Guesses the shell from the file name (.bash_history, .zsh_history, fish_history...).
+def history_format(path):
+    from pathlib import Path
+    for name in ('zsh', 'fish'):
+        if name in Path(path).name:
+            return name
+    return 'bash'
+
+
+# Imports history files from many hosts.
+# Entry point to recent-import-history command.
+def import_history_entry_point(args_for_test=None):
+    import argparse
+    description = ('recent-import-history imports bash, zsh and fish history files into '
+                   '~/.recent.db. Files are parsed in parallel. Running it again imports only the '
+                   'commands added to the files since.')
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('paths',
+                        nargs='+',
+                        metavar='path',
+                        help=('history file, glob or directory. Every file with "history" in its '
+                              'name under a directory is imported'))
+    parser.add_argument('--format',
+                        choices=['auto'] + sorted(HISTORY_PARSERS),
+                        default='auto',
+                        help='format of the history files. auto guesses it from the file name')
+    parser.add_argument('--hostname',
+                        help=('hostname for the commands. Defaults to the name of the directory '
+                              'the history file is in (e.g. host1 for hosts/host1/.bash_history)'))
+    parser.add_argument('--jobs', '-j', type=int, default=os.cpu_count(), help='parser processes')
+    parser.add_argument('-f',
+                        help='Force import the files ignoring previous imports',
+                        action='store_true')
+    args = parser.parse_args(args_for_test)
+    files = find_history_files(args.paths)
+    imported = import_history_files(files, args.format, args.hostname, args.jobs, args.f)
+    print('recent: imported {} commands from {} files'.format(imported, len(files)))
+
+
+def find_history_files(paths):
+    import glob
+    from pathlib import Path
+    files = []
+    for path in paths:
+        for match in sorted(glob.glob(os.path.expanduser(path))) or [path]:
+            match = Path(match).absolute()
+            if match.is_dir():
+                files.extend(p for p in sorted(match.rglob('*history*')) if p.is_file())
+            else:
+                files.append(match)
+    return files
+
+
+# Runs in the parser processes of recent-import-history. Returns the first chunk_size commands in
+# path after offset, with the tail_md5 for their checkpoint. The next chunk starts at the offset
+# and command_ts of the last command, like an import that resumes from a checkpoint.
+def parse_history_chunk(path, history_format_, offset, last_ts, chunk_size):
+    chunk = []
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        for entry in HISTORY_PARSERS[history_format_](f, last_ts):
+            chunk.append(entry)
+            if len(chunk) == chunk_size:
+                break
+        return chunk, history_tail_md5(f, chunk[-1][2]) if chunk else None
+
+
+# Parses the files in a process pool, one chunk at a time. This process is the only writer and
+# inserts the chunks as they are parsed. The next chunk of a file is parsed only once the previous
+# one is done, and at most 2 chunks per job are parsed or waiting to be written, so that memory
+# use does not grow with the size of the files. Returns the number of commands imported.
+def import_history_files(files, history_format_='auto', hostname=None, jobs=None, force=False):
+    import concurrent.futures
+    import hashlib
+    conn = create_connection()
+    imported = 0
+    # (path, format, offset, last_ts) of the files to parse.
+    to_parse = []
+    for path in files:
+        checkpoint = None if force else conn.execute(DB.GET_HISTORY_IMPORT,
+                                                     [str(path)]).fetchone()
+        offset, last_ts = 0, -1
+        if checkpoint:
+            offset, last_ts, tail_md5 = checkpoint
+            with open(path, 'rb') as f:
+                changed = (offset > path.stat().st_size or
+                           history_tail_md5(f, offset) != tail_md5)
+            if changed:
+                print(Term.WARNING + 'recent: skipping {}. It changed since the last import. '
+                      'Use -f to import all of it again.'.format(path) + Term.ENDC)
+                continue
+        file_format = history_format(path) if history_format_ == 'auto' else history_format_
+        to_parse.append((path, file_format, offset, last_ts))
+    to_parse.reverse()
+    max_in_flight = 2 * (jobs or os.cpu_count() or 1)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = {}
+
+        def submit(path, file_format, offset, last_ts):
+            future = executor.submit(parse_history_chunk, str(path), file_format, offset, last_ts,
+                                     IMPORT_CHUNK_SIZE)
+            futures[future] = path, file_format
+
+        while futures or to_parse:
+            while to_parse and len(futures) < max_in_flight:
+                submit(*to_parse.pop())
+            done, _ = concurrent.futures.wait(futures,
+                                              return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                path, file_format = futures.pop(future)
+                try:
+                    chunk, tail_md5 = future.result()
+                except OSError as e:
+                    print(Term.WARNING + 'recent: skipping {}: {}'.format(path, e) + Term.ENDC)
+                    continue
+                # One session per file.
+                session_id = hashlib.md5('import-{}'.format(path).encode('utf-8')).hexdigest()
+                host = hostname or path.parent.name
+                write_with_retry(
+                    conn, lambda: conn.execute(DB.INSERT_IMPORT_SESSION, [host, session_id]))
+                if not chunk:
+                    continue
+                if len(chunk) == IMPORT_CHUNK_SIZE:
+                    # Parsed while this chunk is written.
+                    submit(path, file_format, chunk[-1][2], chunk[-1][0])
+                write_with_retry(
+                    conn, lambda: write_history_chunk(conn, path, chunk, -1, session_id, tail_md5))
+                imported += len(chunk)
+    conn.close()
+    return imported
+
+
+# Parses 500, 64K, 10M, 1G into a number of bytes.
+def parse_bytes(value):
+    match = re.match(r'^(\d+)([KMG]?)$', value.upper())
+    if not match:
+        raise ValueError('invalid size: ' + value)
+    return int(match.group(1)) << {'': 0, 'K': 10, 'M': 20, 'G': 30}[match.group(2)]
+
+
+# Parses durations like 90d, 52w.
+def parse_duration(value):
+    match = re.match(r'^(\d+)([smhdw])$', value)
+    if not match:
+        raise ValueError('invalid duration: ' + value)
+    return int(match.group(1)) * DURATION_UNITS[match.group(2)]
+
+
+def archive_dir():
+    return os.path.expanduser(os.getenv('RECENT_ARCHIVE_DIR', '~/.recent_archive'))
+
+
+# Entry point to recent-gc command.
+def gc_entry_point(args_for_test=None):
+    import argparse
+    description = ('recent-gc moves the oldest commands out of ~/.recent.db into compressed '
+                   'archives (that `recent --archive` can search), in small batches so that '
+                   'log-recent is not blocked for long.')
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('--max_age',
+                        metavar='365d',
+                        help='Archive the commands older than this. Units: s, m, h, d, w',
+                        type=parse_duration)
+    parser.add_argument('--max_rows', help='Keep at most these many commands', type=int)
+    parser.add_argument('--max_bytes',
+                        metavar='100M',
+                        help=('Archive the oldest commands until the db uses about this many '
+                              'bytes. Suffixes: K, M, G'),
+                        type=parse_bytes)
+    parser.add_argument('--batch_size',
+                        help='Commands to archive in one transaction',
+                        default=500,
+                        type=int)
+    parser.add_argument('--archive_dir',
+                        help='Defaults to $RECENT_ARCHIVE_DIR or ~/.recent_archive',
+                        default=archive_dir())
+    parser.add_argument('--no_archive',
+                        help='Delete the commands without archiving them',
+                        action='store_true')
+    parser.add_argument('--vacuum',
+                        help=('Run a full VACUUM at the end. Blocks log-recent while it runs. '
+                              'Needed once for dbs created before recent-gc existed'),
+                        action='store_true')
+    parser.add_argument('--dry_run',
+                        help='Print how many commands would be archived and exit',
+                        action='store_true')
+    args = parser.parse_args(args_for_test)
+    if args.max_age is None and args.max_rows is None and args.max_bytes is None:
+        parser.error('one of --max_age, --max_rows or --max_bytes is required')
+    if args.batch_size <= 0:
+        parser.error('--batch_size must be positive')
+
+    conn = create_connection()
+    count = expired_commands(conn, args.max_age, args.max_rows, args.max_bytes)
+    if args.dry_run:
+        print('recent-gc: would archive {} commands'.format(count))
+        conn.close()
+        return
+    archive_path = None
+    if count and not args.no_archive:
+        archive_path = archive_file(conn, args.archive_dir, count)
+    archived = gc_commands(conn, count, archive_path, args.batch_size)
+    shrink_db(conn, args.vacuum)
     conn.close()
+    if not archived:
+        print('recent-gc: nothing to archive')
+    elif archive_path:
+        print('recent-gc: archived {} commands to {}'.format(archived, archive_path))
+    else:
+        print('recent-gc: deleted {} commands'.format(archived))
+
+
+def runs_table(conn):
+    return 'command_runs' if is_interned(conn) else 'commands'
+
+
+# Returns how many of the oldest commands have to go to meet all the limits. max_bytes is
+# approximate: every command is assumed to take the same space (including the indexes).
+def expired_commands(conn, max_age_secs=None, max_rows=None, max_bytes=None):
+    runs = runs_table(conn)
+    total = conn.execute(DB.GC_COUNT_COMMANDS.format(runs=runs)).fetchone()[0]
+    count = 0
+    if max_age_secs is not None:
+        cutoff = int(time.time()) - max_age_secs
+        count = conn.execute(DB.GC_COUNT_OLDER_THAN.format(runs=runs), [cutoff]).fetchone()[0]
+    if max_rows is not None:
+        count = max(count, total - max_rows)
+    if max_bytes is not None and total:
+        page_size = conn.execute('pragma page_size').fetchone()[0]
+        pages = (conn.execute('pragma page_count').fetchone()[0] -
+                 conn.execute('pragma freelist_count').fetchone()[0])
+        used = pages * page_size
+        if used > max_bytes:
+            count = max(count, -(-total * (used - max_bytes) // used))
+    return min(count, total)
+
+
+# Archives are named after the time range of the commands in them. Running recent-gc again after
+# it was interrupted can archive some commands twice. recent --archive ignores the duplicates.
+def archive_file(conn, directory, count):
+    first_ts, last_ts = [
+        conn.execute(DB.GC_NTH_OLDEST_TS.format(runs=runs_table(conn)), [n]).fetchone()[0]
+        for n in (0, count - 1)
+    ]
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+    name = 'commands-{}-{}.ndjson.gz'.format(
+        *[time.strftime('%Y%m%d%H%M%S', time.gmtime(ts)) for ts in (first_ts, last_ts)])
+    return os.path.join(directory, name)
+
+
+# Archives (unless archive_path is None) and deletes the count oldest commands, batch_size of them
+# per transaction. Returns the number of commands deleted.
+def gc_commands(conn, count, archive_path, batch_size):
+    import json
+    incremental = conn.execute('pragma auto_vacuum').fetchone()[0] == 2
+    deleted = 0
+
+    def gc_batch(limit):
+        rows = conn.execute(DB.GC_OLDEST_COMMANDS, [limit]).fetchall()
+        if archive_path:
+            append_to_archive(archive_path, [{
+                'id': row[0],
+                'ts': row[1],
+                'command': row[2],
+                'pid': row[3],
+                'return_value': row[4],
+                'pwd': row[5],
+                'session': row[6],
+                'env': json.loads(row[7])['env'] if row[7] else {},
+            } for row in rows])
+        delete_oldest_runs(conn, [(row[0], row[2]) for row in rows])
+        return len(rows)
+
+    while deleted < count:
+        batch = []
+        write_with_retry(conn, lambda: batch.append(gc_batch(min(batch_size, count - deleted))))
+        if not batch[-1]:
+            break
+        deleted += batch[-1]
+        if incremental:
+            # Give the pages freed by this batch back to the file system. execute() would only
+            # free one page: it runs a single step of the pragma. executescript runs all of them.
+            try:
+                conn.executescript('pragma incremental_vacuum')
+            except sqlite3.OperationalError as e:
+                # The next batch frees these pages too.
+                if 'locked' not in str(e):
+                    raise
+    return deleted
+
+
+# Deletes the runs (id, command), which have to be the oldest runs of their commands. Keeps
+# command_stats (and command_text in the interned layout) in sync.
+def delete_oldest_runs(conn, runs):
+    import collections
+    import json
+    table = runs_table(conn)
+    conn.execute(DB.GC_DELETE_RUNS.format(runs=table), [json.dumps([r[0] for r in runs])])
+    for command, n in collections.Counter(r[1] for r in runs).items():
+        if command is None:
+            continue
+        if conn.execute(DB.GC_DELETE_COMMAND_STATS, [command, n]).rowcount:
+            if table == 'command_runs':
+                conn.execute(DB.GC_DELETE_COMMAND_TEXT, [command])
+        else:
+            conn.execute(DB.GC_UPDATE_COMMAND_STATS, [n, command])
+
+
+# Appends the records to the archive as a gzip member of their own, so that a partially written
+# archive is still readable.
+def append_to_archive(path, records):
+    import gzip
+    import json
+    with open(path, 'ab') as f:
+        with gzip.GzipFile(fileobj=f, mode='wb') as gz:
+            gz.write(''.join(json.dumps(record) + '\n' for record in records).encode('utf-8'))
+        f.flush()
+        # The commands are deleted from the db right after this.
+        os.fsync(f.fileno())
+
+
+# Makes the db file smaller. In WAL mode the file only shrinks once the WAL is checkpointed.
+def shrink_db(conn, full_vacuum):
+    if full_vacuum:
+        conn.execute('pragma auto_vacuum = incremental')
+        conn.execute('vacuum')
+    elif conn.execute('pragma auto_vacuum').fetchone()[0] == 0:
+        print(Term.WARNING + 'recent-gc: run recent-gc --vacuum once to make the db file smaller. '
+              'The space of the archived commands is reused for new ones until then.' + Term.ENDC)
+    conn.execute('pragma wal_checkpoint(truncate)')
+
+
+# Returns an in memory db with the commands from the archives in directory.
+def archive_connection(directory):
+    import contextlib
+    import gzip
+    import io
+    import json
+    from pathlib import Path
+    conn = sqlite3.connect(':memory:')
+    with contextlib.redirect_stdout(io.StringIO()):
+        migrate(0, conn)
+    env_ids = {}
+    for path in sorted(Path(directory).glob('commands-*.ndjson.gz')):
+        rows = []
+        with gzip.open(path, 'rt', encoding='utf-8') as f:
+            try:
+                for line in f:
+                    record = json.loads(line)
+                    env = json.dumps(record['env'], sort_keys=True)
+                    if env not in env_ids:
+                        env_ids[env] = env_snapshot_id(conn, record['env'])
+                    rows.append([
+                        record['id'], record['ts'], record['command'], record['pid'],
+                        record['return_value'], record['pwd'], record['session'], env_ids[env]
+                    ])
+            except (EOFError, ValueError):
+                # Partially written archive (e.g. recent-gc was killed). Keep what was read.
+                pass
+        conn.executemany(DB.INSERT_ARCHIVED_ROW, rows)
+    conn.commit()
+    return conn
+
+
+# Commands moved to a shard per move. Keeps the occasional log-recent that moves them fast.
+SHARD_BATCH_SIZE = 500
+
+
+# Returns the [start, end) epoch range of the (UTC) month that ts is in.
+def month_range(ts):
+    import calendar
+    year, month = time.gmtime(ts)[:2]
+    next_year, next_month = (year + 1, 1) if month == 12 else (year, month + 1)
+    return (calendar.timegm((year, month, 1, 0, 0, 0)),
+            calendar.timegm((next_year, next_month, 1, 0, 0, 0)))
+
+
+def shard_path(shard_dir, ts):
+    return os.path.join(shard_dir, 'commands-{}.db'.format(time.strftime('%Y-%m', time.gmtime(ts))))
+
+
+# With RECENT_SHARD_DIR set, the main db only keeps the commands of the current month. Moves the
+# oldest batch_size commands from before it into the shard of their month. Runs after every write
+# (log-recent, recent-daemon, spool), so there is only work to do right after a month ends.
+# Returns the number of commands moved.
+def rotate_shards(conn, batch_size=SHARD_BATCH_SIZE):
+    shard_dir = os.getenv('RECENT_SHARD_DIR')
+    if not shard_dir:
+        return 0
+    import contextlib
+    import io
+    import json
+    oldest = conn.execute(DB.GC_NTH_OLDEST_TS.format(runs=runs_table(conn)), [0]).fetchone()
+    if oldest is None or oldest[0] >= month_range(time.time())[0]:
+        return 0
+    path = shard_path(shard_dir, oldest[0])
+    os.makedirs(shard_dir, mode=0o700, exist_ok=True)
+    # Creates (or migrates) the shard. Dont print about it on the prompt.
+    with contextlib.redirect_stdout(io.StringIO()):
+        create_connection(path=path).close()
+    moved = []
+
+    def move():
+        runs = conn.execute(DB.SHARD_OLDEST_COMMANDS,
+                            [month_range(oldest[0])[1], batch_size]).fetchall()
+        ids = json.dumps([r[0] for r in runs])
+        conn.execute(DB.COPY_ENV_SNAPSHOT_VARS_TO_SHARD, [ids])
+        conn.execute(DB.COPY_ENV_SNAPSHOTS_TO_SHARD, [ids])
+        conn.execute(DB.COPY_COMMANDS_TO_SHARD, [ids])
+        delete_oldest_runs(conn, runs)
+        moved.append(len(runs))
+
+    conn.execute(DB.ATTACH_SHARD, [path])
+    try:
+        write_with_retry(conn, move)
+    except sqlite3.OperationalError as e:
+        # The next write tries again.
+        if 'locked' not in str(e):
+            raise
+    finally:
+        conn.execute(DB.DETACH_SHARD)
+    return sum(moved)
+
+
+# rotate_shards for the write paths. The commands are already committed, so a failure (e.g. an
+# unwritable RECENT_SHARD_DIR) is only reported. It must not reach the prompt or stop the writer
+# thread of recent-daemon. The next write tries again.
+def try_rotate_shards(conn):
+    try:
+        return rotate_shards(conn)
+    except Exception as e:
+        print(Term.WARNING + 'recent: failed to move old commands to RECENT_SHARD_DIR: ' +
+              repr(e) + Term.ENDC,
+              file=sys.stderr)
+        return 0
+
+
+# Returns the [start, end) epoch range that the time filters of args (-d, --since, --until) allow.
+# None means unbounded.
+def query_time_range(args, failure_exit_func):
+    start, end = None, None
+    if args.d:
+        start, end = parse_date(args.d) or (None, None)
+    if args.since:
+        since = parse_time_bound(args.since, '--since', failure_exit_func)[0]
+        start = since if start is None else max(start, since)
+    if args.until:
+        until = parse_time_bound(args.until, '--until', failure_exit_func)[1]
+        end = until if end is None else min(end, until)
+    return start, end
+
+
+# Returns (path, month end, True) of the shards in RECENT_SHARD_DIR whose month overlaps
+# [start, end). True: the shards are this host's, so recent can migrate them.
+def shards_in_range(start=None, end=None):
+    shard_dir = os.getenv('RECENT_SHARD_DIR')
+    if not shard_dir:
+        return []
+    import calendar
+    from pathlib import Path
+    shards = []
+    for path in Path(shard_dir).glob('commands-*.db'):
+        match = re.match(r'^commands-(\d{4})-(\d{2})\.db$', path.name)
+        if not match:
+            continue
+        month_start, month_end = month_range(
+            calendar.timegm((int(match.group(1)), int(match.group(2)), 1, 0, 0, 0)))
+        if (start is None or month_end > start) and (end is None or month_start < end):
+            shards.append((str(path), month_end, True))
+    return shards
+
+
+# Clocks of different hosts can be off by this much.
+HOST_CLOCK_SKEW_SECS = 300
+
+
+# Returns (path, end, False) of the dbs of the other hosts in RECENT_HOST_DB_DIR. All their
+# commands are older than end, which is based on when the db (or its journal) was last written.
+# False: the dbs belong to other hosts, which may run another version of recent. They are only
+# ever opened read-only.
+def other_host_dbs():
+    host_db_dir = os.getenv('RECENT_HOST_DB_DIR')
+    if not host_db_dir or not os.path.isdir(host_db_dir):
+        return []
+    own_db = os.path.abspath(recent_db_path())
+    dbs = []
+    for name in os.listdir(host_db_dir):
+        path = os.path.abspath(os.path.join(host_db_dir, name))
+        if not name.endswith('.db') or path == own_db:
+            continue
+        mtimes = [os.path.getmtime(f) for f in (path, path + '-wal', path + '-journal')
+                  if os.path.exists(f)]
+        dbs.append((path, int(max(mtimes)) + 1 + HOST_CLOCK_SKEW_SECS, False))
+    return dbs
+
+
+# Returns the dbs (see add_rows_from_dbs) other than the main one that can have rows for args.
+def other_dbs_for_query(args, failure_exit_func):
+    if args.archive:
+        return []
+    return shards_in_range(*query_time_range(args, failure_exit_func)) + other_host_dbs()
+
+
+# Returns a read-only connection to a db from other_dbs_for_query. None (after a warning) if the db
+# of another host was written by a different version of recent.
+def open_other_db(path, owned):
+    if owned:
+        conn = create_connection(read_only=True, path=path)
+    else:
+        conn = connect_read_only(path, any_layout=True)
+        if conn is None:
+            print(Term.WARNING + 'recent: skipping {}. It was written by a different version '
+                  'of recent'.format(path) + Term.ENDC, file=sys.stderr)
+            return None
+    conn.create_function("REGEXP", 2, regexp)
+    return conn
+
+
+# Adds the rows of the query in args from other dbs (shards and other hosts' dbs) to rows (the
+# rows from the main db). dbs are (path, end, owned) where end is a bound on the command_ts of
+# the commands in the db and owned is false for the dbs that must not be written to. They are
+# read in order of end, newest first, and only as long as they can have one of the newest n rows.
+# --dedup reads all of them, so that the run counts add up.
+def add_rows_from_dbs(rows, dbs, args, failure_exit_func, slow_query_log):
+    import copy
+    n = int(args.n)
+    # command_dt is the first column of all the queries.
+    rows = sorted(rows, key=lambda row: row[0])
+    shard_args = args
+    if args.dedup:
+        shard_args = copy.copy(args)
+        shard_args.n = -1
+    for path, end, owned in sorted(dbs, key=lambda db: db[1], reverse=True):
+        end_dt = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(end))
+        if not args.dedup and 0 < n <= len(rows) and rows[-n][0] >= end_dt:
+            break
+        conn = open_other_db(path, owned)
+        if conn is None:
+            continue
+        c = conn.cursor()
+        rows.extend(query_rows(c, shard_args, failure_exit_func, fts_filter(conn),
+                               slow_query_log))
+        conn.close()
+        rows.sort(key=lambda row: row[0])
+    if args.dedup:
+        merged = {}
+        for command_dt, command, run_count in rows:
+            if command in merged:
+                run_count += merged[command][2]
+                command_dt = max(command_dt, merged[command][0])
+            merged[command] = (command_dt, command, run_count)
+        rows = sorted(merged.values(), key=lambda row: row[0])
+    return rows if n < 0 else rows[len(rows) - n:]
+
+
+# Returns the filters (and their parameters) that match the commands which match the sqlite LIKE
+# pattern. If fts_filter is set, the trigram index over the commands is used to narrow down the
+# rows that the LIKE filter has to look at.
+def like_filters(like_pattern, fts_filter):
+    filters, parameters = ['command like ?'], [like_pattern]
+    # The index can only look up literal runs of 3 or more chars. The LIKE filter is still needed:
+    # the index is case insensitive and does not care about the order of the runs.
+    literals = [lit for lit in re.split(r'[%_]', like_pattern) if len(lit) >= 3]
+    if fts_filter and literals:
+        fts_query = ' AND '.join('"{}"'.format(lit.replace('"', '""')) for lit in literals)
+        filters.insert(0, fts_filter)
+        parameters.insert(0, fts_query)
+    return filters, parameters
+
+
+# The number of newest commands that query_rows searches without the trigram index first.
+LIKE_SCAN_ROWS = 5000
+
+
+# Returns the rows of the queries for args. The trigram index has to find all the commands that
+# match the pattern (or the literals of the -re pattern) before the newest n can be picked, which
+# is slow for common patterns (e.g - git). A plain scan stops as soon as it finds n. So the newest
+# LIKE_SCAN_ROWS commands are scanned first, and the index is only used if they have less than n
+# matches.
+def query_rows(c, args, failure_exit_func, fts, slow_query_log):
+    queries = query_builder(args, failure_exit_func, fts_filter=fts)
+    if (fts and not args.dedup and 0 < int(args.n) and
+            queries != query_builder(args, failure_exit_func)):
+        scan_queries = query_builder(args, failure_exit_func, scan_rows=LIKE_SCAN_ROWS)
+        rows = [row for query, parameters in scan_queries
+                for row in slow_query_log.timed_rows(c, query, parameters)]
+        if len(rows) >= int(args.n):
+            return rows
+    return (row for query, parameters in queries
+            for row in slow_query_log.timed_rows(c, query, parameters))
 
 
 # Returns a list of queries to run for the given args
 # Return type: List(Pair(query, List(query_string)))
-def query_builder(args, failure_exit_func):
+# If scan_rows is set, only the newest scan_rows commands are searched.
+def query_builder(args, failure_exit_func, fts_filter=None, scan_rows=None):
     if args.re and args.sql:
         print(Term.FAIL + 'Only one of -re and -sql should be set' + Term.ENDC)
         failure_exit_func(1)
@@ -397,12 +2470,24 @@ def query_builder(args, failure_exit_func):
         print(Term.FAIL + ('Only one of --successes_only, --failures_only and '
                            '--status_num has to be set') + Term.ENDC)
         failure_exit_func(1)
-    query = DB.TAIL_N_ROWS_TEMPLATE_DEDUP if args.dedup else DB.TAIL_N_ROWS_TEMPLATE
+    query = DB.TAIL_N_ROWS_TEMPLATE
+    if args.dedup:
+        # command_stats has one row per command. Use it if we only filter by the command text.
+        only_command_filters = not (args.cur_session_only or args.successes_only or
+                                    args.failures_only or args.status_num != -1 or args.sql or
+                                    args.w or args.d or args.since or args.until or
+                                    args.env)
+        if only_command_filters:
+            query = DB.TAIL_N_ROWS_TEMPLATE_DEDUP_STATS
+            # The trigram index maps to rows in commands, not command_stats.
+            fts_filter = None
+        else:
+            query = DB.TAIL_N_ROWS_TEMPLATE_DEDUP
     filters = []
     parameters = []
     if args.cur_session_only:
         filters.append('session = ?')
-        parameters.append(Session.session_id_string())
+        parameters.append(Session.id_for_pid())
     if args.successes_only:
         filters.append('return_val = 0')
     if args.failures_only:
@@ -415,26 +2500,55 @@ def query_builder(args, failure_exit_func):
         filters.append("""command not like 'recent%'""")
     if args.pattern:
         if args.re:
+            # Cheap prefilter so that the regex is only evaluated for the rows that contain the
+            # literal parts of the pattern.
+            literals = regexp_literals(args.pattern)
+            if literals:
+                pattern_filters, pattern_parameters = like_filters(
+                    '%' + '%'.join(literals) + '%', fts_filter)
+                filters.extend(pattern_filters)
+                parameters.extend(pattern_parameters)
             filters.append('command REGEXP ?')
             parameters.append(args.pattern)
         elif args.sql:
             filters.append(args.pattern)
         else:
-            filters.append('command like ?')
-            parameters.append('%' + args.pattern + '%')
+            pattern_filters, pattern_parameters = like_filters('%' + args.pattern + '%',
+                                                               fts_filter)
+            filters.extend(pattern_filters)
+            parameters.extend(pattern_parameters)
     if args.w:
+        from pathlib import Path
         filters.append('pwd = ?')
         parameters.append(str(Path(args.w).expanduser().absolute()))
+    # Date filters are ranges over command_ts, so that they can use command_ts_ind.
     if args.d:
-        filters.append(parse_date(args.d))
-        parameters.append(args.d)
+        date_range = parse_date(args.d)
+        if date_range is None:
+            print("Invalid date passed to -d")
+            sys.exit(1)
+        filters.append("command_ts >= ?")
+        filters.append("command_ts < ?")
+        parameters.extend(date_range)
+    if args.since:
+        filters.append("command_ts >= ?")
+        parameters.append(parse_time_bound(args.since, '--since', failure_exit_func)[0])
+    if args.until:
+        filters.append("command_ts < ?")
+        parameters.append(parse_time_bound(args.until, '--until', failure_exit_func)[1])
     for env_var in args.env:
         split = env_var.split(":")
         if len(split) == 1:
-            filters.append('json_extract(json_data, "$.env.{}") is not null'.format(split[0]))
+            filters.append('env_id in (select snapshot_id from env_snapshot_vars where name = ?)')
+            parameters.append(split[0])
         else:
-            filters.append('json_extract(json_data, "$.env.{}") = ?'.format(split[0]))
-            parameters.append(split[1])
+            filters.append(('env_id in (select snapshot_id from env_snapshot_vars '
+                            'where name = ? and value = ?)'))
+            parameters.extend(split[:2])
+    if scan_rows is not None:
+        # A range over command_ts (and not a subquery with a limit), so that the rows can still
+        # be read from command_ts_ind in order, stopping after n.
+        filters.append(DB.SCAN_NEWEST_ROWS_FILTER.format(int(scan_rows) - 1))
     filters.append('length(command) <= {}'.format(args.char_limit))
     try:
         n = int(args.n)
@@ -452,13 +2566,142 @@ def query_builder(args, failure_exit_func):
     return ret
 
 
+# Returns the query (and parameters) to answer args from recent_snapshot or
+# recent_session_snapshot (See DB.MIGRATE_8_9). None if the snapshots can not answer it.
+def snapshot_query(args):
+    if (args.pattern or args.dedup or args.successes_only or args.failures_only or
+            args.status_num != -1 or args.w or args.d or args.since or args.until or args.env or
+            args.return_self or args.nocase):
+        return None
+    try:
+        n, char_limit = int(args.n), int(args.char_limit)
+    except ValueError:
+        return None
+    if char_limit != DB.SNAPSHOT_CHAR_LIMIT or n <= 0:
+        return None
+    if args.cur_session_only:
+        if n > DB.SESSION_SNAPSHOT_ROWS:
+            return None
+        return DB.TAIL_N_ROWS_SNAPSHOT_TEMPLATE.format(
+            table='recent_session_snapshot', where='where session = ?'), [
+                Session.id_for_pid(), n]
+    if n > DB.SNAPSHOT_ROWS:
+        return None
+    return DB.TAIL_N_ROWS_SNAPSHOT_TEMPLATE.format(table='recent_snapshot', where=''), [n]
+
+
 # Returns true if `item` matches `expr`. Used as sqlite UDF.
 def regexp(expr, item):
-    reg = re.compile(expr)
-    return reg.search(item) is not None
+    return item is not None and compile_regexp(expr).search(item) is not None
+
+
+# sqlite calls regexp once per row with the same expr. Compile it only once.
+@functools.lru_cache(maxsize=32)
+def compile_regexp(expr):
+    return re.compile(expr)
+
+
+# Returns the literal strings that every match of the regex `expr` contains, in the same order as
+# in expr. This is conservative: parts of the regex that are hard to reason about (groups, classes,
+# escapes like \d) just end the current literal. The literals dont have sqlite LIKE wildcards
+# (% and _), so that they can be used to build a LIKE pattern.
+def regexp_literals(expr):
+    if '|' in expr or '(?' in expr:
+        # Alternations and inline flags (e.g - (?i)) can make any literal optional.
+        return []
+    literals = []
+    cur = ''
+    i = 0
+    while i < len(expr):
+        ch = expr[i]
+        if ch == '\\' and i + 1 < len(expr) and not expr[i + 1].isalnum():
+            # Escaped special char like \. or \$
+            ch = expr[i + 1]
+            i += 2
+        elif ch in '\\?*{[(.^$)+':
+            if ch in '?*{':
+                # The previous char is optional.
+                cur = cur[:-1]
+            literals.append(cur)
+            cur = ''
+            if ch == '[':
+                i = _skip_regexp_class(expr, i)
+            elif ch == '(':
+                i = _skip_regexp_group(expr, i)
+            elif ch == '{':
+                end = expr.find('}', i)
+                i = i + 1 if end == -1 else end + 1
+            elif ch == '\\':
+                # \d, \w, \b, \x41, \1 etc.
+                i = _skip_regexp_escape(expr, i)
+            else:
+                i += 1
+            continue
+        else:
+            i += 1
+        # ch is a literal char.
+        if ch in '%_':
+            literals.append(cur)
+            cur = ''
+        else:
+            cur += ch
+    literals.append(cur)
+    return [lit for lit in literals if lit]
+
+
+# expr[i] is a \ followed by an alphanumeric char. Returns the index after the escape sequence,
+# including the digits of \x41, \u0041, \101 and \1.
+def _skip_regexp_escape(expr, i):
+    ch = expr[i + 1]
+    i += 2
+    if ch == 'N' and expr.startswith('{', i):
+        end = expr.find('}', i)
+        return len(expr) if end == -1 else end + 1
+    hex_digits = '0123456789abcdefABCDEF'
+    # Octal escapes (\0, \101) and backreferences (\1, \12) have up to 3 digits.
+    max_digits, digits = {'x': (2, hex_digits), 'u': (4, hex_digits), 'U': (8, hex_digits)}.get(
+        ch, (2, '0123456789') if ch.isdigit() else (0, ''))
+    while max_digits and i < len(expr) and expr[i] in digits:
+        i += 1
+        max_digits -= 1
+    return i
+
+
+# expr[i] is the opening [ of a character class. Returns the index after the closing ].
+def _skip_regexp_class(expr, i):
+    i += 1
+    if i < len(expr) and expr[i] == '^':
+        i += 1
+    if i < len(expr) and expr[i] == ']':
+        # ] right after [ or [^ is a literal ].
+        i += 1
+    while i < len(expr) and expr[i] != ']':
+        i += 2 if expr[i] == '\\' else 1
+    return i + 1
+
+
+# expr[i] is the opening ( of a group. Returns the index after the matching ).
+def _skip_regexp_group(expr, i):
+    depth = 0
+    while i < len(expr):
+        if expr[i] == '\\':
+            i += 2
+            continue
+        if expr[i] == '[':
+            i = _skip_regexp_class(expr, i)
+            continue
+        if expr[i] == '(':
+            depth += 1
+        elif expr[i] == ')':
+            depth -= 1
+            if depth == 0:
+                return i + 1
+        i += 1
+    return i
 
 
 def make_arg_parser_for_recent():
+    import argparse
     description = ('recent is a convenient way to query bash history. '
                    'Visit {} for more examples or to ask questions or to report issues'
                    ).format(Term.UNDERLINE + 'https://github.com/dotslash/recent2' + Term.ENDC)
@@ -493,6 +2736,16 @@ def make_arg_parser_for_recent():
                         metavar='2016-10-01',
                         help='date in YYYY-MM-DD, YYYY-MM, or YYYY format',
                         default='')
+    parser.add_argument('--since',
+                        metavar='2h',
+                        help=('only return commands run after this. Takes a date like -d '
+                              '(optionally with HH:MM[:SS]) or a duration like 30m, 2h, 3d, 1w'),
+                        default='')
+    parser.add_argument('--until',
+                        metavar='2016-10-01',
+                        help=('only return commands run before this. A date includes the whole '
+                              'day/month/year. Takes the same values as --since'),
+                        default='')
     parser.add_argument('--return_self',
                         help='Return `recent` commands also in the output',
                         action='store_true')
@@ -509,6 +2762,18 @@ def make_arg_parser_for_recent():
                         metavar='key[:val]',
                         default=[])
     parser.add_argument('--dedup', action='store_true', help=('ok'))
+    parser.add_argument('--interactive',
+                        '-i',
+                        help=('Search interactively and print the selected command. The pattern '
+                              'is the initial query. The other filters narrow down the commands'),
+                        action='store_true')
+    parser.add_argument('--compact',
+                        help='Write commands spooled in RECENT_SPOOL_DIR into the db and exit',
+                        action='store_true')
+    parser.add_argument('--archive',
+                        help=('Search the commands archived by recent-gc (in RECENT_ARCHIVE_DIR) '
+                              'instead of the db'),
+                        action='store_true')
 
     # CONTROL OUTPUT FORMAT
     # Hide time. This makes copy-pasting simpler.
@@ -518,11 +2783,42 @@ def make_arg_parser_for_recent():
                         action='store_true')
     parser.add_argument('--time_first', '-tf', help='Print time first', action='store_true')
     parser.add_argument('--debug', help='Debug mode', action='store_true')
+    parser.add_argument('--explain',
+                        help='Print the sqlite query plan for the queries instead of running them',
+                        action='store_true')
+    parser.add_argument('--profile',
+                        help='Print how long each phase of this command took to stderr',
+                        action='store_true')
+    parser.add_argument('--perf-report',
+                        metavar='N',
+                        help=('Print percentiles of the time taken by each phase of the last N '
+                              '(default 1000) log-recent and recent commands recorded with '
+                              'RECENT_PROFILE set'),
+                        nargs='?',
+                        const=1000,
+                        type=int)
+    parser.add_argument('--startup-report',
+                        help=('Print the time taken by the imports of `recent -n 1`, to keep an '
+                              'eye on the startup time of recent'),
+                        action='store_true')
+    parser.add_argument('--slow-queries',
+                        metavar='N',
+                        help=('Print the N (default 10) slowest kinds of queries recorded by the '
+                              'slow query log. See RECENT_SLOW_QUERY_MS'),
+                        nargs='?',
+                        const=10,
+                        type=int)
     parser.add_argument('--detail', help='Return detailed output', action='store_true')
+    parser.add_argument('--format',
+                        help=('Output format. json, ndjson and csv print the same columns as '
+                              '--detail, without colors'),
+                        choices=['text', 'json', 'ndjson', 'csv'],
+                        default='text')
     parser.add_argument(
         '--columns',
         help=('Comma separated columns to print if --detail is passed. Valid columns are '
-              'command_dt,command,pid,return_val,pwd,session,json_data'),
+              'command_dt,command,pid,return_val,pwd,session,json_data. --dedup always prints '
+              'run_count'),
         default="command_dt,command,json_data")
 
     # Query type - regex/sql.
@@ -554,34 +2850,599 @@ def tty_width():
     return sz.columns
 
 
-def pad(raw_text, print_text):
-    allowed_width = min(tty_width() - 30, 50)
-    to_pad = max(allowed_width - len(raw_text), 0)
-    return print_text + (' ' * to_pad)
+class RowPrinter:
+    # Prints the rows of a recent query. Output goes through one buffer that is written every
+    # FLUSH_ROWS rows, and the terminal width is looked up only once.
+    FLUSH_ROWS = 500
+    # --detail tables are aligned using the first these many rows. Later rows are printed as they
+    # come. Values that are wider than their column are not truncated.
+    DETAIL_SAMPLE_ROWS = 1000
+    NUMERIC_COLUMNS = {'pid', 'return_val', 'run_count'}
+
+    def __init__(self, args, out=None):
+        self.args = args
+        self.out = out or sys.stdout
+        self.buffer = []
+        self.num_rows = 0
+        # Rows of a --detail table that are waiting for the column widths.
+        self.sample = []
+        self.widths = None
+        self.csv_writer = None
+        self.pad_width = min(tty_width() - 30, 50) if args.format == 'text' else 0
+
+    # Used as the file for csv.writer
+    def write(self, text):
+        self.buffer.append(text)
+
+    def flush(self):
+        self.out.write(''.join(self.buffer))
+        self.buffer = []
+
+    def add(self, row_dict):
+        fmt = self.args.format
+        if fmt in ('json', 'ndjson'):
+            import json
+            line = json.dumps(self.json_row(row_dict))
+            if fmt == 'json':
+                self.write('[\n' if self.num_rows == 0 else ',\n')
+                self.write(line)
+            else:
+                self.write(line + '\n')
+        elif fmt == 'csv':
+            if self.csv_writer is None:
+                import csv
+                self.csv_writer = csv.writer(self, lineterminator='\n')
+                self.csv_writer.writerow(row_dict.keys())
+            self.csv_writer.writerow(row_dict.values())
+        elif self.args.detail and 'json_data' in row_dict:
+            for k, v in row_dict.items():
+                self.write(Term.BOLD + Term.OKBLUE + k + Term.ENDC + ": " + str(v) + '\n')
+            self.write("---------------------------------\n")
+        elif self.args.detail:
+            self.add_table_row(row_dict)
+        else:
+            self.write(self.text_row(row_dict) + '\n')
+        self.num_rows += 1
+        if len(self.buffer) >= self.FLUSH_ROWS:
+            self.flush()
+
+    def close(self):
+        if self.args.format == 'json':
+            self.write('[]\n' if self.num_rows == 0 else '\n]\n')
+        if self.sample:
+            self.write_table_header()
+        self.flush()
+
+    def json_row(self, row_dict):
+        import json
+        if row_dict.get('json_data'):
+            return dict(row_dict, json_data=json.loads(row_dict['json_data']))
+        return row_dict
+
+    def text_row(self, row_dict):
+        colored_cmd = row_dict['command']
+        if row_dict.get('return_val', 0) > 0:
+            # Show failed commands in red.
+            # We do > 0 because for commands we got via import_bash_history, the return_val
+            # is negative
+            colored_cmd = Term.FAIL + colored_cmd + Term.ENDC
+        if self.args.hide_time:
+            return colored_cmd
+        cmd_time = row_dict["command_dt"]
+        if self.args.time_first:
+            return f'{Term.YELLOW}{cmd_time}{Term.ENDC} {colored_cmd}'
+        padded_cmd = colored_cmd + ' ' * max(self.pad_width - len(row_dict['command']), 0)
+        return f'{padded_cmd} # rtime@ {Term.YELLOW}{cmd_time}{Term.ENDC}'
+
+    def add_table_row(self, row_dict):
+        if self.widths is None:
+            self.sample.append(row_dict)
+            if len(self.sample) == self.DETAIL_SAMPLE_ROWS:
+                self.write_table_header()
+            return
+        self.write_table_row(row_dict.values())
+
+    # Computes the column widths from the sample and writes the header and the sample.
+    def write_table_header(self):
+        columns = list(self.sample[0].keys())
+        self.widths = [
+            max([len(col)] + [len(self.table_value(row[col])) for row in self.sample])
+            for col in columns
+        ]
+        self.numeric = [col in self.NUMERIC_COLUMNS for col in columns]
+        self.write_table_row(columns)
+        self.write_table_row(['-' * w for w in self.widths])
+        for row in self.sample:
+            self.write_table_row(row.values())
+        self.sample = []
+
+    def write_table_row(self, values):
+        cells = []
+        for value, width, numeric in zip(values, self.widths, self.numeric):
+            value = self.table_value(value)
+            cells.append(value.rjust(width) if numeric else value.ljust(width))
+        self.write('  '.join(cells).rstrip() + '\n')
+
+    @staticmethod
+    def table_value(value):
+        return '' if value is None else str(value)
+
+
+# recent -i loads up to these many distinct commands.
+INTERACTIVE_CANDIDATES = 100000
+
+
+class InteractiveSearch:
+    # State of recent -i. candidates are (command, run_count) pairs, most recent first. They are
+    # ranked once by recency and frequency. A command matches the query if it contains every
+    # space separated term of the query (ignoring case). Typing narrows down the matches of the
+    # previous query instead of scanning all the candidates again, and backspace goes back to
+    # the matches that were already computed.
+
+    def __init__(self, candidates, query=''):
+        import math
+        ranked = sorted(range(len(candidates)),
+                        key=lambda i: -(1 + math.log(max(candidates[i][1], 1))) / math.log(i + 2))
+        # Lower case, single line versions of the commands are matched against the query.
+        self.commands = {}
+        for i in ranked:
+            self.commands.setdefault(' '.join(candidates[i][0].lower().split('\n')),
+                                     candidates[i][0])
+        # (query, matches) for the query and the prefixes of it that were typed.
+        self.stack = [('', list(self.commands))]
+        self.set_query(query)
+
+    @property
+    def query(self):
+        return self.stack[-1][0]
+
+    # Returns the commands that match the query, best first.
+    def matches(self, limit=None):
+        return [self.commands[m] for m in self.stack[-1][1][:limit]]
+
+    def num_matches(self):
+        return len(self.stack[-1][1])
+
+    def set_query(self, query):
+        while len(self.stack) > 1 and not query.startswith(self.query):
+            self.stack.pop()
+        for i in range(len(self.query), len(query)):
+            # One character at a time, so that backspace finds every prefix in the stack.
+            matches = self.stack[-1][1]
+            terms = query[:i + 1].lower().split()
+            if terms and not query[i].isspace():
+                # Only the last term changed, and it only got longer.
+                matches = [m for m in matches if terms[-1] in m]
+            self.stack.append((query[:i + 1], matches))
+
+
+def interactive_candidates(conn, args, failure_exit_func, fts, slow_query_log):
+    import argparse
+    # The filters (-w, -cs, -so, --env...) scope the candidates. The pattern is the initial query.
+    scope = argparse.Namespace(**vars(args))
+    scope.pattern, scope.re, scope.sql, scope.dedup = '', False, False, True
+    scope.n = INTERACTIVE_CANDIDATES
+    rows = []
+    for query, parameters in query_builder(scope, failure_exit_func, fts_filter=fts):
+        rows = list(slow_query_log.timed_rows(conn.cursor(), query, parameters))
+    other_dbs = other_dbs_for_query(scope, failure_exit_func)
+    if other_dbs:
+        rows = add_rows_from_dbs(rows, other_dbs, scope, failure_exit_func, slow_query_log)
+    return [(command, run_count) for _, command, run_count in reversed(rows)]
+
+
+# Runs the recent -i UI on the terminal. Returns the selected command, or None.
+def interactive_ui(search):
+    import curses
+    # stdout is usually captured by the shell (e.g. READLINE_LINE=$(recent -i)). Draw on the tty.
+    with open('/dev/tty', 'r+b', buffering=0) as tty:
+        saved_fds = os.dup(0), os.dup(1)
+        os.dup2(tty.fileno(), 0)
+        os.dup2(tty.fileno(), 1)
+        try:
+            return curses.wrapper(_interactive_loop, search)
+        except KeyboardInterrupt:
+            return None
+        finally:
+            os.dup2(saved_fds[0], 0)
+            os.dup2(saved_fds[1], 1)
+            os.close(saved_fds[0])
+            os.close(saved_fds[1])
+
+
+def _interactive_loop(stdscr, search):
+    import curses
+    curses.use_default_colors()
+    selected = 0
+    while True:
+        height, width = stdscr.getmaxyx()
+        matches = search.matches(limit=max(height - 1, 1))
+        selected = max(min(selected, len(matches) - 1), 0)
+        stdscr.erase()
+        status = '  {}/{}'.format(search.num_matches(), len(search.commands))
+        stdscr.addnstr(0, 0, '> ' + search.query, max(width - len(status) - 1, 1))
+        stdscr.addnstr(0, max(width - len(status) - 1, 0), status, len(status), curses.A_DIM)
+        for row, command in enumerate(matches):
+            attr = curses.A_REVERSE if row == selected else curses.A_NORMAL
+            stdscr.addnstr(row + 1, 0, ' '.join(command.split('\n')), width - 1, attr)
+        stdscr.move(0, min(2 + len(search.query), width - 1))
+        stdscr.refresh()
+        key = stdscr.get_wch()
+        if key in ('\n', '\r', curses.KEY_ENTER):
+            return matches[selected] if matches else None
+        elif key in ('\x1b', '\x07', '\x03'):  # Esc, Ctrl-G, Ctrl-C
+            return None
+        elif key in (curses.KEY_UP, '\x10', '\x12'):  # Ctrl-P, Ctrl-R
+            selected = max(selected - 1, 0)
+        elif key in (curses.KEY_DOWN, '\x0e', '\x13'):  # Ctrl-N, Ctrl-S
+            selected += 1
+        elif key in (curses.KEY_BACKSPACE, '\x7f', '\x08'):
+            search.set_query(search.query[:-1])
+            selected = 0
+        elif key == '\x15':  # Ctrl-U
+            search.set_query('')
+            selected = 0
+        elif isinstance(key, str) and key.isprintable():
+            search.set_query(search.query + key)
+            selected = 0
+
+
+# Prints percentiles of the phase timings of the last n runs in profile_runs (See Profile).
+def print_perf_report(conn, n):
+    import json
+    runs = {}
+    for program, phases in conn.execute(DB.GET_PROFILE_RUNS, [n]):
+        for phase, secs in json.loads(phases).items():
+            runs.setdefault(program, {}).setdefault(phase, []).append(secs)
+    if not runs:
+        print('recent: no timings recorded. Set RECENT_PROFILE=1 to record them')
+        return
+    headers = ['program', 'phase', 'runs', 'p50_ms', 'p95_ms', 'p99_ms', 'max_ms']
+    table = [headers]
+    for program, phases in sorted(runs.items()):
+        for phase, values in phases.items():
+            ms = [1000 * percentile(values, p) for p in (50, 95, 99)] + [1000 * max(values)]
+            table.append([program, phase, str(len(values))] + ['{:.1f}'.format(v) for v in ms])
+    widths = [max(len(row[i]) for row in table) for i in range(len(headers))]
+    for row in table:
+        print('  '.join(v.ljust(w) if i < 2 else v.rjust(w)
+                        for i, (v, w) in enumerate(zip(row, widths))).rstrip())
+
+
+# Prints the modules that `recent -n 1` imports (reported by python -X importtime), slowest
+# first. Modules that python imports on its own are left out.
+def print_startup_report():
+    import subprocess
+    env = dict(os.environ)
+    env.pop('RECENT_PROFILE', None)
+    env['RECENT_CUSTOM_PROMPT'] = '1'
+    # Import this recent2.py in the subprocesses.
+    env['PYTHONPATH'] = os.pathsep.join(
+        [os.path.dirname(os.path.abspath(__file__))] +
+        ([env['PYTHONPATH']] if env.get('PYTHONPATH') else []))
+
+    # Returns the wall time and the top level imports as (name, self_us, cumulative_us, children)
+    def run_python(code):
+        start = time.monotonic()
+        proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', code],
+                              env=env,
+                              stdout=subprocess.DEVNULL,
+                              stderr=subprocess.PIPE,
+                              universal_newlines=True)
+        wall_secs = time.monotonic() - start
+        # Imports are reported after the modules they import, which are indented 2 more spaces.
+        children = {}
+        for line in proc.stderr.splitlines():
+            if not line.startswith('import time:') or 'self [us]' in line:
+                continue
+            self_us, cumulative_us, name = line[len('import time:'):].split('|')
+            depth = (len(name) - len(name.lstrip()) - 1) // 2
+            node = (name.strip(), int(self_us), int(cumulative_us), children.pop(depth + 1, []))
+            children.setdefault(depth, []).append(node)
+        return wall_secs, children.get(0, [])
+
+    python_secs, python_imports = run_python('pass')
+    recent_secs, recent_imports = run_python(
+        'import sys, recent2; sys.argv = ["recent", "-n", "1"]; recent2.main()')
+    python_modules = {name for name, _, _, _ in python_imports}
+    imports = [node for node in recent_imports if node[0] not in python_modules]
+    print('python -c pass: {:.1f}ms, recent -n 1: {:.1f}ms, imports of recent -n 1: {:.1f}ms'.
+          format(1000 * python_secs, 1000 * recent_secs, sum(node[2] for node in imports) / 1000))
+    print('{:>10}  {:>7}  {}'.format('cumulative', 'self', 'module (ms)'))
+    for name, self_us, cumulative_us, children in sorted(imports, key=lambda n: -n[2]):
+        print('{:>10.1f}  {:>7.1f}  {}'.format(cumulative_us / 1000, self_us / 1000, name))
+        for child in sorted(children, key=lambda n: -n[2]):
+            print('{:>10.1f}  {:>7.1f}    {}'.format(child[2] / 1000, child[1] / 1000, child[0]))
+
+
+def print_query_plan(conn, query, parameters):
+    if query.lower().startswith('pragma'):
+        return
+    print(Term.BOLD + 'QUERY: ' + Term.ENDC + ' '.join(query.split()))
+    print(Term.BOLD + 'PARAMETERS: ' + Term.ENDC + str(parameters))
+    print(Term.BOLD + 'PLAN:' + Term.ENDC)
+    print(query_plan(conn, query, parameters))
+
+
+# Returns the sqlite query plan as indented lines.
+def query_plan(conn, query, parameters):
+    depth, lines = {0: 0}, []
+    for node_id, parent_id, _, detail in conn.execute('explain query plan ' + query, parameters):
+        depth[node_id] = depth.get(parent_id, 0) + 1
+        lines.append('  ' * depth[node_id] + detail)
+    return '\n'.join(lines)
+
+
+class SlowQueryLog:
+    """Records the recent queries that take longer than RECENT_SLOW_QUERY_MS (default 100) in the
+    slow_queries table, with their parameters, row count and query plan. Set
+    RECENT_SLOW_QUERY_MS=-1 to turn it off. If RECENT_SLOW_QUERY_REDACT is set, the pattern and
+    the other text parameters are not recorded. `recent --slow-queries` prints the slowest ones.
+    """
+    DEFAULT_THRESHOLD_MS = 100
+    # Options that only change how the rows are printed.
+    OUTPUT_OPTIONS = {'hide_time', 'time_first', 'debug', 'detail', 'format', 'columns', 'profile'}
+    REDACTED = '<redacted>'
+
+    def __init__(self, args):
+        self.args = args
+        try:
+            self.threshold_secs = float(
+                os.getenv('RECENT_SLOW_QUERY_MS', SlowQueryLog.DEFAULT_THRESHOLD_MS)) / 1000
+        except ValueError:
+            self.threshold_secs = SlowQueryLog.DEFAULT_THRESHOLD_MS / 1000
+        # (query, parameters, row_count, secs, plan) of the slow queries.
+        self.slow = []
+
+    # Runs the query with cursor c and yields its rows. The time spent in sqlite (not in the
+    # caller) is measured. The plan of a slow query is taken right away, on the connection that
+    # ran it: shards and other hosts' dbs are closed before save.
+    def timed_rows(self, c, query, parameters):
+        if self.threshold_secs < 0 or query.lower().startswith('pragma'):
+            yield from c.execute(query, parameters)
+            return
+        start = time.perf_counter()
+        c.execute(query, parameters)
+        secs, row_count = time.perf_counter() - start, 0
+        while True:
+            start = time.perf_counter()
+            row = c.fetchone()
+            secs += time.perf_counter() - start
+            if row is None:
+                break
+            row_count += 1
+            yield row
+        if secs >= self.threshold_secs:
+            try:
+                plan = query_plan(c.connection, query, parameters)
+            except sqlite3.Error as e:
+                plan = 'failed to explain the query: ' + repr(e)
+            self.slow.append((query, parameters, row_count, secs, plan))
+
+    # Names of the recent options (and not their values) that change the query.
+    def options(self):
+        parser = make_arg_parser_for_recent()
+        return ' '.join(
+            sorted(dest for dest, value in vars(self.args).items()
+                   if dest not in SlowQueryLog.OUTPUT_OPTIONS and
+                   value != parser.get_default(dest)))
+
+    def save(self):
+        if not self.slow:
+            return
+        import json
+        redact = env_flag('RECENT_SLOW_QUERY_REDACT')
+        options = self.options()
+        rows = []
+        for query, parameters, row_count, secs, plan in self.slow:
+            if redact:
+                parameters = [
+                    SlowQueryLog.REDACTED if isinstance(p, str) else p for p in parameters
+                ]
+                if self.args.sql and self.args.pattern:
+                    query = query.replace(self.args.pattern, SlowQueryLog.REDACTED)
+            rows.append((int(time.time()), options, 1000 * secs, row_count,
+                         ' '.join(query.split()), json.dumps(parameters), plan))
+
+        # The conn of the query can be read-only.
+        write_conn = create_connection()
+
+        def write():
+            c = write_conn.cursor()
+            c.executemany(DB.INSERT_SLOW_QUERY, rows)
+            c.execute(DB.TRIM_SLOW_QUERIES, [c.lastrowid])
+
+        try:
+            write_with_retry(write_conn, write)
+        except sqlite3.OperationalError:
+            # Not being able to record a slow query should not fail the query.
+            pass
+        write_conn.close()
+
+
+def print_slow_queries(conn, n):
+    slow_queries = conn.execute(DB.GET_SLOW_QUERIES, [n]).fetchall()
+    if not slow_queries:
+        print('recent: no slow queries recorded')
+        return
+    for (options, count, avg_ms, max_ms, ts, row_count, query, parameters,
+         plan) in slow_queries:
+        print(Term.BOLD + 'OPTIONS: ' + Term.ENDC + (options or '(none)'))
+        print('{} queries, avg {:.1f}ms, max {:.1f}ms. The slowest one returned {} rows at {}'.
+              format(count, avg_ms, max_ms, row_count,
+                     time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(ts))))
+        print(Term.BOLD + 'QUERY: ' + Term.ENDC + query)
+        print(Term.BOLD + 'PARAMETERS: ' + Term.ENDC + parameters)
+        print(Term.BOLD + 'PLAN:' + Term.ENDC)
+        print(plan)
+        print()
+
+
+class ResultCache:
+    # Opt-in (RECENT_CACHE_DB) on-disk cache for the results of recent queries. Entries are keyed
+    # by the queries (and parameters) from query_builder and are valid as long as no command was
+    # logged or deleted (e.g. by recent-gc or shard rotation) since, i.e. the commands_generation
+    # counter (See DB.MIGRATE_12_13) did not change.
+    MAX_ENTRIES = 200
+    # Bigger results are not cached.
+    MAX_ENTRY_BYTES = 1 << 20
+    CREATE_TABLE = """
+        create table if not exists results (
+            key text primary key,
+            version int,
+            rows text,
+            used_ts real
+        )"""
+    # -sql patterns with these can return different results for the same data.
+    NONDETERMINISTIC_SQL = re.compile(
+        r'\b(random|randomblob|changes|total_changes|last_insert_rowid|now|localtime)\b|'
+        r'\bcurrent_(time|date|timestamp)\b', re.I)
+
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path, timeout=BUSY_TIMEOUT_SECS)
+        self.conn.execute(self.CREATE_TABLE)
+        self.key, self.version = None, None
+
+    # Returns None if the results of the query should not be cached.
+    @classmethod
+    def open(cls, args):
+        path = os.getenv('RECENT_CACHE_DB')
+        # The version (See get) does not change when other hosts log commands.
+        if not path or args.debug or args.archive or os.getenv('RECENT_HOST_DB_DIR'):
+            return None
+        if args.sql and cls.NONDETERMINISTIC_SQL.search(args.pattern):
+            return None
+        return cls(os.path.expanduser(path))
+
+    # Returns the cached rows for queries or None. Does not read the commands.
+    def get(self, conn, queries):
+        import hashlib
+        import json
+        self.key = hashlib.sha1(json.dumps(queries).encode('utf-8')).hexdigest()
+        self.version = conn.execute(DB.GET_COMMANDS_GENERATION).fetchone()[0]
+        row = self.conn.execute('select version, rows from results where key = ?',
+                                [self.key]).fetchone()
+        if not row or row[0] != self.version:
+            return None
+        self.conn.execute('update results set used_ts = ? where key = ?', [time.time(), self.key])
+        self.conn.commit()
+        return json.loads(row[1])
+
+    def put(self, rows):
+        import json
+        rows = json.dumps(rows)
+        if len(rows) > self.MAX_ENTRY_BYTES:
+            return
+        self.conn.execute('insert or replace into results values (?, ?, ?, ?)',
+                          [self.key, self.version, rows, time.time()])
+        # Evict the least recently used entries.
+        self.conn.execute(
+            """delete from results where key not in (
+                   select key from results order by used_ts desc limit ?)""", [self.MAX_ENTRIES])
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
 
 
 def handle_recent_command(args, failure_exit_func):
+    if args.startup_report:
+        print_startup_report()
+        return
     check_prompt(args.debug)  # Fail the command if PROMPT_COMMAND is not set
-    conn = create_connection()
+    if args.archive:
+        conn = archive_connection(archive_dir())
+    else:
+        # Only writing spooled commands needs a writable connection.
+        conn = create_connection(read_only=not (args.compact or os.getenv('RECENT_SPOOL_DIR')))
+    if args.perf_report is not None:
+        print_perf_report(conn, args.perf_report)
+        conn.close()
+        return
+    if args.slow_queries is not None:
+        print_slow_queries(conn, args.slow_queries)
+        conn.close()
+        return
+    # Make sure the commands spooled by log-recent are visible to the queries.
+    with PROFILE.phase('compact_spool'):
+        num_compacted = 0 if args.archive else compact_spool(conn)
+    if args.compact:
+        print('recent: wrote {} spooled commands'.format(num_compacted))
+        conn.close()
+        return
     # Install REGEXP sqlite UDF.
     conn.create_function("REGEXP", 2, regexp)
+    fts = fts_filter(conn)
+    if args.explain:
+        for query, parameters in query_builder(args, failure_exit_func, fts_filter=fts):
+            print_query_plan(conn, query, parameters)
+        for path, _, owned in other_dbs_for_query(args, failure_exit_func):
+            other_conn = open_other_db(path, owned)
+            if other_conn is None:
+                continue
+            print(Term.BOLD + 'DB: ' + Term.ENDC + path)
+            for query, parameters in query_builder(args, failure_exit_func,
+                                                   fts_filter=fts_filter(other_conn)):
+                print_query_plan(other_conn, query, parameters)
+            other_conn.close()
+        conn.close()
+        return
+    if args.interactive:
+        slow_query_log = SlowQueryLog(args)
+        search = InteractiveSearch(
+            interactive_candidates(conn, args, failure_exit_func, fts, slow_query_log),
+            args.pattern)
+        slow_query_log.save()
+        conn.close()
+        selected = interactive_ui(search)
+        if selected is not None:
+            print(selected)
+        return
     # Register the queries executed. (Replace new lines with spaces in the query)
     queries_executed = []
 
     def update_queries_executed(inp):
         if inp == DB.GET_COMMANDS_TABLE_SCHEMA:
             return
+        # Statements run by triggers and by the fts5 module itself are not interesting.
+        if inp.startswith('--') or "'main'." in inp:
+            return
         trans = inp.replace('\n', ' ')
         queries_executed.append(trans)
 
     conn.set_trace_callback(update_queries_executed)
     c = conn.cursor()
-    detail_results = []
+    printer = RowPrinter(args)
     columns_to_print = set(args.columns.split(','))
     columns_to_print.update(['command_dt', 'command', 'return_val'])
-    for query, parameters in query_builder(args, failure_exit_func):
-        for row in c.execute(query, parameters):
-            query_columns = DB.TAIL_N_ROWS_DEDUP_COLUMNS if args.dedup else DB.TAIL_N_ROWS_COLUMNS
+    if args.dedup:
+        columns_to_print.add('run_count')
+    query_columns = DB.TAIL_N_ROWS_DEDUP_COLUMNS if args.dedup else DB.TAIL_N_ROWS_COLUMNS
+    queries = query_builder(args, failure_exit_func, fts_filter=fts)
+    with PROFILE.phase('cache'):
+        cache = ResultCache.open(args)
+        rows = cache.get(conn, queries) if cache else None
+    # Rows to add to the cache.
+    new_rows = [] if cache and rows is None else None
+    other_dbs = [] if rows is not None else other_dbs_for_query(args, failure_exit_func)
+    slow_query_log = SlowQueryLog(args)
+    if rows is None:
+        snapshot = snapshot_query(args)
+        if snapshot:
+            with PROFILE.phase('query'):
+                rows = list(slow_query_log.timed_rows(c, *snapshot))
+            if len(rows) < snapshot[1][-1]:
+                # The snapshot does not have enough rows. Maybe some were deleted.
+                rows = None
+    if rows is None:
+        rows = query_rows(c, args, failure_exit_func, fts, slow_query_log)
+    if other_dbs:
+        with PROFILE.phase('query'):
+            rows = add_rows_from_dbs(rows, other_dbs, args, failure_exit_func, slow_query_log)
+    with PROFILE.phase('output'):
+        for row in PROFILE.timed_iter('query', rows):
+            if new_rows is not None:
+                new_rows.append(row)
             row_dict = {
                 query_columns[i]: row[i]
                 for i in range(len(row))
@@ -590,32 +3451,15 @@ def handle_recent_command(args, failure_exit_func):
             if 'command_dt' not in row_dict or 'command' not in row_dict:
                 # Why would we have these entries?
                 continue
-            if args.detail:
-                detail_results.append(row_dict)
-                continue
-            colored_cmd = row_dict['command']
-            if row_dict.get('return_val', 0) > 0:
-                # Show failed commands in red.
-                # We do > 0 because for commands we got via import_bash_history, the return_val
-                # is negative
-                colored_cmd = Term.FAIL + colored_cmd + Term.ENDC
-            if args.hide_time:
-                print(colored_cmd)
-            if not args.hide_time:
-                cmd_time = row_dict["command_dt"]
-                if args.time_first:
-                    print(f'{Term.YELLOW}{cmd_time}{Term.ENDC} {colored_cmd}')
-                else:
-                    padded_cmd = pad(raw_text=row_dict['command'], print_text=colored_cmd)
-                    print(f'{padded_cmd} # rtime@ {Term.YELLOW}{cmd_time}{Term.ENDC}')
-    if args.detail:
-        if 'json_data' not in columns_to_print:
-            print(tabulate(detail_results, headers="keys"))
-        else:
-            for res in detail_results:
-                for k, v in res.items():
-                    print(Term.BOLD + Term.OKBLUE + k + Term.ENDC + ": " + str(v))
-                print("---------------------------------")
+            printer.add(row_dict)
+        printer.close()
+    if cache:
+        with PROFILE.phase('cache'):
+            if new_rows is not None:
+                cache.put(new_rows)
+            cache.close()
+    with PROFILE.phase('slow_query_log'):
+        slow_query_log.save()
 
     if args.debug:
         schema = None
@@ -631,9 +3475,14 @@ def handle_recent_command(args, failure_exit_func):
 
 
 def main():
-    parser = make_arg_parser_for_recent()
-    args = parser.parse_args()
+    PROFILE.enable('recent')
+    with PROFILE.phase('parse_args'):
+        parser = make_arg_parser_for_recent()
+        args = parser.parse_args()
+    if args.profile:
+        PROFILE.enable('recent', to_stderr=True)
     handle_recent_command(args, parser.exit)
+    PROFILE.finish()
 
 
 if __name__ == '__main__':
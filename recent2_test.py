@@ -1,6 +1,10 @@
 from datetime import datetime, timedelta, timezone
 import io
+import json
 import os
+import shutil
+import sqlite3
+import threading
 import time
 import unittest
 import unittest.mock as mock
@@ -40,6 +44,8 @@ class TestBase(unittest.TestCase):
         IN_MEM_DB = 'file::memory:?cache=shared'
         os.environ['RECENT_DB'] = IN_MEM_DB
         os.environ['PROMPT_COMMAND'] = recent2.EXPECTED_PROMPT
+        # Dont send the commands to a recent-daemon that might be running on this machine.
+        os.environ['RECENT_DAEMON_SOCKET'] = "/tmp/{}.sock".format(uuid.uuid1())
 
         self._arg_parser = recent2.make_arg_parser_for_recent()
         self._shell_pid = int(time.time())
@@ -99,9 +105,6 @@ class RecentTest(TestBase):
     def tearDownClass(cls) -> None:
         untested_options = {
             'help',  # Need not test help
-            # TODO: These options change how we display the results. Figure out how to test them.
-            'columns',
-            'detail',
         }
         assert tests_option.untested_options == untested_options
 
@@ -127,6 +130,39 @@ class RecentTest(TestBase):
         # We have only 30 items logged
         self.check_without_ts(self.query("-n 100"), commands)
 
+    def test_tail_uses_snapshot(self):
+        for i in range(3):
+            self.logCmd("cmd{}".format(i))
+        self.logCmd("recent cmd")
+        conn = self._keep_alive_conn
+        self.assertEqual(["cmd0", "cmd1", "cmd2"], [
+            r[0] for r in conn.execute("select command from recent_snapshot order by id")])
+        for table in ["recent_snapshot", "recent_session_snapshot"]:
+            conn.execute("update {} set command = 'snapshot' where command = 'cmd2'".format(table))
+        conn.commit()
+        self.check_without_ts(self.query("-n 2"), ["cmd1", "snapshot"])
+        with mock.patch('os.getppid', return_value=self._shell_pid):
+            self.check_without_ts(self.query("-n 2 -cs"), ["cmd1", "snapshot"])
+        # Filters that the snapshot can not answer use the commands table.
+        self.check_without_ts(self.query("-n 2 -cl 100"), ["cmd1", "cmd2"])
+        # So do queries for more commands than the snapshot has.
+        conn.execute("delete from recent_snapshot where command = 'cmd0'")
+        conn.commit()
+        self.check_without_ts(self.query("-n 3"), ["cmd0", "cmd1", "cmd2"])
+
+    def test_snapshot_evicts_old_commands(self):
+        conn = self._keep_alive_conn
+        rows = [(i, "cmd{}".format(i), 1, 0, "/", "s") for i in range(1000)]
+        conn.executemany(recent2.DB.INSERT_ROW_NO_JSON, rows)
+        conn.commit()
+        num_rows, min_ts = conn.execute(
+            "select count(*), min(command_ts) from recent_snapshot").fetchone()
+        self.assertLessEqual(num_rows, recent2.DB.SNAPSHOT_ROWS + 50)
+        self.assertEqual(1000 - num_rows, min_ts)
+        num_rows = conn.execute(
+            "select count(*) from recent_session_snapshot where session = 's'").fetchone()[0]
+        self.assertLessEqual(num_rows, recent2.DB.SESSION_SNAPSHOT_ROWS + 50)
+
     @tests_option("hide_time")
     def test_hide_time(self):
         self.logCmd("cmd1")
@@ -246,6 +282,63 @@ class RecentTest(TestBase):
         self.check_without_ts(self.query("head%0only%tail"), [cmds[0]])
         self.check_without_ts(self.query("head%1only%tail"), [cmds[1]])
 
+    def test_pattern_with_trigram_index(self):
+        cmds = ['echo "hi there"', 'ls', 'LS -la', 'grep it_s file']
+        for c in cmds:
+            self.logCmd(c)
+        args = self._arg_parser.parse_args(['there'])
+        query, params = recent2.query_builder(args, self._arg_parser.exit,
+                                              fts_filter=recent2.DB.FTS_FILTER)[-1]
+        self.assertIn('commands_fts match ?', query)
+        self.assertIn('"there"', params)
+
+        def check_all_patterns():
+            self.check_without_ts(self.query('"hi'), [cmds[0]])
+            self.check_without_ts(self.query('ls'), [cmds[1]])
+            self.check_without_ts(self.query('ls -nc'), [cmds[1], cmds[2]])
+            self.check_without_ts(self.query_with_args(['LS -l']), [cmds[2]])
+            self.check_without_ts(self.query_with_args(['ls -l']), [])
+            self.check_without_ts(self.query_with_args(['ls -l', '--nocase']), [cmds[2]])
+            self.check_without_ts(self.query('it_s'), [cmds[3]])
+            self.check_without_ts(self.query('there%hi'), [])
+
+        check_all_patterns()
+        # Same results when sqlite does not support the trigram index.
+        with mock.patch('recent2.fts_filter', return_value=None):
+            check_all_patterns()
+
+    def test_common_pattern_does_not_use_trigram_index(self):
+        cmds = ['make old', 'ls', 'make new1', 'ls', 'make new2']
+        for c in cmds:
+            self.logCmd(c)
+        if not recent2.fts_filter(self._keep_alive_conn):
+            self.skipTest('sqlite does not have fts5 with the trigram tokenizer')
+
+        def fts_queries():
+            return self._keep_alive_conn.execute(
+                "select count(*) from slow_queries where query like '%fts match%'").fetchone()[0]
+
+        with mock.patch.dict(os.environ, {'RECENT_SLOW_QUERY_MS': '0'}), \
+                mock.patch('recent2.LIKE_SCAN_ROWS', 3):
+            # The newest 3 commands have the 2 matches.
+            self.check_without_ts(self.query('-n 2 make'), cmds[2::2])
+            self.assertEqual(0, fts_queries())
+            self.check_without_ts(self.query('-n 3 make'), cmds[0::2])
+            self.assertEqual(1, fts_queries())
+            # Same for the literals of a regex.
+            self.check_without_ts(self.query_with_args(['-n', '2', '-re', 'mak.*w[12]']),
+                                  cmds[2::2])
+            self.assertEqual(1, fts_queries())
+            self.check_without_ts(self.query_with_args(['-n', '3', '-re', 'mak.* [on]']),
+                                  cmds[0::2])
+            self.assertEqual(2, fts_queries())
+
+    def test_short_pattern_does_not_use_trigram_index(self):
+        args = self._arg_parser.parse_args(['ab%cd'])
+        query, params = recent2.query_builder(args, self._arg_parser.exit,
+                                              fts_filter=recent2.DB.FTS_FILTER)[-1]
+        self.assertNotIn('commands_fts', query)
+
     @tests_option("re")
     def test_re(self):
         cmds = [
@@ -259,6 +352,50 @@ class RecentTest(TestBase):
         self.check_without_ts(self.query("-re head.*0.*tail"), [cmds[0]])
         self.check_without_ts(self.query("-re head.*1.*tail"), [cmds[1]])
 
+    def test_re_prefilters_with_literals(self):
+        for i in range(50):
+            self.logCmd("noise {}".format(i))
+        cmds = ["git commit -m one", "git  commit -m two", "git status"]
+        for c in cmds:
+            self.logCmd(c)
+        with mock.patch('recent2.regexp', wraps=recent2.regexp) as regexp:
+            self.check_without_ts(self.query_with_args(["-re", "git +commit"]), cmds[:2])
+            # Only the rows that contain "git" and "commit" reach the regex. With the trigram
+            # index, they reach it twice: there are less than 20 of them in the newest commands,
+            # so the index is used after the scan of those.
+            fts = recent2.fts_filter(self._keep_alive_conn)
+            self.assertEqual(4 if fts else 2, regexp.call_count)
+        self.check_without_ts(self.query_with_args(["-re", "(one|two)$"]), cmds[:2])
+        self.check_without_ts(self.query_with_args(["-re", r"^noise 4\d$"]),
+                              ["noise {}".format(i) for i in range(40, 50)])
+        self.logCmd("fooAbar")
+        for expr in [r"foo\x41bar", r"foo\u0041bar", r"foo\101bar", r"f(o)\1Abar"]:
+            self.check_without_ts(self.query_with_args(["-re", expr]), ["fooAbar"])
+
+    def test_regexp_literals(self):
+        cases = {
+            "head.*tail": ["head", "tail"],
+            "ab+c": ["ab", "c"],
+            "a?bc": ["bc"],
+            "x{2}yz": ["yz"],
+            "(abc)?def": ["def"],
+            "[ab)]cd": ["cd"],
+            r"\.py$": [".py"],
+            r"foo\dbar": ["foo", "bar"],
+            "50%_off": ["50", "off"],
+            "a|b": [],
+            "(?i)abc": [],
+            # The digits of an escape are not literal text.
+            r"foo\x41bar": ["foo", "bar"],
+            r"foo\u0041bar": ["foo", "bar"],
+            r"\101bc": ["bc"],
+            r"(a)\1bc": ["bc"],
+            r"ab\0cd": ["ab", "cd"],
+            r"ab\N{DIGIT ONE}cd": ["ab", "cd"],
+        }
+        for expr, literals in cases.items():
+            self.assertEqual(literals, recent2.regexp_literals(expr), expr)
+
     @tests_option("sql")
     def test_sql(self):
         cmds = [
@@ -317,6 +454,45 @@ class RecentTest(TestBase):
         self.check_without_ts(self.query("-d 2020-07"), ["cmd 2020-07-01", "cmd 2020-07-02"])
         self.check_without_ts(self.query("-d 2020-07-01"), ["cmd 2020-07-01"])
 
+    @tests_option("since")
+    @tests_option("until")
+    def test_since_until(self):
+        def ts(date_str):
+            return datetime.strptime(date_str, '%Y-%m-%d %H:%M').replace(
+                tzinfo=timezone.utc).timestamp()
+
+        self.logCmd("cmd 2020-06-30", time_secs=ts("2020-06-30 23:59"))
+        self.logCmd("cmd 2020-07-01", time_secs=ts("2020-07-01 10:00"))
+        self.logCmd("cmd 2020-07-02", time_secs=ts("2020-07-02 10:00"))
+        self.logCmd("cmd 2020-08-01", time_secs=ts("2020-08-01 00:00"))
+
+        self.check_without_ts(self.query("--since 2020-07"),
+                              ["cmd 2020-07-01", "cmd 2020-07-02", "cmd 2020-08-01"])
+        # --until includes the whole period.
+        self.check_without_ts(self.query("--until 2020-07"),
+                              ["cmd 2020-06-30", "cmd 2020-07-01", "cmd 2020-07-02"])
+        self.check_without_ts(self.query("--since 2020-07-01 --until 2020-07-01"),
+                              ["cmd 2020-07-01"])
+        self.check_without_ts(self.query_with_args(["--since", "2020-07-01 10:00"]),
+                              ["cmd 2020-07-01", "cmd 2020-07-02", "cmd 2020-08-01"])
+        # Durations are relative to now.
+        with mock.patch('time.time', return_value=ts("2020-07-02 12:00")):
+            self.check_without_ts(self.query("--since 1d"), ["cmd 2020-07-02", "cmd 2020-08-01"])
+            self.check_without_ts(self.query("--since 36h --until 1d"), ["cmd 2020-07-01"])
+            self.check_without_ts(self.query("--since 90m"), ["cmd 2020-08-01"])
+        with self.assertRaises(SystemExit), mock.patch('sys.stdout', new=io.StringIO()):
+            recent2.parse_time_bound("yesterday", "--since", self._arg_parser.exit)
+
+    def test_date_filters_use_index(self):
+        args = self._arg_parser.parse_args(["-d", "2020-07", "--since", "2w"])
+        query, params = recent2.query_builder(args, self._arg_parser.exit)[-1]
+        self.assertNotIn("strftime", query)
+        self.assertEqual(3, query.count("command_ts >= ") + query.count("command_ts < "))
+        self.assertEqual((1593561600, 1596240000), recent2.parse_date("2020-07"))
+        self.assertEqual((1609372800, 1609459200), recent2.parse_date("2020-12-31"))
+        self.assertEqual((1577836800, 1609459200), recent2.parse_date("2020"))
+        self.assertIsNone(recent2.parse_date("2020-13"))
+
     @tests_option("env")
     def tests_env(self):
         os.environ['IGNORE'] = 'ignore'
@@ -357,6 +533,27 @@ class RecentTest(TestBase):
                               ["capture_set1", "capture_set1 again"])
         self.check_without_ts(self.query("--env RECENT_CAPTURE:implicit2"),
                               ["capture_set2", "capture_set2 again"])
+        # Commands with the same env vars share an env snapshot.
+        env_ids = self._keep_alive_conn.execute(
+            "select count(distinct env_id) from commands where command like 'capture%'")
+        self.assertEqual(3, env_ids.fetchone()[0])
+
+    @tests_option("explain")
+    def test_explain_uses_indexes(self):
+        self.logCmd("cmd1")
+
+        def plan(query):
+            return "\n".join(self.query_with_args(["--explain"] + query.split(" ")))
+
+        self.assertIn("USING INDEX commands_session_ts_ind", plan("-cs"))
+        self.assertIn("USING INDEX commands_pwd_ts_ind", plan("-w /tmp"))
+        self.assertIn("USING INDEX commands_return_val_ts_ind", plan("-stn 2"))
+        self.assertIn("USING INDEX commands_env_ts_ind", plan("--env EXPLAIN_VAR:1"))
+        self.assertIn("USING COVERING INDEX env_snapshot_vars_ind", plan("--env EXPLAIN_VAR:1"))
+        self.assertIn("USING INDEX command_ts_ind", plan("-n 5"))
+        self.assertIn("USING INDEX command_ts_ind", plan("-d 2020"))
+        # --explain does not run the query.
+        self.assertNotIn("rtime@", plan("cmd1"))
 
     @tests_option("debug")
     def tests_debug_does_not_throw_error(self):
@@ -383,6 +580,7 @@ class RecentTest(TestBase):
         with mock.patch('sys.exit') as exit_mock:
             recent2.check_prompt(False)
             self.assertFalse(exit_mock.called)
+        del os.environ['RECENT_CUSTOM_PROMPT']
 
     def test_check_prompt(self):
         # PROMPT_COMMAND will be checked.
@@ -424,6 +622,290 @@ class RecentTest(TestBase):
         self.check_with_ts(self.query("cmd --dedup -so"), [("cmd 1", 1), ("cmd 2", 2)])
         self.check_with_ts(self.query("cmd --dedup -fo"), [("cmd 1", 3), ("cmd 2", 4)])
 
+    def test_dedup_uses_command_stats(self):
+        def dedup_query(args):
+            args = self._arg_parser.parse_args(args.split(" "))
+            return recent2.query_builder(args, self._arg_parser.exit,
+                                         fts_filter=recent2.DB.FTS_FILTER)[-1][0]
+
+        self.assertIn('from command_stats', dedup_query("cmd --dedup"))
+        self.assertIn('from command_stats', dedup_query("cmd --dedup -re -nc --return_self"))
+        self.assertNotIn('from command_stats', dedup_query("cmd --dedup -so"))
+        self.assertNotIn('from command_stats', dedup_query("cmd --dedup -w /tmp"))
+        self.assertNotIn('from command_stats', dedup_query("cmd --dedup --env FOO"))
+
+        # Older command logged after a newer one. E.g - via recent-import-bash-history.
+        self.logCmd("cmd 1", time_secs=20, return_value=0, pwd="/new")
+        self.logCmd("cmd 1", time_secs=10, return_value=1, pwd="/old")
+        self.logCmd("cmd 2", time_secs=15)
+        self.check_with_ts(self.query("cmd --dedup"), [("cmd 2", 15), ("cmd 1", 20)])
+        stats = self._keep_alive_conn.execute(
+            """select first_ts, last_ts, run_count, last_return_val, last_pwd
+               from command_stats where command = 'cmd 1'""").fetchone()
+        self.assertEqual((10, 20, 2, 0, "/new"), stats)
+
+    @tests_option("detail")
+    @tests_option("columns")
+    def test_dedup_detail_prints_run_count(self):
+        for i in range(3):
+            self.logCmd("cmd 1")
+        self.logCmd("cmd 2")
+        out = self.query("cmd --dedup --detail --columns command")
+        self.assertEqual(["command_dt", "command", "run_count"], out[0].split())
+        self.assertEqual(["cmd", "1", "3"], out[2].split()[-3:])
+        self.assertEqual(["cmd", "2", "1"], out[3].split()[-3:])
+
+    def test_detail_table_is_streamed(self):
+        for cmd in ["ls", "make all", "ls -la /tmp"]:
+            self.logCmd(cmd)
+        with mock.patch('recent2.RowPrinter.DETAIL_SAMPLE_ROWS', 2):
+            out = self.query("--detail --columns pid")
+        self.assertEqual(["command_dt", "command", "pid", "return_val"], out[0].split())
+        self.assertTrue(out[1].startswith("-------------------  --------  "))
+        self.assertEqual(["ls", str(self._shell_pid), "0"], out[2].split()[-3:])
+        # The sample is aligned. The rows after it use the same widths, even if they do not fit.
+        pid = str(self._shell_pid)
+        self.assertEqual(out[2].index(pid), out[3].index(pid))
+        overflow = len("ls -la /tmp") - len("make all")
+        self.assertEqual(out[2].index(pid) + overflow, out[4].index(pid))
+
+    @tests_option("format")
+    def test_format(self):
+        self.logCmd("cmd1")
+        self.logCmd("fail, with comma", return_value=1)
+        rows = [json.loads(line) for line in self.query("--format ndjson")]
+        self.assertEqual(["cmd1", "fail, with comma"], [r["command"] for r in rows])
+        self.assertEqual([0, 1], [r["return_val"] for r in rows])
+        self.assertIn("env", rows[0]["json_data"])
+        self.assertEqual(rows, json.loads("\n".join(self.query("--format json"))))
+        self.assertEqual([], json.loads("\n".join(self.query("nomatch --format json"))))
+        out = self.query_with_args(["--format", "csv", "--columns", "command"])
+        self.assertEqual(["command_dt,command,return_val", ",cmd1,0", ',"fail, with comma",1'],
+                         [line[line.find(','):] if i else line for i, line in enumerate(out)])
+
+    @tests_option("interactive")
+    def test_interactive(self):
+        self.logCmd("git status", pwd="/repo")
+        self.logCmd("git commit", pwd="/repo")
+        self.logCmd("git status", pwd="/repo")
+        self.logCmd("git push", pwd="/other")
+        searches = []
+
+        def fake_ui(search):
+            searches.append(search)
+            return search.matches()[0]
+
+        with mock.patch('recent2.interactive_ui', side_effect=fake_ui):
+            self.assertEqual(["git status"], self.query("-i -w /repo git"))
+        # -w scopes the candidates, the pattern is the initial query.
+        self.assertEqual("git", searches[0].query)
+        self.assertEqual(["git status", "git commit"], searches[0].matches())
+
+    def test_result_cache(self):
+        os.environ['RECENT_CACHE_DB'] = "/tmp/{}.db".format(uuid.uuid1())
+        try:
+            for cmd in ["cmd1", "cmd2", "cmd3"]:
+                self.logCmd(cmd)
+            self.check_without_ts(self.query("cmd"), ["cmd1", "cmd2", "cmd3"])
+            with mock.patch('recent2.ResultCache.put') as put:
+                self.check_without_ts(self.query("cmd"), ["cmd1", "cmd2", "cmd3"])
+                put.assert_not_called()
+            # Deleting any command (e.g. recent-gc) invalidates the cache. So do new commands.
+            for cmd, expected in [("cmd2", ["cmd1", "cmd3"]), ("cmd1", ["cmd3"])]:
+                self._keep_alive_conn.execute("delete from commands where command = ?", [cmd])
+                self._keep_alive_conn.commit()
+                self.check_without_ts(self.query("cmd"), expected)
+            self.logCmd("cmd4")
+            self.check_without_ts(self.query("cmd"), ["cmd3", "cmd4"])
+            # Nondeterministic -sql patterns are not cached.
+            self.assertIsNone(
+                recent2.ResultCache.open(self._arg_parser.parse_args(["-sql", "random() > 0"])))
+            self.assertIsNotNone(
+                recent2.ResultCache.open(self._arg_parser.parse_args(["-sql", "pid > 0"])))
+            # Least recently used entries are evicted.
+            with mock.patch('recent2.ResultCache.MAX_ENTRIES', 2):
+                for pattern in ["a", "b", "c"]:
+                    self.query(pattern)
+            cache = sqlite3.connect(os.environ['RECENT_CACHE_DB'])
+            self.assertEqual(2, cache.execute("select count(*) from results").fetchone()[0])
+            cache.close()
+        finally:
+            Path(os.environ.pop('RECENT_CACHE_DB')).unlink()
+
+    def test_interactive_search(self):
+        search = recent2.InteractiveSearch([("make test", 1), ("git Commit", 1), ("ls", 1),
+                                            ("git status\n-s", 5), ("git commit -a", 1)])
+        self.assertEqual(5, search.num_matches())
+        # More frequent commands come first.
+        self.assertEqual("git status\n-s", search.matches()[0])
+        search.set_query("git co")
+        self.assertEqual(["git Commit", "git commit -a"], search.matches())
+        # Terms match in any order.
+        search.set_query("co git")
+        self.assertEqual(["git Commit", "git commit -a"], search.matches())
+        search.set_query("co git -")
+        self.assertEqual(["git commit -a"], search.matches())
+        # Backspace reuses the matches computed for the prefix.
+        matches_before = search.stack[-2][1]
+        search.set_query("co git ")
+        self.assertIs(matches_before, search.stack[-1][1])
+        search.set_query("-s")
+        self.assertEqual(["git status\n-s"], search.matches(limit=1))
+
+    @tests_option("startup_report")
+    def test_startup_report(self):
+        out = self.query("--startup-report")
+        self.assertTrue(out[0].startswith('python -c pass: '), out)
+        self.assertEqual(['cumulative', 'self', 'module', '(ms)'], out[1].split())
+        modules = {line.split()[2]: float(line.split()[0]) for line in out[2:]}
+        self.assertIn('recent2', modules)
+        self.assertIn('argparse', modules)
+        # Not needed for plain `recent`.
+        self.assertNotIn('socket', modules)
+        self.assertNotIn('pathlib', modules)
+
+    @tests_option("slow_queries")
+    def test_slow_queries(self):
+        self.logCmd("git status")
+        self.logCmd("ls")
+        self.assertEqual(['recent: no slow queries recorded'], self.query("--slow-queries"))
+        # No query takes 100ms here.
+        self.query("git")
+        self.assertEqual(['recent: no slow queries recorded'], self.query("--slow-queries"))
+
+        with mock.patch.dict(os.environ, {'RECENT_SLOW_QUERY_MS': '0'}):
+            self.query("git -w /root")
+            self.query("git -w /root")
+            self.query("-so")
+        bold, endc = recent2.Term.BOLD, recent2.Term.ENDC
+        out = self.query("--slow-queries")
+        self.assertEqual(2, out.count(bold + 'PLAN:' + endc))
+        self.assertEqual(sorted([bold + 'OPTIONS: ' + endc + 'pattern w',
+                                 bold + 'OPTIONS: ' + endc + 'successes_only']),
+                         sorted(line for line in out if line.startswith(bold + 'OPTIONS')))
+        parameters = [json.loads(line[len(bold + 'PARAMETERS: ' + endc):]) for line in out
+                      if line.startswith(bold + 'PARAMETERS')]
+        # The first parameter is for the trigram index if sqlite has fts5.
+        self.assertEqual(['%git%', '/root', 20], parameters[0][-3:])
+        self.assertEqual(1, len([line for line in self.query("--slow-queries 1")
+                                 if line.startswith(bold + 'OPTIONS')]))
+        rows = self._keep_alive_conn.execute(
+            "select options, row_count, plan from slow_queries order by id").fetchall()
+        # With the trigram index, the newest commands are first scanned without it. They have less
+        # than 20 matches here, so both queries run.
+        pattern_queries = 4 if recent2.fts_filter(self._keep_alive_conn) else 2
+        self.assertEqual(['pattern w'] * pattern_queries + ['successes_only'], [r[0] for r in rows])
+        self.assertEqual([1] * pattern_queries + [2], [r[1] for r in rows])
+        self.assertTrue(all(r[2] for r in rows))
+
+    def test_slow_queries_redact(self):
+        self.logCmd("git status")
+        env = {'RECENT_SLOW_QUERY_MS': '0', 'RECENT_SLOW_QUERY_REDACT': '1'}
+        with mock.patch.dict(os.environ, env):
+            self.query_with_args(["secret", "-w", "/root"])
+            self.query_with_args(["-sql", "command like '%secret%'"])
+        rows = self._keep_alive_conn.execute(
+            "select query, parameters from slow_queries order by id").fetchall()
+        self.assertEqual(['<redacted>', '<redacted>', 20], json.loads(rows[0][1])[-3:])
+        self.assertEqual({'<redacted>', 20}, set(json.loads(rows[0][1])))
+        self.assertNotIn('secret', rows[-1][0])
+        self.assertIn('<redacted>', rows[-1][0])
+
+    def test_slow_queries_disabled(self):
+        self.logCmd("git status")
+        with mock.patch.dict(os.environ, {'RECENT_SLOW_QUERY_MS': '-1'}):
+            self.assertEqual(1, len(self.query("git")))
+        self.assertEqual(['recent: no slow queries recorded'], self.query("--slow-queries"))
+
+    def gc(self, args):
+        with mock.patch('sys.stdout', new=io.StringIO()) as fake_out:
+            recent2.gc_entry_point(args)
+        return fake_out.getvalue().strip()
+
+    @tests_option("archive")
+    def test_archive(self):
+        archive_dir = "/tmp/{}".format(uuid.uuid1())
+        self.addCleanup(shutil.rmtree, archive_dir, True)
+        for cmd in ["ls", "make", "ls", "git", "ls", "make"]:
+            self.logCmd(cmd)
+        with mock.patch.dict(os.environ, {'RECENT_ARCHIVE_DIR': archive_dir}):
+            self.assertEqual("recent-gc: would archive 4 commands",
+                             self.gc(["--max_rows", "2", "--dry_run"]))
+            self.assertIn("recent-gc: archived 4 commands",
+                          self.gc(["--max_rows", "2", "--batch_size", "3"]))
+            self.check_without_ts(self.query(""), ["ls", "make"])
+            self.check_without_ts(self.query("--archive"), ["ls", "make", "ls", "git"])
+            self.check_without_ts(self.query("--archive ma"), ["make"])
+            # Nothing left to archive.
+            self.assertEqual("recent-gc: nothing to archive", self.gc(["--max_rows", "2"]))
+            self.check_without_ts(self.query("--archive"), ["ls", "make", "ls", "git"])
+        conn = self._keep_alive_conn
+        self.assertEqual([("ls", 1), ("make", 1)],
+                         conn.execute("select command, run_count from command_stats "
+                                      "order by command").fetchall())
+        self.check_without_ts(self.query("--dedup"), ["ls", "make"])
+        if recent2.is_interned(conn):
+            self.assertEqual([("ls", ), ("make", )],
+                             conn.execute("select command from command_text "
+                                          "order by command").fetchall())
+
+    def test_gc_max_age(self):
+        archive_dir = "/tmp/{}".format(uuid.uuid1())
+        self.addCleanup(shutil.rmtree, archive_dir, True)
+        now = int(time.time())
+        self.logCmd("two days ago", time_secs=now - 2 * 86400)
+        self.logCmd("yesterday", time_secs=now - 86400 - 60)
+        self.logCmd("today", time_secs=now)
+        self.assertEqual(2, recent2.expired_commands(self._keep_alive_conn, max_age_secs=86400))
+        self.assertEqual(3, recent2.expired_commands(self._keep_alive_conn, max_bytes=1))
+        self.assertEqual(0, recent2.expired_commands(self._keep_alive_conn, max_bytes=1 << 30))
+        self.assertIn("recent-gc: deleted 2 commands", self.gc(["--max_age", "1d", "--no_archive"]))
+        self.check_without_ts(self.query(""), ["today"])
+        with mock.patch.dict(os.environ, {'RECENT_ARCHIVE_DIR': archive_dir}):
+            self.assertEqual([], self.query("--archive"))
+
+    def test_partially_written_archive(self):
+        archive_dir = Path("/tmp/{}".format(uuid.uuid1()))
+        self.addCleanup(shutil.rmtree, archive_dir, True)
+        archive_dir.mkdir()
+        path = archive_dir / "commands-1-2.ndjson.gz"
+        record = {'id': 1, 'ts': 1600000000, 'command': 'cmd1', 'pid': 1, 'return_value': 0,
+                  'pwd': '/', 'session': 's', 'env': {}}
+        recent2.append_to_archive(path, [record])
+        recent2.append_to_archive(path, [dict(record, id=2, command='cmd2')])
+        # The same command archived again by a second (interrupted) recent-gc run.
+        recent2.append_to_archive(path, [record, dict(record, id=3, command='cmd3')])
+        # recent-gc was killed while writing the last batch. Its commands are still in the db.
+        with open(path, 'r+b') as f:
+            f.truncate(path.stat().st_size - 10)
+        with mock.patch.dict(os.environ, {'RECENT_ARCHIVE_DIR': str(archive_dir)}):
+            self.check_without_ts(self.query("--archive"), ["cmd1", "cmd2"])
+
+
+class InternedCommandsTest(RecentTest):
+    # Runs all the tests in RecentTest with the interned command layout.
+    def setUp(self) -> None:
+        os.environ['RECENT_INTERN_COMMANDS'] = '1'
+        super().setUp()
+
+    def tearDown(self) -> None:
+        del os.environ['RECENT_INTERN_COMMANDS']
+        super().tearDown()
+
+    def test_commands_are_interned(self):
+        for cmd in ["ls", "make", "ls", "ls"]:
+            self.logCmd(cmd)
+        conn = self._keep_alive_conn
+        self.assertTrue(recent2.is_interned(conn))
+        self.assertEqual([("ls", ), ("make", )],
+                         conn.execute("select command from command_text order by id").fetchall())
+        self.assertEqual(4, conn.execute("select count(*) from command_runs").fetchone()[0])
+        self.assertEqual(recent2.DB.FTS_FILTER_INTERNED, recent2.fts_filter(conn))
+        # Deleting via the view works.
+        conn.execute("delete from commands where command = 'make'")
+        conn.commit()
+        self.check_without_ts(self.query(""), ["ls", "ls", "ls"])
+
 
 class LogCommandTest(TestBase):
     # log() method will not be tested here because we have enough coverage in RecentTest
@@ -454,6 +936,708 @@ class LogCommandTest(TestBase):
         self.assertEqual(recent2.parse_history(" 12  " + cmd), (12, cmd))
         self.assertEqual(recent2.parse_history("no_number " + cmd), (None, None))
 
+    def test_parse_log_args(self):
+        parser = recent2.make_arg_parser_for_log()
+        for argv in [[], ["-r", "12", "-c", "123 my_cmd", "-p", "1234"],
+                     ["--pid", "1", "--command", "12 ls -c -p", "--return_value", "3"],
+                     ["-c", "123 my_cmd"]]:
+            self.assertEqual(vars(parser.parse_args(argv)), recent2.parse_log_args(argv))
+        # Anything else is handled by argparse.
+        self.assertEqual(recent2.parse_log_args(["-p=5"])['pid'], 5)
+        with mock.patch('sys.stderr', new=io.StringIO()), self.assertRaises(SystemExit):
+            recent2.parse_log_args(["-p", "not_a_pid"])
+
+    def test_session_init(self):
+        with mock.patch('sys.stdout', new=io.StringIO()) as fake_out:
+            recent2.session_init_entry_point(["-p", "1234"])
+        self.assertEqual(fake_out.getvalue().strip(),
+                         "export RECENT_SESSION=1234:" + recent2.Session.session_id_string(1234))
+
+    def test_log_uses_recent_session(self):
+        def log(cmd, sequence, pid=1234):
+            recent2.log_command(command=cmd, pid=pid, sequence=sequence, return_value=0, pwd="/")
+
+        with mock.patch.dict(os.environ, {'RECENT_SESSION': '1234:init_session'}):
+            # The first command of a session and repeated sequence numbers are not logged.
+            log("first", 1)
+            log("second", 2)
+            log("second again", 2)
+            log("third", 3)
+            # RECENT_SESSION was exported by a parent shell.
+            log("subshell", 1, pid=5678)
+            log("subshell", 2, pid=5678)
+            with mock.patch('os.getppid', return_value=1234):
+                self.check_without_ts(self.query("-cs"), ["second", "third"])
+            with mock.patch('os.getppid', return_value=5678):
+                self.check_without_ts(self.query("-cs"), ["subshell"])
+            self.assertEqual(["init_session"], [
+                r[0] for r in self._keep_alive_conn.execute(
+                    "select distinct session from commands where command != 'subshell'")
+            ])
+            # RECENT_SESSION is not part of the env snapshot.
+            self.assertEqual(
+                1,
+                self._keep_alive_conn.execute(
+                    "select count(distinct env_id) from commands").fetchone()[0])
+
+
+class ProfileTest(TestBase):
+    def log(self, sequence):
+        recent2.log(["-r", "0", "-c", " {} cmd{}".format(sequence, sequence), "-p",
+                     str(self._shell_pid)])
+
+    @tests_option("profile")
+    def test_profile_to_stderr(self):
+        with mock.patch.dict(os.environ, {'RECENT_PROFILE': 'stderr'}), \
+                mock.patch('sys.stderr', new=io.StringIO()) as fake_err:
+            self.log(1)
+        line = fake_err.getvalue()
+        self.assertTrue(line.startswith('log-recent profile: '), line)
+        for phase in ['parse_args', 'envvars_to_log', 'connect', 'session_update', 'insert',
+                      'commit', 'total']:
+            self.assertIn(' {}='.format(phase), line)
+        self.assertFalse(recent2.PROFILE.enabled)
+
+        with mock.patch('sys.argv', ['recent', '--profile']), \
+                mock.patch('sys.stdout', new=io.StringIO()) as fake_out, \
+                mock.patch('sys.stderr', new=io.StringIO()) as fake_err:
+            recent2.main()
+        self.assertIn('cmd1', fake_out.getvalue())
+        line = fake_err.getvalue()
+        self.assertTrue(line.startswith('recent profile: '), line)
+        for phase in ['connect', 'query', 'output', 'total']:
+            self.assertIn(' {}='.format(phase), line)
+
+    def test_profile_off_values(self):
+        for value in ['0', 'false', 'False', 'off', '', ' ']:
+            profile = recent2.Profile()
+            with mock.patch.dict(os.environ, {'RECENT_PROFILE': value}):
+                profile.enable('recent')
+            self.assertFalse(profile.enabled, value)
+        with mock.patch.dict(os.environ, {'RECENT_PROFILE': 'yes'}):
+            profile.enable('recent')
+        self.assertEqual('yes', profile.destination)
+
+    def test_phases_exclude_inner_phases(self):
+        profile = recent2.Profile()
+        profile.enable('recent', to_stderr=True)
+        with mock.patch('time.monotonic', side_effect=[10, 11, 14, 20, 26, 30]):
+            with profile.phase('outer'):
+                with profile.phase('inner'):
+                    pass
+            list(profile.timed_iter('outer', []))
+        self.assertEqual(profile.phases['inner'], 3)
+        self.assertEqual(profile.phases['outer'], 7 + 4)
+
+    @tests_option("perf_report")
+    def test_perf_report(self):
+        self.assertEqual(['recent: no timings recorded. Set RECENT_PROFILE=1 to record them'],
+                         self.query("--perf-report"))
+        with mock.patch.dict(os.environ, {'RECENT_PROFILE': '1'}):
+            for sequence in range(1, 4):
+                self.log(sequence)
+        report = [line.split() for line in self.query("--perf-report")]
+        self.assertEqual(['program', 'phase', 'runs', 'p50_ms', 'p95_ms', 'p99_ms', 'max_ms'],
+                         report[0])
+        runs = {row[1]: int(row[2]) for row in report[1:] if row[0] == 'log-recent'}
+        self.assertEqual(3, runs['insert'])
+        self.assertEqual(3, runs['total'])
+        report = [line.split() for line in self.query("--perf-report 2")]
+        self.assertEqual(2, {row[1]: int(row[2]) for row in report[1:]}['total'])
+
+
+class ConcurrentWriteTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.db_file = "/tmp/{}.db".format(uuid.uuid1())
+        os.environ['RECENT_DB'] = self.db_file
+        os.environ['PROMPT_COMMAND'] = recent2.EXPECTED_PROMPT
+        os.environ['RECENT_DAEMON_SOCKET'] = "/tmp/{}.sock".format(uuid.uuid1())
+
+    def tearDown(self) -> None:
+        for suffix in ("", "-wal", "-shm"):
+            Path(self.db_file + suffix).unlink(missing_ok=True)
+
+    def connect(self):
+        with mock.patch('sys.stdout', new=io.StringIO()):
+            return recent2.create_connection()
+
+    def test_wal_is_enabled(self):
+        conn = self.connect()
+        self.assertEqual("wal", conn.execute("pragma journal_mode").fetchone()[0])
+        conn.close()
+
+    def test_journal_mode_can_be_overridden(self):
+        os.environ['RECENT_JOURNAL_MODE'] = 'delete'
+        conn = self.connect()
+        self.assertEqual("delete", conn.execute("pragma journal_mode").fetchone()[0])
+        conn.close()
+        del os.environ['RECENT_JOURNAL_MODE']
+
+    def test_concurrent_shells(self):
+        self.connect().close()
+
+        def shell(pid):
+            # The first command of a session is not logged.
+            for i in range(21):
+                recent2.log_command(command="cmd", pid=pid, sequence=i, return_value=0, pwd="/")
+
+        threads = [threading.Thread(target=shell, args=(pid, )) for pid in range(1, 9)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        conn = self.connect()
+        self.assertEqual(8 * 20, conn.execute("select count(*) from commands").fetchone()[0])
+        self.assertEqual(8, conn.execute("select count(*) from sessions").fetchone()[0])
+        conn.close()
+
+    def test_write_with_retry(self):
+        conn = self.connect()
+        write = mock.Mock(side_effect=[sqlite3.OperationalError("database is locked"), None])
+        with mock.patch('time.sleep') as sleep:
+            recent2.write_with_retry(conn, write)
+        self.assertEqual(2, write.call_count)
+        self.assertEqual(1, sleep.call_count)
+        self.assertFalse(conn.in_transaction)
+
+        # Gives up after WRITE_ATTEMPTS.
+        write = mock.Mock(side_effect=sqlite3.OperationalError("database is locked"))
+        with mock.patch('time.sleep'), self.assertRaises(sqlite3.OperationalError):
+            recent2.write_with_retry(conn, write)
+        self.assertEqual(recent2.WRITE_ATTEMPTS, write.call_count)
+
+        # Other errors are not retried.
+        write = mock.Mock(side_effect=sqlite3.OperationalError("no such table: foo"))
+        with self.assertRaises(sqlite3.OperationalError):
+            recent2.write_with_retry(conn, write)
+        self.assertEqual(1, write.call_count)
+        conn.close()
+
+    def test_queries_use_read_only_connection(self):
+        # The db does not exist yet.
+        conn = self.connect_read_only()
+        conn.execute("select 1 from commands").fetchall()
+        conn.close()
+        conn = self.connect_read_only()
+        with self.assertRaises(sqlite3.OperationalError) as cm:
+            conn.execute("delete from commands")
+        self.assertIn("readonly", str(cm.exception))
+        conn.close()
+
+        # A db that needs a migration is opened read-write.
+        conn = sqlite3.connect(self.db_file)
+        conn.execute(recent2.DB.UPDATE_SCHEMA_VERSION + str(recent2.DB.SCHEMA_VERSION - 1))
+        conn.commit()
+        with mock.patch('recent2.migrate') as migrate:
+            self.connect_read_only().close()
+            self.assertEqual(1, migrate.call_count)
+        conn.execute(recent2.DB.UPDATE_SCHEMA_VERSION + str(recent2.DB.SCHEMA_VERSION))
+        conn.commit()
+        conn.close()
+
+        with mock.patch('sys.stdout', new=io.StringIO()) as fake_out:
+            recent2.log_command(command="cmd", pid=1, sequence=1, return_value=0, pwd="/")
+            recent2.log_command(command="cmd2", pid=1, sequence=2, return_value=0, pwd="/")
+            parser = recent2.make_arg_parser_for_recent()
+            recent2.handle_recent_command(parser.parse_args([]), parser.exit)
+        self.assertIn("cmd2", fake_out.getvalue())
+
+    def connect_read_only(self):
+        with mock.patch('sys.stdout', new=io.StringIO()):
+            return recent2.create_connection(read_only=True)
+
+
+class LogDaemonTest(TestBase):
+    def setUp(self) -> None:
+        super().setUp()
+        self.socket_path = os.environ['RECENT_DAEMON_SOCKET']
+        self.daemon = recent2.LogDaemon(self.socket_path, batch_window_secs=0.01)
+        self.server_thread = threading.Thread(target=self.daemon.serve_forever)
+        self.server_thread.start()
+
+    def tearDown(self) -> None:
+        self.daemon.shutdown()
+        self.server_thread.join()
+        super().tearDown()
+
+    def logCmd(self, cmd, sequence):
+        self._time_secs += 1
+        with mock.patch('time.time', return_value=self._time_secs):
+            recent2.log_command(command=cmd,
+                                pid=self._shell_pid,
+                                sequence=sequence,
+                                return_value=0,
+                                pwd="/root")
+
+    def wait_for_commands(self, expected):
+        deadline = time.time() + 5
+        while time.time() < deadline:
+            self.daemon.flush()
+            result = self.query("--hide_time")
+            if result == expected:
+                return
+            time.sleep(0.01)
+        self.assertEqual(expected, result)
+
+    def test_log_via_daemon(self):
+        with mock.patch('recent2.write_command', wraps=recent2.write_command) as write_command:
+            self.logCmd("cmd1", 1)
+            self.logCmd("cmd2", 2)
+            # Same sequence number again => empty prompt. Will not be logged.
+            self.logCmd("cmd2", 2)
+            self.wait_for_commands(["cmd1", "cmd2"])
+            # All the writes happened in the daemon's writer thread.
+            self.assertEqual(3, write_command.call_count)
+
+    def test_bad_records_are_dropped(self):
+        with mock.patch('sys.stderr', new=io.StringIO()) as fake_err:
+            self.daemon.enqueue(b'not json\n')
+            self.daemon.enqueue(b'{"command": "no other keys"}\n')
+        self.assertEqual(2, fake_err.getvalue().count('dropping bad record'))
+        self.logCmd("good cmd", 1)
+        self.wait_for_commands(["good cmd"])
+
+    def test_malformed_records_are_dropped(self):
+        record = {'command': 'bad cmd', 'pid': self._shell_pid, 'sequence': 1,
+                  'return_value': 0, 'pwd': '/root', 'ts': self._time_secs}
+        bad_records = [[], 5, dict(record, env='not a dict'), dict(record, pid='1'),
+                       dict(record, command=None), dict(record, env={'A': 1})]
+        with mock.patch('sys.stderr', new=io.StringIO()) as fake_err:
+            for bad_record in bad_records:
+                self.daemon.enqueue(json.dumps(bad_record).encode('utf-8'))
+        self.assertEqual(len(bad_records), fake_err.getvalue().count('dropping bad record'))
+        # The writer thread survives records that fail to write, and writes the ones after them.
+        with mock.patch('sys.stderr', new=io.StringIO()) as fake_err:
+            self.daemon.queue.put(dict(record, env='not a dict'))
+            self.logCmd("good cmd", 2)
+            self.wait_for_commands(["good cmd"])
+        self.assertIn('dropping record', fake_err.getvalue())
+        self.assertTrue(self.daemon.writer.is_alive())
+
+    def test_writer_survives_failed_shard_rotation(self):
+        # The shard dir can not be created: its parent is a file.
+        not_a_dir = "/tmp/{}".format(uuid.uuid1())
+        Path(not_a_dir).touch()
+        try:
+            with mock.patch.dict(os.environ, {'RECENT_SHARD_DIR': not_a_dir + '/shards'}), \
+                    mock.patch('sys.stderr', new=io.StringIO()) as fake_err:
+                # Old enough to be moved to a shard.
+                self._time_secs -= 60 * 86400
+                self.logCmd("old cmd", 1)
+                self.wait_for_commands(["old cmd"])
+                self._time_secs += 60 * 86400
+                self.logCmd("new cmd", 2)
+                self.wait_for_commands(["old cmd", "new cmd"])
+            self.assertIn('failed to move old commands', fake_err.getvalue())
+            self.assertTrue(self.daemon.writer.is_alive())
+        finally:
+            Path(not_a_dir).unlink()
+
+    def test_fallback_when_daemon_not_running(self):
+        self.daemon.shutdown()
+        self.server_thread.join()
+        # Stale socket file left behind by a daemon that died.
+        Path(self.socket_path).touch()
+        self.logCmd("direct cmd", 1)
+        self.assertEqual(["direct cmd"], self.query("--hide_time"))
+        # Restart so that tearDown has something to stop.
+        os.unlink(self.socket_path)
+        self.daemon = recent2.LogDaemon(self.socket_path)
+        self.server_thread = threading.Thread(target=self.daemon.serve_forever)
+        self.server_thread.start()
+
+
+class ShardTest(TestBase):
+    def setUp(self) -> None:
+        super().setUp()
+        self.shard_dir = "/tmp/{}".format(uuid.uuid1())
+        os.environ['RECENT_SHARD_DIR'] = self.shard_dir
+        self._now = int(time.time())
+
+    def tearDown(self) -> None:
+        del os.environ['RECENT_SHARD_DIR']
+        shutil.rmtree(self.shard_dir, ignore_errors=True)
+        super().tearDown()
+
+    def logCmd(self, cmd, days_ago=0):
+        self._sequence += 1
+        self._now += 1
+        with mock.patch('time.time', return_value=self._now - days_ago * 86400):
+            recent2.log_command(command=cmd,
+                                pid=self._shell_pid,
+                                sequence=self._sequence,
+                                return_value=0,
+                                pwd="/root")
+
+    def log_history(self):
+        # 40 days apart, so each of them is in a month of its own.
+        with mock.patch.dict(os.environ, {'RECENT_ENV_VARS': 'SHELL_NAME', 'SHELL_NAME': 'old'}):
+            self.logCmd("make", days_ago=80)
+            self.logCmd("ls", days_ago=80)
+            self.logCmd("make", days_ago=40)
+        self.logCmd("git", days_ago=40)
+        self.logCmd("ls")
+        self.logCmd("make")
+        # Each write moves one batch of the oldest month.
+        while recent2.rotate_shards(self._keep_alive_conn):
+            pass
+
+    def shard_opens(self, args):
+        with mock.patch('recent2.create_connection', wraps=recent2.create_connection) as connect:
+            self.query(args)
+        return len([call for call in connect.call_args_list if call.kwargs.get('path')])
+
+    def test_commands_are_moved_to_shards(self):
+        self.log_history()
+        conn = self._keep_alive_conn
+        self.assertEqual([("ls", ), ("make", )],
+                         conn.execute("select command from commands order by id").fetchall())
+        self.assertEqual([("ls", 1), ("make", 1)],
+                         conn.execute("select command, run_count from command_stats "
+                                      "order by command").fetchall())
+        self.assertEqual(2, len(os.listdir(self.shard_dir)))
+        oldest = recent2.create_connection(path=recent2.shard_path(self.shard_dir,
+                                                                   self._now - 80 * 86400))
+        self.assertEqual([("make", ), ("ls", )],
+                         oldest.execute("select command from commands order by id").fetchall())
+        oldest.close()
+        self.assertEqual(0, recent2.rotate_shards(conn))
+
+    def test_query_reads_shards_newest_first(self):
+        self.log_history()
+        self.check_without_ts(self.query(""), ["make", "ls", "make", "git", "ls", "make"])
+        self.check_without_ts(self.query("-n 3"), ["git", "ls", "make"])
+        self.check_without_ts(self.query("ma"), ["make", "make", "make"])
+        self.check_without_ts(self.query("--env SHELL_NAME:old"), ["make", "ls", "make"])
+        # Only the main db is needed for the newest 2 commands.
+        self.assertEqual(0, self.shard_opens("-n 2"))
+        self.assertEqual(1, self.shard_opens("-n 3"))
+        self.assertEqual(2, self.shard_opens("-n 5"))
+        self.assertEqual(1, self.shard_opens("--since 60d"))
+        self.check_without_ts(self.query("--since 60d"), ["make", "git", "ls", "make"])
+
+    def test_dedup_adds_up_run_counts(self):
+        self.log_history()
+        self.assertEqual(['git 1', 'ls 2', 'make 3'], [
+            ' '.join(line.split()[2:4]) for line in self.query("--dedup --detail")[2:]
+        ])
+        self.check_without_ts(self.query("--dedup -n 2"), ["ls", "make"])
+
+    def test_interactive_and_explain_read_shards(self):
+        self.log_history()
+        with mock.patch('recent2.interactive_ui', return_value=None), \
+                mock.patch('recent2.InteractiveSearch', wraps=recent2.InteractiveSearch) as search:
+            self.query("-i")
+        # Most recent first, with the run counts of all the dbs.
+        self.assertEqual([("make", 3), ("ls", 2), ("git", 1)], search.call_args[0][0])
+        out = self.query("--explain")
+        self.assertEqual(2, len([line for line in out if line.startswith(
+            recent2.Term.BOLD + 'DB: ' + recent2.Term.ENDC + self.shard_dir)]))
+
+    def test_slow_query_plans_are_taken_on_the_shards(self):
+        self.log_history()
+        dbs, query_plan = [], recent2.query_plan
+
+        def plan_and_record_db(conn, query, parameters):
+            # The shard conns are closed by the time the query returns.
+            dbs.append(conn.execute('pragma database_list').fetchone()[2])
+            return query_plan(conn, query, parameters)
+
+        with mock.patch.dict(os.environ, {'RECENT_SLOW_QUERY_MS': '0'}), \
+                mock.patch('recent2.query_plan', side_effect=plan_and_record_db):
+            self.check_without_ts(self.query(""), ["make", "ls", "make", "git", "ls", "make"])
+        self.assertEqual(2, len([db for db in dbs if db.startswith(self.shard_dir)]))
+        self.assertEqual(len(dbs), self._keep_alive_conn.execute(
+            "select count(*) from slow_queries where plan != ''").fetchone()[0])
+
+    def test_failed_slow_query_plan(self):
+        self.log_history()
+        with mock.patch.dict(os.environ, {'RECENT_SLOW_QUERY_MS': '0'}), \
+                mock.patch('recent2.query_plan', side_effect=sqlite3.OperationalError('no plan')):
+            self.check_without_ts(self.query("-n 2"), ["ls", "make"])
+        self.assertEqual([("failed to explain the query: OperationalError('no plan')", )],
+                         self._keep_alive_conn.execute(
+                             "select plan from slow_queries").fetchall())
+
+
+class InternedShardTest(ShardTest):
+    def setUp(self) -> None:
+        os.environ['RECENT_INTERN_COMMANDS'] = '1'
+        super().setUp()
+
+    def tearDown(self) -> None:
+        del os.environ['RECENT_INTERN_COMMANDS']
+        super().tearDown()
+
+
+class HostDbTest(TestBase):
+    def setUp(self) -> None:
+        self.host_db_dir = "/tmp/{}".format(uuid.uuid1())
+        os.environ['RECENT_HOST_DB_DIR'] = self.host_db_dir
+        super().setUp()
+
+    def tearDown(self) -> None:
+        del os.environ['RECENT_HOST_DB_DIR']
+        super().tearDown()
+        shutil.rmtree(self.host_db_dir, ignore_errors=True)
+
+    def logCmd(self, cmd, host=None, secs_ago=0):
+        self._sequence += 1
+        uname = os.uname()
+        if host:
+            uname = mock.Mock(nodename=host)
+        with mock.patch('time.time', return_value=self._time_secs - secs_ago), \
+                mock.patch('os.uname', return_value=uname):
+            recent2.log_command(command=cmd,
+                                pid=self._shell_pid,
+                                sequence=self._sequence,
+                                return_value=0,
+                                pwd="/root")
+
+    def db_opens(self, args):
+        with mock.patch('recent2.connect_read_only', wraps=recent2.connect_read_only) as connect:
+            self.query(args)
+        return len([call for call in connect.call_args_list if call.kwargs.get('any_layout')])
+
+    def test_hosts_write_their_own_db(self):
+        self.logCmd("first command of the session is not logged", host="host2")
+        self.logCmd("cmd1", host="host2")
+        self.logCmd("cmd2")
+        self.assertEqual(sorted([os.uname().nodename + '.db', 'host2.db']),
+                         sorted(os.listdir(self.host_db_dir)))
+        self.assertEqual("delete",
+                         self._keep_alive_conn.execute("pragma journal_mode").fetchone()[0])
+        self.assertEqual([("cmd2", )],
+                         self._keep_alive_conn.execute("select command from commands").fetchall())
+
+    def test_query_merges_hosts_by_time(self):
+        for host in ["host2", "host3"]:
+            self.logCmd("first command of the session is not logged", host=host)
+        self.logCmd("host3 old", host="host3", secs_ago=2 * 86400)
+        self.logCmd("cmd1", secs_ago=40)
+        self.logCmd("host2 cmd2", host="host2", secs_ago=30)
+        self.logCmd("cmd3", secs_ago=20)
+        self.logCmd("host2 cmd4", host="host2", secs_ago=10)
+        self.check_without_ts(self.query(""),
+                              ["host3 old", "cmd1", "host2 cmd2", "cmd3", "host2 cmd4"])
+        self.check_without_ts(self.query("-n 3"), ["host2 cmd2", "cmd3", "host2 cmd4"])
+        self.check_without_ts(self.query("--dedup host"), ["host3 old", "host2 cmd2",
+                                                           "host2 cmd4"])
+        # host3 has not logged anything for a day. The newest commands can not be in its db.
+        host3_db = os.path.join(self.host_db_dir, "host3.db")
+        os.utime(host3_db, (time.time() - 86400, time.time() - 86400))
+        self.assertEqual(1, self.db_opens("-n 3"))
+        self.assertEqual(2, self.db_opens("-n 5"))
+        # So do recent -i and --explain.
+        with mock.patch('recent2.interactive_ui', return_value=None) as ui:
+            self.query("-i host")
+        self.assertEqual(["host2 cmd4", "host2 cmd2", "host3 old"], ui.call_args[0][0].matches())
+        self.assertIn(recent2.Term.BOLD + 'DB: ' + recent2.Term.ENDC + host3_db,
+                      self.query("--explain"))
+
+    def test_other_host_dbs_are_not_written(self):
+        self.logCmd("cmd1")
+        self.logCmd("cmd2")
+        contents = {}
+        for host, version in [("host2", recent2.DB.SCHEMA_VERSION - 1),
+                              ("host3", recent2.DB.SCHEMA_VERSION + 1)]:
+            path = os.path.join(self.host_db_dir, host + ".db")
+            conn = recent2.create_connection(path=path)
+            conn.execute(recent2.DB.UPDATE_SCHEMA_VERSION + str(version))
+            conn.commit()
+            conn.close()
+            contents[path] = Path(path).read_bytes()
+        with mock.patch('sys.stderr', new=io.StringIO()) as fake_err:
+            self.check_without_ts(self.query(""), ["cmd1", "cmd2"])
+        self.assertEqual(2, fake_err.getvalue().count("It was written by a different version"))
+        for path, content in contents.items():
+            self.assertEqual(content, Path(path).read_bytes())
+        self.assertEqual(sorted([os.uname().nodename + '.db', 'host2.db', 'host3.db']),
+                         sorted(os.listdir(self.host_db_dir)))
+
+
+class SpoolTest(TestBase):
+    def setUp(self) -> None:
+        super().setUp()
+        self.spool_dir = "/tmp/{}".format(uuid.uuid1())
+        os.environ['RECENT_SPOOL_DIR'] = self.spool_dir
+
+    def tearDown(self) -> None:
+        del os.environ['RECENT_SPOOL_DIR']
+        shutil.rmtree(self.spool_dir, ignore_errors=True)
+        super().tearDown()
+
+    def logCmd(self, cmd, sequence):
+        self._time_secs += 1
+        with mock.patch('time.time', return_value=self._time_secs):
+            recent2.log_command(command=cmd,
+                                pid=self._shell_pid,
+                                sequence=sequence,
+                                return_value=0,
+                                pwd="/root")
+
+    def num_rows_in_db(self):
+        return self._keep_alive_conn.execute("select count(*) from commands").fetchone()[0]
+
+    def test_spooled_commands_are_visible_to_queries(self):
+        self.logCmd("cmd1", 1)
+        self.logCmd("cmd2", 2)
+        # Same sequence number again => empty prompt. Will not be logged.
+        self.logCmd("cmd2", 2)
+        self.assertEqual(0, self.num_rows_in_db())
+        spool_files = list(Path(self.spool_dir).iterdir())
+        self.assertEqual(1, len(spool_files))
+        self.assertEqual(3, len(spool_files[0].read_text().splitlines()))
+
+        self.assertEqual(["cmd1", "cmd2"], self.query("--hide_time"))
+        self.assertEqual(2, self.num_rows_in_db())
+        self.assertEqual("", spool_files[0].read_text())
+
+    @tests_option("compact")
+    def test_compact(self):
+        self.logCmd("cmd1", 1)
+        self.logCmd("cmd2", 2)
+        self.assertEqual(["recent: wrote 2 spooled commands"], self.query("--compact"))
+        self.assertEqual(2, self.num_rows_in_db())
+        self.assertEqual(["recent: wrote 0 spooled commands"], self.query("--compact"))
+
+    def test_partial_record_is_skipped(self):
+        self.logCmd("cmd1", 1)
+        spool_file = next(Path(self.spool_dir).iterdir())
+        with open(spool_file, "a") as f:
+            f.write('{"command": "cut sh')
+        self.assertEqual(["cmd1"], self.query("--hide_time"))
+
+
+class MigrationTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.db_file = "/tmp/{}.db".format(uuid.uuid1())
+        os.environ['RECENT_DB'] = self.db_file
+
+    def tearDown(self) -> None:
+        Path(self.db_file).unlink()
+
+    def make_v2_db(self, commands):
+        conn = sqlite3.connect(self.db_file)
+        conn.execute(recent2.DB.CREATE_COMMANDS_TABLE)
+        conn.execute(recent2.DB.CREATE_SESSIONS_TABLE)
+        conn.execute(recent2.DB.CREATE_DATE_INDEX)
+        for i, cmd in enumerate(commands):
+            conn.execute(
+                "insert into commands values (datetime(?, 'unixepoch'), ?, 1, 0, '/', 's', null)",
+                [1600000000 + i, cmd])
+        conn.execute(recent2.DB.UPDATE_SCHEMA_VERSION + "2")
+        conn.commit()
+        conn.close()
+
+    def connect(self):
+        with mock.patch('sys.stdout', new=io.StringIO()):
+            return recent2.create_connection()
+
+    def test_migrate_2_3_backfills_trigram_index(self):
+        self.make_v2_db(["git status", "git commit", "make"])
+        conn = self.connect()
+        self.assertEqual(recent2.DB.SCHEMA_VERSION,
+                         conn.execute(recent2.DB.GET_SCHEMA_VERSION).fetchone()[0])
+        rows = conn.execute(
+            "select command from commands_fts where commands_fts match '\"git\"' order by rowid")
+        self.assertEqual(["git status", "git commit"], [r[0] for r in rows])
+        # New rows are indexed by the triggers.
+        conn.execute("insert into commands (command) values ('git push')")
+        rows = conn.execute("select count(*) from commands_fts where commands_fts match 'git'")
+        self.assertEqual(3, rows.fetchone()[0])
+        conn.close()
+
+    def test_migrate_3_4_backfills_command_stats(self):
+        self.make_v2_db(["git status", "make", "git status", "make"])
+        conn = self.connect()
+        rows = conn.execute("""select command, first_ts, last_ts, run_count
+                               from command_stats order by command""").fetchall()
+        self.assertEqual([("git status", 1600000000, 1600000002, 2),
+                          ("make", 1600000001, 1600000003, 2)], rows)
+        conn.close()
+
+    def test_migrate_5_6_converts_to_epoch(self):
+        self.make_v2_db(["git status", "make"])
+        conn = self.connect()
+        rows = conn.execute("select id, command_ts, command_dt, command from commands")
+        self.assertEqual([(1, 1600000000, "2020-09-13 12:26:40", "git status"),
+                          (2, 1600000001, "2020-09-13 12:26:41", "make")], rows.fetchall())
+        rows = conn.execute(
+            "select rowid, command from commands_fts where commands_fts match 'make'")
+        self.assertEqual([(2, "make")], rows.fetchall())
+        conn.close()
+
+    def test_migrate_12_13_counts_inserts_and_deletes(self):
+        self.make_v2_db(["a", "b"])
+        conn = self.connect()
+
+        def generation():
+            return conn.execute(recent2.DB.GET_COMMANDS_GENERATION).fetchone()[0]
+
+        start = generation()
+        conn.execute("delete from commands where command = 'a'")
+        self.assertEqual(start + 1, generation())
+        conn.execute(recent2.DB.INSERT_ROW_NO_JSON, [1600000005, "c", 1, 0, "/", "s"])
+        self.assertEqual(start + 2, generation())
+        conn.commit()
+        conn.close()
+
+    def test_old_sqlite_is_rejected(self):
+        self.make_v2_db(["make"])
+        with mock.patch('sqlite3.sqlite_version_info', (3, 30, 1)), \
+                mock.patch('sqlite3.sqlite_version', '3.30.1'), \
+                self.assertRaises(SystemExit) as cm:
+            self.connect()
+        self.assertIn('recent needs sqlite >= 3.31.0, but python is using sqlite 3.30.1',
+                      str(cm.exception.code))
+        # The db was not migrated.
+        conn = sqlite3.connect(self.db_file)
+        self.assertEqual(2, recent2.schema_version(conn))
+        conn.close()
+
+    def test_migrate_6_7_moves_env_to_snapshots(self):
+        self.make_v2_db(["a", "b", "c"])
+        conn = sqlite3.connect(self.db_file)
+        conn.execute("update commands set json_data = json('{\"env\": {\"K\": \"1\"}}')")
+        conn.execute("update commands set json_data = null where command = 'c'")
+        conn.commit()
+        conn.close()
+        conn = self.connect()
+        self.assertEqual([("a", 1), ("b", 1), ("c", None)],
+                         conn.execute("select command, env_id from commands").fetchall())
+        self.assertEqual(0, conn.execute(
+            "select count(*) from commands where json_data is not null").fetchone()[0])
+        self.assertEqual([(1, "K", "1")],
+                         conn.execute("select * from env_snapshot_vars").fetchall())
+        conn.close()
+
+    def test_migrate_8_9_backfills_snapshots(self):
+        self.make_v2_db(["cmd{}".format(i) for i in range(600)] + ["recent -n 5", "x" * 500])
+        conn = self.connect()
+        rows = conn.execute("select min(id), max(id), count(*) from recent_snapshot").fetchone()
+        self.assertEqual((101, 600, recent2.DB.SNAPSHOT_ROWS), rows)
+        rows = conn.execute("select min(id), count(*) from recent_session_snapshot").fetchone()
+        self.assertEqual((401, recent2.DB.SESSION_SNAPSHOT_ROWS), rows)
+        conn.close()
+
+    def test_same_second_commands_are_ordered_by_insertion(self):
+        os.environ['PROMPT_COMMAND'] = recent2.EXPECTED_PROMPT
+        self.make_v2_db([])
+        self.connect().close()
+        with mock.patch('time.time', return_value=1600000000):
+            for i, cmd in enumerate(["b", "a", "c", "a"]):
+                recent2.log_command(command=cmd, pid=1, sequence=i + 1, return_value=0, pwd="/")
+        parser = recent2.make_arg_parser_for_recent()
+        for _ in range(3):
+            with mock.patch('sys.stdout', new=io.StringIO()) as out:
+                recent2.handle_recent_command(parser.parse_args(["-ht", "-n", "2"]), parser.exit)
+            # First command initializes the session and is not logged.
+            self.assertEqual(["c", "a"], out.getvalue().split())
+            with mock.patch('sys.stdout', new=io.StringIO()) as out:
+                recent2.handle_recent_command(parser.parse_args(["-ht", "--dedup"]), parser.exit)
+            self.assertEqual(["c", "a"], out.getvalue().split())
+
 
 class ImportBashHistory(TestBase):
     def setUp(self) -> None:
@@ -499,10 +1683,12 @@ class ImportBashHistory(TestBase):
         # Check that we actually imported history
         # Note:
         # - we are not testing timestamps.
-        # - we are checking for cmd3 before cmd2 because cmd3 will get cmd2's timestamp and
-        #   sqlite returns latest inserted item first.
-        self.check_without_ts(self.query(""), ["cmd1", "cmd3", "cmd2", "cmd4"])
-        self.assertTrue(Path(self.import_marker).exists())
+        # - cmd3 gets cmd2's timestamp. Commands with the same timestamp are returned in
+        #   insertion order.
+        self.check_without_ts(self.query(""), ["cmd1", "cmd2", "cmd3", "cmd4"])
+        # Nothing new to import.
+        self.assertIn("imported 0 commands", self.import_history())
+        self.check_without_ts(self.query(""), ["cmd1", "cmd2", "cmd3", "cmd4"])
 
     def test_import(self):
         # Expected case.
@@ -514,6 +1700,41 @@ class ImportBashHistory(TestBase):
         Path(self.import_marker).touch()
         self.helper_for_test_import(["-f"])
 
+    def test_import_resumes(self):
+        Path(self.history_file).write_text("#1571012545\ncmd1\n#1571012546\ncmd2\n")
+        self.import_history()
+        with open(self.history_file, "a") as f:
+            f.write("cmd3\n#1571012547\ncmd4\n")
+        self.assertIn("imported 2 commands", self.import_history())
+        self.check_without_ts(self.query(""), ["cmd1", "cmd2", "cmd3", "cmd4"])
+        # -f imports all of it again.
+        self.assertIn("imported 4 commands", self.import_history(args=["-f"]))
+
+    def test_import_rewritten_history(self):
+        Path(self.history_file).write_text("#1571012545\ncmd1\n#1571012546\ncmd2\n")
+        self.import_history()
+        Path(self.history_file).write_text("#1571012545\ncmd3\n#1571012546\ncmd4\ncmd5\n")
+        with self.assertRaises(SystemExit):
+            self.import_history()
+        self.check_without_ts(self.query(""), ["cmd1", "cmd2"])
+
+    def test_import_in_chunks(self):
+        lines = ["cmd{}".format(i) for i in range(5)] + ["#1571012545"]
+        lines += ["cmd{}".format(i) for i in range(5, 10)]
+        Path(self.history_file).write_text("\n".join(lines))
+        with mock.patch('recent2.IMPORT_CHUNK_SIZE', 3):
+            self.assertIn("imported 10 commands", self.import_history())
+        self.check_without_ts(self.query(""), ["cmd{}".format(i) for i in range(10)])
+
+    def test_parse_bash_history(self):
+        f = io.BytesIO(b"ls /\n#1571012545\necho foo\n#1571012560\n#useless comment\ncat bar")
+        self.assertEqual([(1571012545, "ls /", 5), (1571012545, "echo foo", 26),
+                          (1571012560, "cat bar", 62)], list(recent2.parse_bash_history(f)))
+        # Commands without any timestamp.
+        f = io.BytesIO(b"ls\npwd\n")
+        with mock.patch('recent2.IMPORT_CHUNK_SIZE', 1):
+            self.assertEqual([(-1, "ls", 3), (-1, "pwd", 7)], list(recent2.parse_bash_history(f)))
+
     def test_import_marker_exists(self):
         # Import marker exists. So import will fail.
         Path(self.import_marker).touch()
@@ -522,5 +1743,75 @@ class ImportBashHistory(TestBase):
         self.assertTrue('Bash history already imported' in stdout)
 
 
+class ImportHistoryTest(TestBase):
+    def setUp(self) -> None:
+        super().setUp()
+        self.hosts_dir = Path("/tmp/{}".format(uuid.uuid1()))
+        for host, name, content in [
+            ("host1", ".bash_history", "#1571012545\nbash1\n#1571012547\nbash2\n"),
+            ("host2", ".zsh_history", ": 1571012546:0;zsh1\n: 1571012548:0;zsh2\n"),
+            ("host3", "fish_history", "- cmd: fish1\n  when: 1571012549\n  paths:\n    - a\n"),
+            ("host3", "notes.txt", "not a history file\n"),
+        ]:
+            (self.hosts_dir / host).mkdir(parents=True, exist_ok=True)
+            (self.hosts_dir / host / name).write_text(content)
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self.hosts_dir)
+        super().tearDown()
+
+    def import_history(self, args):
+        with mock.patch('sys.stdout', new=io.StringIO()) as fake_out:
+            recent2.import_history_entry_point(args)
+        return fake_out.getvalue()
+
+    def test_import_directory(self):
+        out = self.import_history([str(self.hosts_dir), "-j", "2"])
+        self.assertIn("imported 5 commands from 3 files", out)
+        self.check_without_ts(self.query("-n 10"), ["bash1", "zsh1", "bash2", "zsh2", "fish1"])
+        hosts = self._keep_alive_conn.execute("""
+            select s.hostname, count(*) from commands c join sessions s on s.session = c.session
+            group by s.hostname order by s.hostname""").fetchall()
+        self.assertEqual([("host1", 2), ("host2", 2), ("host3", 1)], hosts)
+        # Only the commands added since the last import are imported.
+        with open(self.hosts_dir / "host1" / ".bash_history", "a") as f:
+            f.write("#1571012550\nbash3\n")
+        self.assertIn("imported 1 commands", self.import_history([str(self.hosts_dir)]))
+
+    def test_import_in_chunks_bounds_memory(self):
+        import concurrent.futures
+        wait, in_flight = concurrent.futures.wait, []
+
+        def recording_wait(futures, **kwargs):
+            in_flight.append(len(futures))
+            return wait(futures, **kwargs)
+
+        with mock.patch('recent2.IMPORT_CHUNK_SIZE', 1), \
+                mock.patch('concurrent.futures.wait', recording_wait):
+            out = self.import_history([str(self.hosts_dir), "-j", "1"])
+        self.assertIn("imported 5 commands from 3 files", out)
+        self.check_without_ts(self.query("-n 10"), ["bash1", "zsh1", "bash2", "zsh2", "fish1"])
+        # At most 2 chunks per job are parsed or waiting to be written, not one per file.
+        self.assertEqual(2, max(in_flight))
+        # Each chunk is checkpointed, so a rerun has nothing to import.
+        self.assertIn("imported 0 commands", self.import_history([str(self.hosts_dir)]))
+
+    def test_import_glob(self):
+        out = self.import_history([str(self.hosts_dir / "*" / ".*_history"), "--hostname", "h"])
+        self.assertIn("imported 4 commands from 2 files", out)
+        self.check_without_ts(self.query("-n 10"), ["bash1", "zsh1", "bash2", "zsh2"])
+
+    def test_parse_zsh_history(self):
+        # \xc6\x92 (utf-8 for \u0192) is metafied to \xc6\x83\xb2.
+        f = io.BytesIO(b"ls\n: 1571012545:0;echo \\\nfoo\n: 1571012546:3;\xc6\x83\xb2\n")
+        self.assertEqual([(-1, "ls", 3), (1571012545, "echo \nfoo", 29),
+                          (1571012546, "\u0192", 48)], list(recent2.parse_zsh_history(f)))
+
+    def test_parse_fish_history(self):
+        f = io.BytesIO(b"- cmd: echo a\\nb\n  when: 1571012545\n- cmd: ls\n  when: 1571012546\n")
+        self.assertEqual([(1571012545, "echo a\nb", 36), (1571012546, "ls", 65)],
+                         list(recent2.parse_fish_history(f)))
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -33,10 +33,12 @@ setup(
             'log-recent=recent2:log',
             'recent-import-bash-history=recent2:import_bash_history_entry_point',
             'recent=recent2:main',
+            'recent-daemon=recent2:daemon_entry_point',
+            'recent-session-init=recent2:session_init_entry_point',
+            'recent-gc=recent2:gc_entry_point',
+            'recent-import-history=recent2:import_history_entry_point',
         ],
     },
+    # recent also needs python's sqlite3 module to use sqlite >= 3.31. It checks that at runtime.
     python_requires='>=3',
-    install_requires=[
-        'tabulate',
-    ],
 )